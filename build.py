@@ -30,10 +30,13 @@ def set_properties(project):
     project.set_property('bucket_name', bucket_name)
 
     project.depends_on('boto3')
-    project.depends_on('pils')
     project.build_depends_on('unittest2')
     project.build_depends_on('cfn-sphere')
     project.build_depends_on('mock')
+    # Only needed by the integration tests.
+    project.build_depends_on('pils')
+    # Only needed by the offline simulator, not by the Lambda function.
+    project.build_depends_on('numpy')
 
 
 @init(environments='teamcity')
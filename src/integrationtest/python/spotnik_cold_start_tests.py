@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+from __future__ import print_function, absolute_import, division
+
+import os
+import unittest2
+
+from spotnik.benchmark import measure_cold_start
+
+# Budgets can be adjusted per build environment without touching the test.
+MAX_IMPORT_SECONDS = float(os.environ.get('SPOTNIK_MAX_IMPORT_SECONDS', 0.2))
+MAX_FIRST_CALL_SECONDS = float(os.environ.get('SPOTNIK_MAX_FIRST_CALL_SECONDS', 3.0))
+
+
+class SpotnikColdStartTests(unittest2.TestCase):
+    def test_cold_start_stays_within_budget(self):
+        result = measure_cold_start(repeat=3, api_call=True)
+        print("Cold start: %r" % result)
+
+        self.assertEqual(result['heavy_modules'], [])
+        self.assertLess(result['import_seconds'], MAX_IMPORT_SECONDS)
+        self.assertLess(result['first_call_seconds'], MAX_FIRST_CALL_SECONDS)
+
+
+if __name__ == "__main__":
+    unittest2.main()
@@ -5,7 +5,8 @@ import mock
 import time
 import unittest2
 
-from spotnik.spotnik import ReplacementPolicy
+from spotnik.records import AutoScalingGroup
+from spotnik.spotnik import ReplacementPolicy, Spotnik
 from spotnik_tests_base import SpotnikTestsBase
 
 
@@ -42,15 +43,14 @@ class SpotnikTests(SpotnikTestsBase):
         else:
             raise Exception("Timed out waiting for Spotnik to attach the new instance")
         _, _, asg_name = self.get_cf_output()
-        asg = self.autoscaling.describe_auto_scaling_groups(
-                AutoScalingGroupNames=[asg_name])['AutoScalingGroups'][0]
-        fake_spotnik = mock.Mock()
-        fake_spotnik.ec2_client = self.ec2
-        on_demand_instances, spot_instances = ReplacementPolicy(asg, fake_spotnik).get_instances()
+        asg = AutoScalingGroup.from_boto(self.autoscaling.describe_auto_scaling_groups(
+                AutoScalingGroupNames=[asg_name])['AutoScalingGroups'][0])
+        spotnik = Spotnik(self.region_name, asg, logger=mock.Mock())
+        on_demand_instances, spot_instances = ReplacementPolicy(asg, spotnik).get_instances()
 
         self.assertEqual(len(on_demand_instances), 1)
         self.assertEqual(len(spot_instances), 1)
-        self.assertEqual(spot_instances[0]['InstanceType'], 'm3.medium')
+        self.assertEqual(spot_instances[0].instance_type, 'm3.medium')
 
         # Fourth run of spotnik should do nothing because number of ondemand
         # instances would fall below minimum.
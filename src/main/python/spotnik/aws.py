@@ -0,0 +1,163 @@
+from __future__ import print_function, absolute_import, division
+
+import threading
+
+# Only these service models are loaded. They are loaded once per process
+# and shared by all clients, regardless of account, region or thread.
+SERVICE_NAMES = ('ec2', 'autoscaling')
+
+# Region used for calls that are not specific to a region.
+DEFAULT_REGION = 'eu-west-1'
+
+ROLE_SESSION_NAME = 'spotnik'
+
+_lock = threading.RLock()
+_sessions = {}
+# One lock per role ARN, so that each session is created only once, but
+# sessions of different accounts are created in parallel.
+_session_locks = {}
+_clients = {}
+# Captures or replays the calls of all clients, see spotnik.snapshot.
+_recorder = None
+
+
+def get_session(role_arn=None):
+    """Return the boto3 session shared by all spotnik clients of an account
+
+    Without role_arn, this is the session of the account spotnik runs in.
+    Otherwise, the role is assumed once and its credentials are refreshed
+    by botocore shortly before they expire.
+
+    boto3 is imported on first use, so that importing spotnik (e.g. on a
+    Lambda cold start) does not pay for it before there is work to do.
+    The AssumeRole call is made outside of the global lock.
+    """
+    with _lock:
+        session = _sessions.get(role_arn)
+        if session is not None:
+            return session
+        session_lock = _session_locks.setdefault(role_arn, threading.Lock())
+    with session_lock:
+        with _lock:
+            session = _sessions.get(role_arn)
+        if session is None:
+            if role_arn is None:
+                session = _create_default_session()
+            else:
+                session = _create_assumed_role_session(role_arn)
+            with _lock:
+                _sessions[role_arn] = session
+        return session
+
+
+def _create_default_session():
+    import boto3
+
+    session = boto3.session.Session()
+    loader = session._session.get_component('data_loader')
+    for service_name in SERVICE_NAMES:
+        loader.load_service_model(service_name, 'service-2')
+    return session
+
+
+def _create_assumed_role_session(role_arn):
+    import boto3
+    import botocore.session
+    from botocore.credentials import RefreshableCredentials
+
+    sts_client = get_client('sts', DEFAULT_REGION)
+
+    def assume_role():
+        credentials = sts_client.assume_role(
+            RoleArn=role_arn, RoleSessionName=ROLE_SESSION_NAME)['Credentials']
+        return {
+            'access_key': credentials['AccessKeyId'],
+            'secret_key': credentials['SecretAccessKey'],
+            'token': credentials['SessionToken'],
+            'expiry_time': credentials['Expiration'].isoformat(),
+        }
+
+    botocore_session = botocore.session.Session()
+    # Share the already loaded service models with the default session.
+    default_loader = get_session()._session.get_component('data_loader')
+    botocore_session.register_component('data_loader', default_loader)
+    botocore_session._credentials = RefreshableCredentials.create_from_metadata(
+        metadata=assume_role(), refresh_using=assume_role, method='sts-assume-role')
+    return boto3.session.Session(botocore_session=botocore_session)
+
+
+def get_client(service_name, region_name, role_arn=None):
+    """Return a cached client for the given service, region and account
+
+    Creating clients is expensive and not thread-safe, but the clients
+    themselves are, so one client per (account, service, region) is shared
+    by all threads.
+    """
+    key = (role_arn, service_name, region_name)
+    with _lock:
+        client = _clients.get(key)
+        if client is not None:
+            return client
+    # Creating a new account's session may take a network call, which must
+    # not block the clients of other accounts.
+    session = get_session(role_arn)
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            client = session.client(service_name, region_name=region_name)
+            if _recorder is not None:
+                _recorder.attach(client, role_arn, region_name)
+            _clients[key] = client
+        return client
+
+
+class ClientRegistry(object):
+    """Objects shared per account and region that are built from its clients
+
+    factory is called with the region name and the clients of
+    service_names. An object is built again once one of its clients was
+    replaced (see reset() and set_recorder()), so it never uses a client
+    that bypasses the recorder.
+    """
+    def __init__(self, factory, *service_names):
+        self.factory = factory
+        self.service_names = service_names
+        self._lock = threading.Lock()
+        # (role_arn, region_name) -> (clients, object)
+        self._entries = {}
+
+    def get(self, region_name, role_arn=None):
+        clients = tuple(get_client(service_name, region_name, role_arn=role_arn)
+                        for service_name in self.service_names)
+        key = (role_arn, region_name)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or any(old is not new for old, new in zip(entry[0], clients)):
+                entry = (clients, self.factory(region_name, *clients))
+                self._entries[key] = entry
+            return entry[1]
+
+    def pop_all(self):
+        """Forget all objects and return them by (role_arn, region_name)"""
+        with self._lock:
+            entries, self._entries = self._entries, {}
+        return dict((key, obj) for key, (_, obj) in entries.items())
+
+
+def reset():
+    """Forget all sessions and cached clients"""
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
+
+
+def set_recorder(recorder):
+    """Attach recorder to all clients created from now on
+
+    Already cached clients and sessions are dropped, so that no call
+    bypasses the recorder. Pass None to stop recording.
+    """
+    global _recorder
+    with _lock:
+        reset()
+        _recorder = recorder
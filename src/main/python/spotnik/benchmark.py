@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""Measure the cold start of the spotnik Lambda function
+
+Every measurement runs in a fresh interpreter, so that modules already
+imported by the calling process do not skew the result. Run it with
+
+    python -m spotnik.benchmark [--no-api-call] [--repeat N]
+"""
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# Importing spotnik must not import any of these.
+HEAVY_MODULES = ('boto3', 'botocore', 'pils', 'pprint')
+
+_SNIPPET = """
+import json, sys, time
+start = time.time()
+import spotnik
+imported = time.time()
+result = {
+    'import_seconds': imported - start,
+    'heavy_modules': [name for name in %(heavy_modules)r if name in sys.modules],
+}
+if %(api_call)r:
+    from spotnik.main import get_aws_region_names
+    get_aws_region_names()
+    result['first_call_seconds'] = time.time() - imported
+print(json.dumps(result))
+"""
+
+
+def measure_once(api_call=True):
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+    snippet = _SNIPPET % {'heavy_modules': HEAVY_MODULES, 'api_call': api_call}
+    output = subprocess.check_output([sys.executable, '-c', snippet], env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2
+
+
+def measure_cold_start(repeat=3, api_call=True):
+    """Return the median import time and time to first API call in seconds
+
+    The time to the first API call is measured from the end of the import
+    and includes importing boto3, loading the service models and creating
+    the first client.
+    """
+    runs = [measure_once(api_call=api_call) for _ in range(repeat)]
+    result = {
+        'import_seconds': _median([run['import_seconds'] for run in runs]),
+        'heavy_modules': sorted(set(name for run in runs for name in run['heavy_modules'])),
+    }
+    if api_call:
+        result['first_call_seconds'] = _median([run['first_call_seconds'] for run in runs])
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure the cold start of spotnik")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-api-call', dest='api_call', action='store_false',
+                        help="Only measure the import, do not call AWS")
+    args = parser.parse_args(argv)
+    print(json.dumps(measure_cold_start(repeat=args.repeat, api_call=args.api_call),
+                     sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+from __future__ import print_function, absolute_import, division
+
+import calendar
+import os
+import threading
+import time
+
+from .aws import ClientRegistry
+from .util import utcnow
+
+# EventBridge detail types that announce the loss of a spot instance.
+INTERRUPTION_WARNING = 'EC2 Spot Instance Interruption Warning'
+REBALANCE_RECOMMENDATION = 'EC2 Instance Rebalance Recommendation'
+# How the rebalancing spot requests triggered by each event are labeled.
+EVENT_TRIGGERS = {
+    INTERRUPTION_WARNING: 'interruption_warning',
+    REBALANCE_RECOMMENDATION: 'rebalance_recommendation',
+}
+
+# Status codes of spot requests whose instance was reclaimed by EC2.
+INTERRUPTION_STATUS_CODES = (
+    'instance-terminated-by-price', 'instance-terminated-no-capacity',
+    'instance-terminated-capacity-oversubscribed', 'instance-stopped-by-price',
+    'instance-stopped-no-capacity', 'instance-stopped-capacity-oversubscribed',
+    'marked-for-termination', 'marked-for-stop')
+
+# A pool with this many interruptions within the window is avoided. Can
+# be overridden with SPOTNIK_RISKY_POOL_INTERRUPTIONS.
+RISKY_POOL_INTERRUPTIONS = 2
+INTERRUPTION_WINDOW_SECONDS = 3600
+# The interruption history is fetched again after this many seconds,
+# i.e. once per run.
+REFRESH_SECONDS = 60
+
+# Pools marked risky by an interruption event are stored in this ASG tag,
+# because scheduled runs may happen in other Lambda containers than the
+# one that handled the event. The value looks like
+# "eu-west-1a/m5.large/1500000000 eu-west-1b/c5.large/1500000100".
+RISKY_POOLS_TAG_KEY = 'spotnik-risky-pools'
+MAX_TAG_VALUE_LENGTH = 256
+
+
+def is_interruption_event(event):
+    return isinstance(event, dict) and event.get('detail-type') in EVENT_TRIGGERS
+
+
+def get_pool(instance):
+    """Return the spot pool of an instance: (availability zone, instance type)"""
+    return instance.availability_zone, instance.instance_type
+
+
+def _get_timestamp(value):
+    return calendar.timegm(value.utctimetuple())
+
+
+def _now():
+    return _get_timestamp(utcnow())
+
+
+def get_reported_pools(tags, window_seconds=INTERRUPTION_WINDOW_SECONDS):
+    """Return when the pools in the RISKY_POOLS_TAG_KEY tag were reported
+
+    Pools reported before the window are left out.
+    """
+    now = _now()
+    pools = {}
+    for entry in tags.get(RISKY_POOLS_TAG_KEY, '').split():
+        try:
+            availability_zone, instance_type, reported_at = entry.split('/')
+            reported_at = int(reported_at)
+        except ValueError:
+            continue
+        pool = (availability_zone, instance_type)
+        if now - reported_at < window_seconds and reported_at > pools.get(pool, 0):
+            pools[pool] = reported_at
+    return pools
+
+
+def format_reported_pools(pools):
+    """Inverse of get_reported_pools(), keeps the latest pools that fit into a tag"""
+    entries = []
+    length = -1
+    for (availability_zone, instance_type), reported_at in sorted(pools.items(), key=lambda item: -item[1]):
+        entry = "%s/%s/%d" % (availability_zone, instance_type, reported_at)
+        length += len(entry) + 1
+        if length > MAX_TAG_VALUE_LENGTH:
+            break
+        entries.append(entry)
+    return " ".join(entries)
+
+
+class InterruptionTracker(object):
+    """Interruption rates of the spot pools of one account and region
+
+    The rates come from the spot requests EC2 closed because it reclaimed
+    their instance, which it keeps visible for a few hours. A pool is
+    risky if it had too many interruptions within the window, or if an
+    instance in it received an interruption warning or rebalance
+    recommendation (see record()).
+    """
+    def __init__(self, ec2_client, threshold=RISKY_POOL_INTERRUPTIONS,
+                 window_seconds=INTERRUPTION_WINDOW_SECONDS):
+        self.ec2_client = ec2_client
+        self.threshold = threshold
+        self.window_seconds = window_seconds
+
+        self._lock = threading.Lock()
+        self._interruptions = None
+        self._refreshed_at = None
+        self._reported = {}
+
+    def record(self, pool, reported_at=None):
+        """Mark a pool as risky after an interruption event for one of its instances
+
+        reported_at defaults to now (seconds since the epoch) and is returned.
+        """
+        reported_at = _now() if reported_at is None else reported_at
+        with self._lock:
+            self._reported[pool] = max(reported_at, self._reported.get(pool, reported_at))
+        return reported_at
+
+    def get_interruptions(self):
+        """Return the number of recent interruptions per pool"""
+        with self._lock:
+            now = time.time()
+            if self._refreshed_at is None or now - self._refreshed_at > REFRESH_SECONDS:
+                # The window is relative to utcnow(), which a replay pins.
+                self._interruptions = self._fetch_interruptions(_now())
+                self._refreshed_at = now
+            return dict(self._interruptions)
+
+    def is_risky(self, pool):
+        with self._lock:
+            reported_at = self._reported.get(pool)
+        if reported_at is not None and _now() - reported_at < self.window_seconds:
+            return True
+        return self.get_interruptions().get(pool, 0) >= self.threshold
+
+    def _fetch_interruptions(self, now):
+        interruptions = {}
+        kwargs = {'Filters': [{'Name': 'status-code', 'Values': list(INTERRUPTION_STATUS_CODES)}]}
+        while True:
+            response = self.ec2_client.describe_spot_instance_requests(**kwargs)
+            for request in response['SpotInstanceRequests']:
+                update_time = request.get('Status', {}).get('UpdateTime')
+                if update_time is None or now - _get_timestamp(update_time) > self.window_seconds:
+                    continue
+                pool = (request.get('LaunchedAvailabilityZone'),
+                        request.get('LaunchSpecification', {}).get('InstanceType'))
+                interruptions[pool] = interruptions.get(pool, 0) + 1
+            if not response.get('NextToken'):
+                return interruptions
+            kwargs['NextToken'] = response['NextToken']
+
+
+def _new_tracker(region_name, ec2_client):
+    threshold = int(os.environ.get('SPOTNIK_RISKY_POOL_INTERRUPTIONS', RISKY_POOL_INTERRUPTIONS))
+    return InterruptionTracker(ec2_client, threshold=threshold)
+
+
+_trackers = ClientRegistry(_new_tracker, 'ec2')
+
+
+def get_interruption_tracker(region_name, role_arn=None):
+    """Return the tracker shared by all ASGs of a region, across runs"""
+    return _trackers.get(region_name, role_arn=role_arn)
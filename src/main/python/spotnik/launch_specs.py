@@ -0,0 +1,123 @@
+from __future__ import print_function, absolute_import, division
+
+import threading
+import time
+from collections import OrderedDict
+
+from .aws import ClientRegistry
+from .records import LaunchConfiguration
+from .replacement_policy import generate_launch_specification
+
+# Launch configurations and numbered template versions never change, so
+# they are cached for the lifetime of the process. Aliases like $Latest
+# are resolved again after this many seconds, i.e. once per run.
+ALIAS_TTL_SECONDS = 60
+MAX_CACHE_SIZE = 1024
+
+
+class _LruCache(object):
+    """Thread-safe mapping that forgets the least recently used entries"""
+    def __init__(self, max_size=MAX_CACHE_SIZE):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                self._entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class LaunchSpecBuilder(object):
+    """Build spot launch specifications from launch configurations and templates
+
+    Resolved launch configurations and template versions are cached, as
+    are the finished specifications per (ASG, launch source, AZ, subnet,
+    security groups, instance type). Repeated replacements therefore make
+    no describe calls and reuse the same specification. The returned
+    specifications are shared and must not be modified.
+    """
+    def __init__(self, ec2_client, asg_client):
+        self.ec2_client = ec2_client
+        self.asg_client = asg_client
+        self._launch_configs = _LruCache()
+        # (template, version) -> (LaunchConfiguration, expiry time or None)
+        self._template_versions = _LruCache()
+        self._specs = _LruCache()
+
+    def get_launch_source(self, asg):
+        """Return the LaunchConfiguration record new instances of asg are based on"""
+        if asg.launch_template is not None:
+            return self._get_template_version(asg.launch_template)
+        if asg.launch_configuration_name:
+            return self._get_launch_config(asg.launch_configuration_name)
+        raise Exception("ASG %s has neither a launch configuration nor a launch template" % asg.name)
+
+    def build(self, asg, instance_to_replace, instance_type=None):
+        """Return the LaunchSpecification to replace instance_to_replace"""
+        launch_source = self.get_launch_source(asg)
+        key = (asg.name, launch_source.name, instance_to_replace.availability_zone,
+               instance_to_replace.subnet_id, instance_to_replace.security_group_ids,
+               instance_type or launch_source.instance_type)
+        launch_specification = self._specs.get(key)
+        if launch_specification is None:
+            launch_specification = generate_launch_specification(
+                launch_source, instance_to_replace, new_instance_type=instance_type)
+            self._specs.put(key, launch_specification)
+        return launch_specification
+
+    def _get_launch_config(self, name):
+        launch_config = self._launch_configs.get(name)
+        if launch_config is None:
+            response = self.asg_client.describe_launch_configurations(LaunchConfigurationNames=[name])
+            launch_config = LaunchConfiguration.from_boto(response['LaunchConfigurations'][0])
+            self._launch_configs.put(name, launch_config)
+        return launch_config
+
+    def _get_template_version(self, template):
+        key = (template.template_id or template.template_name, str(template.version))
+        cached = self._template_versions.get(key)
+        if cached is not None:
+            launch_config, expiry = cached
+            if expiry is None or expiry > time.time():
+                return launch_config
+
+        if template.template_id:
+            kwargs = {'LaunchTemplateId': template.template_id}
+        else:
+            kwargs = {'LaunchTemplateName': template.template_name}
+        response = self.ec2_client.describe_launch_template_versions(Versions=[str(template.version)], **kwargs)
+        template_version = response['LaunchTemplateVersions'][0]
+        launch_config = LaunchConfiguration.from_launch_template_version(template_version)
+
+        is_alias = str(template.version).startswith('$')
+        self._template_versions.put(key, (launch_config, time.time() + ALIAS_TTL_SECONDS if is_alias else None))
+        if is_alias:
+            # Also serve ASGs that reference the resolved version by number.
+            resolved_key = (key[0], str(template_version['VersionNumber']))
+            self._template_versions.put(resolved_key, (launch_config, None))
+        return launch_config
+
+
+def _new_builder(region_name, ec2_client, asg_client):
+    return LaunchSpecBuilder(ec2_client, asg_client)
+
+
+_builders = ClientRegistry(_new_builder, 'ec2', 'autoscaling')
+
+
+def get_launch_spec_builder(region_name, role_arn=None):
+    """Return the builder shared by all ASGs of a region, across runs"""
+    return _builders.get(region_name, role_arn=role_arn)
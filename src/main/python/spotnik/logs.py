@@ -0,0 +1,114 @@
+from __future__ import print_function, absolute_import, division
+
+import json
+import logging
+import os
+
+from .util import get_random
+
+TEXT_FORMAT = "%(asctime)-15s %(levelname)s - %(name)s - %(message)s"
+
+# Setting this tag on an ASG overrides SPOTNIK_LOG_SAMPLE_RATE for that ASG.
+SAMPLE_RATE_TAG_KEY = "spotnik-log-sample-rate"
+
+
+class _LazyPformat(object):
+    """Defer pformat() until the log record is actually emitted"""
+    __slots__ = ('payload',)
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def __str__(self):
+        from pprint import pformat
+        return pformat(self.payload)
+
+
+class _LazyKeyValues(object):
+    """Render a decision record as 'key=value key=value' for text logs"""
+    __slots__ = ('values',)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __str__(self):
+        return " ".join("%s=%s" % item for item in sorted(self.values.items()))
+
+
+class JsonFormatter(logging.Formatter):
+    """Format each log record as a single line of JSON
+
+    Records that carry a decision (see log_decision()) contain it as a
+    nested object instead of a formatted message.
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+        }
+        decision = getattr(record, 'decision', None)
+        if decision is not None:
+            entry['decision'] = decision
+        else:
+            entry['message'] = record.getMessage()
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, sort_keys=True, default=str)
+
+
+def configure_logging():
+    """Set the formatter of all root handlers according to SPOTNIK_LOG_FORMAT
+
+    Supported values are 'text' (the default) and 'json'.
+    """
+    if os.environ.get('SPOTNIK_LOG_FORMAT', 'text').lower() == 'json':
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter(fmt=TEXT_FORMAT)
+    for handler in logging.getLogger().handlers:
+        handler.setFormatter(formatter)
+
+
+def get_log_level():
+    return os.environ.get('SPOTNIK_LOG_LEVEL', 'INFO').upper()
+
+
+def get_sample_rate(asg_tags):
+    """Return the probability that payloads of this ASG are logged in a run"""
+    value = asg_tags.get(SAMPLE_RATE_TAG_KEY, os.environ.get('SPOTNIK_LOG_SAMPLE_RATE', 0))
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
+
+
+class PayloadLogger(object):
+    """Log large payloads (ASG config, launch configuration, ...) on demand
+
+    Payloads are only logged if the logger is enabled for DEBUG or if the
+    ASG was sampled for this run. Even then, they are only formatted when
+    the record is actually emitted. name (e.g. the ASG's) is passed to
+    util.get_random() for the sampling.
+    """
+    def __init__(self, logger, sample_rate=0.0, name=None):
+        self.logger = logger
+        if logger.isEnabledFor(logging.DEBUG):
+            self.level = logging.DEBUG
+        elif sample_rate > 0 and get_random(name).random() < sample_rate:
+            self.level = logging.INFO
+        else:
+            self.level = None
+
+    @property
+    def enabled(self):
+        return self.level is not None
+
+    def log(self, name, payload):
+        if self.enabled:
+            self.logger.log(self.level, "%s:\n%s", name, _LazyPformat(payload))
+
+
+def log_decision(logger, decision):
+    """Emit the one compact record that summarizes an ASG's run"""
+    logger.info("Decision: %s", _LazyKeyValues(decision), extra={'decision': decision})
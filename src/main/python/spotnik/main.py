@@ -1,89 +1,365 @@
 #!/usr/bin/env python
 from __future__ import print_function, absolute_import, division
 
-import boto3
 import logging
+import os
+import re
 import sys
-import threading
-from pprint import pformat
+import time
 
+from .aws import DEFAULT_REGION, get_client
+from .interruptions import EVENT_TRIGGERS, is_interruption_event
+from .logs import configure_logging, get_log_level, log_decision
+from .pool import WorkerPool
+from .records import Instance, Target
+from .report import ReportBuilder, get_price_table, get_run_interval_minutes, summarize
+from .sharding import (COORDINATOR_MARGIN_SECONDS, LambdaDispatcher, compact_results, is_in_asg_shard,
+                       merge_results, new_account_result, plan_shards)
 from .spotnik import Spotnik
+from .tagging import drain_tag_queues
+from .util import utcnow
 
-_ERROR_IN_MAIN = False
+# Upper limit for concurrent work (and thus AWS API calls) across all
+# accounts, regions and ASGs. Can be overridden with SPOTNIK_MAX_WORKERS.
+DEFAULT_MAX_WORKERS = 32
 
 
-def handler(*_):
-    formatter = logging.Formatter(fmt="%(asctime)-15s %(levelname)s - %(name)s - %(message)s")
-    for handler in logging.getLogger().handlers:
-        handler.setFormatter(formatter)
+def handler(event=None, context=None):
+    """Entry point of the Lambda function
+
+    Depending on the event (or SPOTNIK_SHARD_STRATEGY), this runs as
+    worker for one shard, as coordinator that splits the run into shards,
+    or does all the work itself. Spot interruption warnings and rebalance
+    recommendations from EventBridge only handle the affected ASG.
+    """
+    configure_logging()
+    event = event if isinstance(event, dict) else {}
+    if event.get('worker'):
+        return run_worker(event)
+    if is_interruption_event(event):
+        return handle_interruption_event(event)
+
+    targets = get_targets(event.get('role_arns'))
+    strategy = event.get('shard_strategy', os.environ.get('SPOTNIK_SHARD_STRATEGY'))
+    if strategy:
+        shard_count = int(event.get('shard_count', os.environ.get('SPOTNIK_SHARD_COUNT', 0)))
+        deadline = None
+        if context is not None:
+            deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - COORDINATOR_MARGIN_SECONDS
+        return coordinate(targets, LambdaDispatcher(deadline=deadline), strategy, shard_count=shard_count,
+                          deadline=deadline)
+    return main(targets=targets)
 
-    main()
 
+def get_targets(role_arns=None):
+    """Return the accounts spotnik should work on
 
-def get_aws_region_names():
-    ec2_client = boto3.client('ec2', region_name='eu-west-1')
+    The IAM roles to assume come from the Lambda event or from the comma
+    separated SPOTNIK_ROLE_ARNS. Without any, only the account spotnik
+    runs in is handled.
+    """
+    if role_arns is None:
+        role_arns = [arn for arn in re.split("[, ]+", os.environ.get('SPOTNIK_ROLE_ARNS', '')) if arn]
+    if not role_arns:
+        return [Target()]
+    return [Target.from_role_arn(role_arn) for role_arn in role_arns]
+
+
+def get_aws_region_names(role_arn=None):
+    ec2_client = get_client('ec2', DEFAULT_REGION, role_arn=role_arn)
     return [endpoint['RegionName'] for endpoint in ec2_client.describe_regions()['Regions']]
 
 
-def main():
+def _get_logger(target, *names):
+    parts = ['spotnik']
+    if target.role_arn:
+        parts.append(target.account_id)
+    parts.extend(names)
+    return logging.getLogger(".".join(parts))
+
+
+def main(targets=None, max_workers=None, regions=None, asg_shard=None, capture_path=None,
+         replay_path=None):
+    """Process all spotnik ASGs in all regions of the given accounts
+
+    Returns a dict with the regions, ASG decisions (including each ASG's
+    report), errors and report summary of each account. Raises an
+    exception after all work is done if any account had errors.
+
+    With capture_path, all AWS responses are written to a snapshot file.
+    With replay_path, they are read from one instead of calling AWS.
+    """
+    if capture_path or replay_path:
+        from . import snapshot
+        if capture_path:
+            recording = snapshot.capture(capture_path)
+        else:
+            recording = snapshot.replay(replay_path)
+        with recording:
+            results = run(targets, max_workers=max_workers, regions=regions, asg_shard=asg_shard)
+    else:
+        results = run(targets, max_workers=max_workers, regions=regions, asg_shard=asg_shard)
+    _raise_for_errors(results)
+    return results
+
+
+def run(targets=None, max_workers=None, regions=None, asg_shard=None, deadline=None):
+    """Like main(), but only report errors in the returned dict
+
+    If given, only the listed regions and the ASGs in asg_shard (a pair of
+    shard index and shard count) are processed. ASGs whose turn comes after
+    deadline (as returned by time.time()) are skipped and reported as an
+    error.
+    """
+    logger = logging.getLogger('spotnik')
+    logger.setLevel(get_log_level())
+
+    targets = targets or [Target()]
+    if max_workers is None:
+        max_workers = int(os.environ.get('SPOTNIK_MAX_WORKERS', DEFAULT_MAX_WORKERS))
+    results = dict((target.account_id, new_account_result()) for target in targets)
+    report_builder = ReportBuilder(get_price_table(), get_run_interval_minutes())
+
+    with WorkerPool(max_workers) as pool:
+        account_tasks = [(target, pool.submit(run_account, target, regions, results[target.account_id]))
+                         for target in targets]
+
+        region_tasks = []
+        for target, task in account_tasks:
+            for region_name in task.get():
+                region_tasks.append((target, region_name, pool.submit(
+                    run_region, target, region_name, asg_shard, results[target.account_id])))
+
+        asg_tasks = []
+        for target, region_name, task in region_tasks:
+            asgs, instances = task.get()
+            for asg in asgs:
+                asg_tasks.append((target, pool.submit(
+                    run_asg, target, region_name, asg, results[target.account_id], instances,
+                    report_builder, deadline)))
+
+        for target, task in asg_tasks:
+            results[target.account_id]['decisions'].append(task.get())
+
+    for account_id, result in results.items():
+        skipped = [decision for decision in result['decisions'] if decision.get('reason') == 'deadline']
+        if skipped:
+            logger.error("Account %s: skipped %d ASGs, the run's deadline passed", account_id, len(skipped))
+            result['errors'].append("skipped %d ASGs, the run's deadline passed" % len(skipped))
+
+    # Tag operations are still queued, wait for them before reporting.
+    account_ids = dict((target.role_arn, target.account_id) for target in targets)
+    for role_arn, failures in drain_tag_queues().items():
+        for failure in failures:
+            logger.error("Tagging failed: %s", failure)
+        results[account_ids[role_arn]]['errors'].extend(failures)
+
+    _add_summaries(results)
+    _log_summary(logger, results)
+    return results
+
+
+def _add_summaries(results):
+    for result in results.values():
+        result['summary'] = summarize(result['decisions'])
+
+
+def _log_summary(logger, results):
+    for account_id, result in sorted(results.items()):
+        summary = result['summary']
+        logger.info("Account %s: %d regions, %d ASGs, %d errors, %d on-demand and %d spot instances, "
+                    "saving %.2f US$/hour", account_id, len(result['regions']), summary['asgs'],
+                    len(result['errors']), summary['on_demand'], summary['spot'], summary['hourly_saving'])
+
+
+def _raise_for_errors(results):
+    failed_accounts = sorted(account_id for account_id, result in results.items() if result['errors'])
+    if failed_accounts:
+        raise Exception("Spotnik failed in account(s) %s" % ", ".join(failed_accounts))
+
+
+def run_worker(event):
+    """Process the shard described by a worker event, see plan_shards()"""
+    asg_shard = event.get('asg_shard')
+    return compact_results(run(get_targets(event.get('role_arns')), regions=event.get('regions'),
+                               asg_shard=tuple(asg_shard) if asg_shard else None,
+                               deadline=event.get('deadline')))
+
+
+def _get_all_region_names(targets):
+    """Return the regions enabled in any account, and errors per account ID
+
+    Opt-in regions may be enabled in some accounts only.
+    """
+    region_names = set()
+    errors = {}
+    with WorkerPool(min(len(targets), DEFAULT_MAX_WORKERS)) as pool:
+        tasks = [(target, pool.submit(get_aws_region_names, target.role_arn)) for target in targets]
+        for target, task in tasks:
+            try:
+                region_names.update(task.get())
+            except Exception as exc:
+                _get_logger(target).exception("Could not list regions of account %s:", target.account_id)
+                errors[target.account_id] = "%s" % exc
+    return sorted(region_names), errors
+
+
+def coordinate(targets, dispatcher, strategy, shard_count=None, deadline=None):
+    """Split a run into shards and let the dispatcher run them in parallel
+
+    The shards cover the regions enabled in any of the accounts. The
+    merged results are returned like main() returns them, but without the
+    decisions; the workers log those. Workers stop taking on ASGs in time
+    for the coordinator to collect their results by deadline.
+    """
     logger = logging.getLogger('spotnik')
-    logger.setLevel(logging.INFO)
+    logger.setLevel(get_log_level())
 
-    regional_threads = []
-    for region_name in get_aws_region_names():
-        logger.info("Starting thread for AWS region %s", region_name)
-        regional_thread = threading.Thread(target=run_regional_thread, args=(region_name,))
-        regional_thread.start()
-        regional_threads.append(regional_thread)
+    targets = targets or [Target()]
+    region_names, errors = _get_all_region_names(targets)
+    events = plan_shards(targets, strategy, region_names, shard_count=shard_count, deadline=deadline)
+    logger.info("Dispatching %d shards (strategy %s)", len(events), strategy)
 
-    for regional_thread in regional_threads:
-        regional_thread.join()
+    results = merge_results(targets, dispatcher.dispatch(events))
+    for account_id, error in errors.items():
+        results[account_id]['errors'].append(error)
+    _log_summary(logger, results)
+    _raise_for_errors(results)
+    return results
 
-    if _ERROR_IN_MAIN:
-        raise Exception("One of the worker threads failed")
 
+def handle_interruption_event(event, targets=None):
+    """Prepare the replacement of a spot instance that is about to be lost
 
-def run_regional_thread(region_name):
-    logger = logging.getLogger("spotnik." + region_name)
+    Handles the EventBridge events listed in EVENT_TRIGGERS. The event's
+    account must be the local one or one of the targets.
+    """
+    logger = logging.getLogger('spotnik')
+    logger.setLevel(get_log_level())
+
+    targets = dict((target.account_id, target) for target in targets or get_targets())
+    target = targets.get(event.get('account'), Target())
+    result = new_account_result()
+    try:
+        decision = run_interruption_event(target, event, result)
+    finally:
+        for failures in drain_tag_queues().values():
+            result['errors'].extend(failures)
+    results = {target.account_id: result}
+    _raise_for_errors(results)
+    return decision
+
+
+def run_interruption_event(target, event, result):
+    region_name = event['region']
+    instance_id = event['detail']['instance-id']
+    logger = _get_logger(target, region_name)
+    decision = {'account': target.account_id, 'region': region_name, 'action': 'none',
+                'trigger': EVENT_TRIGGERS[event['detail-type']], 'instance_id': instance_id}
+    start_time = time.time()
+    try:
+        ec2_client = get_client('ec2', region_name, role_arn=target.role_arn)
+        reservations = ec2_client.describe_instances(InstanceIds=[instance_id])['Reservations']
+        instance = Instance.from_boto(reservations[0]['Instances'][0])
+        asg = None
+        if instance.asg_name:
+            asg = Spotnik.get_spotnik_asg(region_name, instance.asg_name, role_arn=target.role_arn)
+        if asg is None:
+            decision['reason'] = 'not_in_spotnik_asg'
+            return decision
+
+        decision['asg'] = asg.name
+        spotnik = Spotnik(region_name, asg, logger=_get_logger(target, region_name, asg.name),
+                          decision=decision, role_arn=target.role_arn)
+        spot_request, _ = spotnik.get_pending_spot_resources()
+        if spot_request:
+            # Only one spot request per ASG may be pending.
+            decision.update(action='pending', spot_request_id=spot_request.request_id)
+        else:
+            spotnik.make_rebalance_request(instance, decision['trigger'])
+    except Exception as exc:
+        decision['action'] = 'failed'
+        logger.exception("Task failed:")
+        result['errors'].append("%s/%s: %s" % (region_name, instance_id, exc))
+    finally:
+        decision['duration_ms'] = int((time.time() - start_time) * 1000)
+        log_decision(logger, decision)
+    return decision
+
+
+def run_account(target, regions, result):
+    logger = _get_logger(target)
     try:
-        spotnik_asgs = Spotnik.get_spotnik_asgs(region_name)
-        logger.info("Found %d spotnik ASGs", len(spotnik_asgs))
+        region_names = get_aws_region_names(role_arn=target.role_arn)
+        if regions is not None:
+            region_names = [region_name for region_name in region_names if region_name in regions]
+    except Exception as exc:
+        logger.exception("Could not list regions of account %s:", target.account_id)
+        result['errors'].append("%s" % exc)
+        return []
+    result['regions'].extend(region_names)
+    return region_names
 
-        asg_threads = []
-        for asg in spotnik_asgs:
-            asg_thread = threading.Thread(target=run_asg_thread, args=(region_name, asg))
-            asg_thread.start()
-            asg_threads.append(asg_thread)
 
-        for asg_thread in asg_threads:
-            asg_thread.join()
-    except Exception:
-        logger.exception("Thread failed:")
-        global _ERROR_IN_MAIN
-        _ERROR_IN_MAIN = True
+def run_region(target, region_name, asg_shard, result):
+    logger = _get_logger(target, region_name)
+    try:
+        spotnik_asgs = Spotnik.get_spotnik_asgs(region_name, role_arn=target.role_arn)
+    except Exception as exc:
+        logger.exception("Task failed:")
+        result['errors'].append("%s: %s" % (region_name, exc))
+        return [], None
+    spotnik_asgs = [asg for asg in spotnik_asgs if is_in_asg_shard(asg.name, asg_shard)]
+    logger.info("Found %d spotnik ASGs", len(spotnik_asgs))
+    if not spotnik_asgs:
+        return [], None
+    try:
+        Spotnik.record_reported_pools(region_name, spotnik_asgs, role_arn=target.role_arn)
+        instances = Spotnik.get_instance_snapshot(region_name, spotnik_asgs, role_arn=target.role_arn)
+    except Exception as exc:
+        logger.exception("Task failed:")
+        result['errors'].append("%s: %s" % (region_name, exc))
+        return [], None
+    return spotnik_asgs, instances
 
 
-def run_asg_thread(region_name, asg):
-    logger = logging.getLogger("spotnik.%s.%s" % (region_name, asg['AutoScalingGroupName']))
+def run_asg(target, region_name, asg, result, instances=None, report_builder=None, deadline=None):
+    logger = _get_logger(target, region_name, asg.name)
+    decision = {'account': target.account_id, 'region': region_name, 'asg': asg.name,
+                'action': 'none'}
+    start_time = time.time()
     try:
-        spotnik = Spotnik(region_name, asg, logger=logger)
+        if deadline is not None and start_time > deadline:
+            # The next run handles the ASG, rather than losing the results of the whole run.
+            decision['reason'] = 'deadline'
+            return decision
+        spotnik = Spotnik(region_name, asg, logger=logger, decision=decision,
+                          role_arn=target.role_arn, instances=instances)
 
-        logger.info("Processing ASG with this config: \n%s", pformat(asg))
+        spotnik.payload_logger.log("Processing ASG with this config", asg)
         spot_request, spot_instance_id = spotnik.get_pending_spot_resources()
         if spot_instance_id:
-            logger.info("Instance %r is ready to be attached to ASG", spot_instance_id)
-            spotnik.attach_spot_instance(spot_instance_id, spot_request)
+            logger.debug("Instance %r is ready to be attached to ASG", spot_instance_id)
+            attached = spotnik.attach_spot_instance(spot_instance_id, spot_request)
             spotnik.untag_spot_request(spot_request)
+            decision.update(action='attached' if attached else 'discarded',
+                            spot_request_id=spot_request.request_id, spot_instance_id=spot_instance_id)
         elif spot_request:
-            logger.info("ASG has pending spot request %r.", spot_request['SpotInstanceRequestId'])
             # Amazon processing our request, but no instance yet
-            return
+            decision.update(action='pending', spot_request_id=spot_request.request_id,
+                            replaced_instance_id=spot_request.tags.get('spotnik-will-replace'))
         else:
             spotnik.make_spot_request()
-    except Exception:
-        logger.exception("Thread failed:")
-        global _ERROR_IN_MAIN
-        _ERROR_IN_MAIN = True
+    except Exception as exc:
+        decision['action'] = 'failed'
+        logger.exception("Task failed:")
+        result['errors'].append("%s/%s: %s" % (region_name, asg.name, exc))
+    finally:
+        if instances is not None and report_builder is not None:
+            decision['report'] = report_builder.build(region_name, asg, instances, decision, utcnow())
+        decision['duration_ms'] = int((time.time() - start_time) * 1000)
+        log_decision(logger, decision)
+    return decision
 
 
 if __name__ == "__main__":
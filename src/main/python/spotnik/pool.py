@@ -0,0 +1,75 @@
+from __future__ import print_function, absolute_import, division
+
+import threading
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class _Task(object):
+    __slots__ = ('function', 'args', 'result', 'exception', 'done')
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.result = None
+        self.exception = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.result = self.function(*self.args)
+        except Exception as exc:
+            self.exception = exc
+        finally:
+            self.done.set()
+
+    def get(self):
+        """Wait for the task to finish and return its result"""
+        self.done.wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.result
+
+
+class WorkerPool(object):
+    """A fixed number of threads that run submitted tasks
+
+    All work of a run goes through one pool, so the number of concurrent
+    AWS API calls is bounded no matter how many accounts, regions and ASGs
+    there are. Tasks must not wait for other tasks of the same pool.
+    """
+    def __init__(self, max_workers):
+        self._tasks = queue.Queue()
+        self._threads = []
+        for _ in range(max_workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            task.run()
+
+    def submit(self, function, *args):
+        task = _Task(function, args)
+        self._tasks.put(task)
+        return task
+
+    def shutdown(self):
+        for _ in self._threads:
+            self._tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.shutdown()
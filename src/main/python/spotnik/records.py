@@ -0,0 +1,229 @@
+from __future__ import print_function, absolute_import, division
+
+from .util import _boto_tags_to_dict
+
+
+class _Record(object):
+    """Compact replacement for a boto response dict
+
+    Only the fields that spotnik actually reads are kept. Each record is
+    created from a boto response with from_boto(), so the (much larger)
+    response can be garbage collected right after the API call.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        fields = ", ".join("%s=%r" % (name, getattr(self, name)) for name in self.__slots__)
+        return "%s(%s)" % (type(self).__name__, fields)
+
+    def __eq__(self, other):
+        if type(self) is not type(other):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    __hash__ = None
+
+
+class Instance(_Record):
+    __slots__ = ('instance_id', 'lifecycle', 'launch_time', 'availability_zone',
+                 'subnet_id', 'security_group_ids', 'state', 'tags', 'instance_type')
+
+    def __init__(self, instance_id, lifecycle=None, launch_time=None, availability_zone=None,
+                 subnet_id=None, security_group_ids=(), state=None, tags=None, instance_type=None):
+        self.instance_id = instance_id
+        self.lifecycle = lifecycle
+        self.launch_time = launch_time
+        self.availability_zone = availability_zone
+        self.subnet_id = subnet_id
+        self.security_group_ids = tuple(security_group_ids)
+        self.state = state
+        self.tags = tags or {}
+        self.instance_type = instance_type
+
+    @property
+    def is_spot(self):
+        return self.lifecycle == "spot"
+
+    @classmethod
+    def from_boto(cls, description):
+        # FIXME: support multiple interfaces
+        interfaces = description.get('NetworkInterfaces') or [{}]
+        primary_interface = interfaces[0]
+        return cls(
+            instance_id=description['InstanceId'],
+            lifecycle=description.get('InstanceLifecycle'),
+            launch_time=description.get('LaunchTime'),
+            availability_zone=description.get('Placement', {}).get('AvailabilityZone'),
+            subnet_id=primary_interface.get('SubnetId'),
+            security_group_ids=[group['GroupId'] for group in primary_interface.get('Groups', [])],
+            state=description.get('State', {}).get('Name'),
+            tags=_boto_tags_to_dict(description.get('Tags', [])),
+            instance_type=description.get('InstanceType'))
+
+    @property
+    def asg_name(self):
+        """Name of the ASG the instance belongs to, if any"""
+        return self.tags.get('aws:autoscaling:groupName')
+
+
+class LaunchTemplateRef(_Record):
+    """The launch template (and version) an ASG launches its instances from"""
+    __slots__ = ('template_id', 'template_name', 'version')
+
+    DEFAULT_VERSION = '$Default'
+
+    def __init__(self, template_id=None, template_name=None, version=DEFAULT_VERSION):
+        self.template_id = template_id
+        self.template_name = template_name
+        self.version = version or self.DEFAULT_VERSION
+
+    @classmethod
+    def from_boto(cls, specification):
+        return cls(
+            template_id=specification.get('LaunchTemplateId'),
+            template_name=specification.get('LaunchTemplateName'),
+            version=specification.get('Version'))
+
+
+class AutoScalingGroup(_Record):
+    """An ASG that spotnik works on
+
+    The ASG launches its instances either from launch_configuration_name or
+    from launch_template. With a mixed instances policy, instance_types
+    holds the instance types of its overrides. lifecycle_states maps
+    instance IDs to their lifecycle state in the ASG (e.g. "InService").
+    """
+    __slots__ = ('name', 'tags', 'instance_ids', 'max_size', 'launch_configuration_name',
+                 'launch_template', 'instance_types', 'lifecycle_states')
+
+    def __init__(self, name, tags=None, instance_ids=(), max_size=None,
+                 launch_configuration_name=None, launch_template=None, instance_types=(),
+                 lifecycle_states=None):
+        self.name = name
+        self.tags = tags or {}
+        self.instance_ids = tuple(instance_ids)
+        self.max_size = max_size
+        self.launch_configuration_name = launch_configuration_name
+        self.launch_template = launch_template
+        self.instance_types = tuple(instance_types)
+        self.lifecycle_states = lifecycle_states or {}
+
+    @classmethod
+    def from_boto(cls, asg):
+        launch_template = asg.get('LaunchTemplate')
+        instance_types = []
+        mixed_instances_policy = asg.get('MixedInstancesPolicy')
+        if mixed_instances_policy:
+            # FIXME: support launch templates that are specific to an override
+            template = mixed_instances_policy['LaunchTemplate']
+            launch_template = template['LaunchTemplateSpecification']
+            instance_types = [override['InstanceType'] for override in template.get('Overrides', [])
+                              if 'InstanceType' in override]
+        return cls(
+            name=asg['AutoScalingGroupName'],
+            tags=_boto_tags_to_dict(asg.get('Tags', [])),
+            instance_ids=[instance['InstanceId'] for instance in asg.get('Instances', [])],
+            max_size=asg.get('MaxSize'),
+            launch_configuration_name=asg.get('LaunchConfigurationName'),
+            launch_template=LaunchTemplateRef.from_boto(launch_template) if launch_template else None,
+            instance_types=instance_types,
+            lifecycle_states=dict((instance['InstanceId'], instance.get('LifecycleState'))
+                                  for instance in asg.get('Instances', [])))
+
+
+class SpotRequest(_Record):
+    __slots__ = ('request_id', 'state', 'instance_id', 'tags')
+
+    def __init__(self, request_id, state=None, instance_id=None, tags=None):
+        self.request_id = request_id
+        self.state = state
+        self.instance_id = instance_id
+        self.tags = tags or {}
+
+    @classmethod
+    def from_boto(cls, request):
+        return cls(
+            request_id=request['SpotInstanceRequestId'],
+            state=request.get('State'),
+            instance_id=request.get('InstanceId'),
+            tags=_boto_tags_to_dict(request.get('Tags', [])))
+
+
+class LaunchConfiguration(_Record):
+    __slots__ = ('name', 'image_id', 'user_data', 'instance_type', 'iam_instance_profile',
+                 'monitoring_enabled', 'block_device_mappings', 'key_name', 'ebs_optimized',
+                 'associate_public_ip_address')
+
+    def __init__(self, name, image_id, user_data, instance_type, iam_instance_profile,
+                 monitoring_enabled, block_device_mappings, key_name=None, ebs_optimized=False,
+                 associate_public_ip_address=None):
+        self.name = name
+        self.image_id = image_id
+        self.user_data = user_data
+        self.instance_type = instance_type
+        self.iam_instance_profile = iam_instance_profile
+        self.monitoring_enabled = monitoring_enabled
+        self.block_device_mappings = block_device_mappings
+        self.key_name = key_name
+        self.ebs_optimized = ebs_optimized
+        self.associate_public_ip_address = associate_public_ip_address
+
+    @classmethod
+    def from_boto(cls, launch_config):
+        return cls(
+            name=launch_config['LaunchConfigurationName'],
+            image_id=launch_config['ImageId'],
+            user_data=launch_config['UserData'],
+            instance_type=launch_config['InstanceType'],
+            iam_instance_profile=launch_config['IamInstanceProfile'],
+            monitoring_enabled=launch_config['InstanceMonitoring']['Enabled'],
+            block_device_mappings=launch_config['BlockDeviceMappings'],
+            key_name=launch_config.get('KeyName'),
+            ebs_optimized=launch_config.get('EbsOptimized', False),
+            associate_public_ip_address=launch_config['AssociatePublicIpAddress'])
+
+    @classmethod
+    def from_launch_template_version(cls, template_version):
+        """Create a record from a describe_launch_template_versions() entry
+
+        The name identifies the exact template version, e.g. "lt-123:4".
+        """
+        data = template_version['LaunchTemplateData']
+        profile = data.get('IamInstanceProfile', {})
+        interfaces = data.get('NetworkInterfaces') or [{}]
+        return cls(
+            name="%s:%s" % (template_version['LaunchTemplateId'], template_version['VersionNumber']),
+            image_id=data.get('ImageId'),
+            user_data=data.get('UserData', ''),
+            instance_type=data.get('InstanceType'),
+            iam_instance_profile=profile.get('Arn') or profile.get('Name'),
+            monitoring_enabled=data.get('Monitoring', {}).get('Enabled', False),
+            block_device_mappings=data.get('BlockDeviceMappings', []),
+            key_name=data.get('KeyName'),
+            ebs_optimized=data.get('EbsOptimized', False),
+            associate_public_ip_address=interfaces[0].get('AssociatePublicIpAddress'))
+
+
+class Target(_Record):
+    """An AWS account spotnik works on
+
+    Without a role_arn, this is the account spotnik itself runs in.
+    """
+    __slots__ = ('account_id', 'role_arn')
+
+    LOCAL_ACCOUNT_ID = 'local'
+
+    def __init__(self, account_id=LOCAL_ACCOUNT_ID, role_arn=None):
+        self.account_id = account_id
+        self.role_arn = role_arn
+
+    @classmethod
+    def from_role_arn(cls, role_arn):
+        # arn:aws:iam::123456789012:role/spotnik
+        return cls(account_id=role_arn.split(':')[4], role_arn=role_arn)
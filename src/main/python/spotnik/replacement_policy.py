@@ -1,86 +1,97 @@
 from __future__ import print_function, absolute_import, division
 
-import random
 import re
-from pprint import pformat
-from datetime import datetime
 
-from .util import _boto_tags_to_dict
+from .util import get_random, utcnow
+
+# An on-demand instance is only replaced while its minutes past the full
+# billing hour are strictly between these two values.
+REPLACEMENT_WINDOW = (45, 55)
 
 
 def generate_launch_specification(launch_config, instance_to_replace, new_instance_type=None):
-    new_instance_type = new_instance_type or launch_config['InstanceType']
-    iam_profile_lc = launch_config['IamInstanceProfile']
-    if iam_profile_lc.startswith('arn:aws:'):
-        iam_profile = {'Arn': iam_profile_lc}
-    else:
-        iam_profile = {'Name': iam_profile_lc}
+    """Build the LaunchSpecification for request_spot_instances()
+
+    launch_config is a LaunchConfiguration record, instance_to_replace an
+    Instance record.
+    """
+    new_instance_type = new_instance_type or launch_config.instance_type
 
     launch_specification = {
-        'ImageId': launch_config['ImageId'],
-        'UserData': launch_config['UserData'],  # FIXME: test empty userdata
+        'ImageId': launch_config.image_id,
+        'UserData': launch_config.user_data,  # FIXME: test empty userdata
         'InstanceType': new_instance_type,
-        'Placement': {'AvailabilityZone': instance_to_replace['Placement']['AvailabilityZone']},
-        'IamInstanceProfile': iam_profile,
-        'Monitoring': dict(launch_config['InstanceMonitoring']),
+        'Placement': {'AvailabilityZone': instance_to_replace.availability_zone},
+        'Monitoring': {'Enabled': launch_config.monitoring_enabled},
         'NetworkInterfaces': get_network_specification(
                 launch_config, instance_to_replace),
 
         # autospotter says that KernelId and RamdiskId should not be copied.
 
         # Fixme: may need some conversion
-        'BlockDeviceMappings': launch_config['BlockDeviceMappings']
+        'BlockDeviceMappings': launch_config.block_device_mappings
         }
 
-    if launch_config.get("KeyName"):
+    iam_profile_lc = launch_config.iam_instance_profile
+    if iam_profile_lc:
+        # Launch templates do not need an instance profile.
+        if iam_profile_lc.startswith('arn:aws:'):
+            launch_specification['IamInstanceProfile'] = {'Arn': iam_profile_lc}
+        else:
+            launch_specification['IamInstanceProfile'] = {'Name': iam_profile_lc}
+    if launch_config.key_name:
         # Needed to support instances without any SSH key.
-        launch_specification["KeyName"] = launch_config['KeyName']
-    if launch_config.get('EbsOptimized'):
-        launch_specification["EbsOptimized"] = launch_config['EbsOptimized']
+        launch_specification["KeyName"] = launch_config.key_name
+    if launch_config.ebs_optimized:
+        launch_specification["EbsOptimized"] = launch_config.ebs_optimized
 
     return launch_specification
 
 
 def get_network_specification(launch_config, instance_to_replace):
     # FIXME: support multiple interfaces
-    return [{
+    interface = {
         'DeviceIndex': 0,
         # FIXME: support multiple groups
-        'Groups': [instance_to_replace['NetworkInterfaces'][0]['Groups'][0]['GroupId']],
-        'SubnetId': instance_to_replace['NetworkInterfaces'][0]['SubnetId'],
-        'AssociatePublicIpAddress': launch_config['AssociatePublicIpAddress']
-    }]
+        'Groups': [instance_to_replace.security_group_ids[0]],
+        'SubnetId': instance_to_replace.subnet_id,
+    }
+    if launch_config.associate_public_ip_address is not None:
+        interface['AssociatePublicIpAddress'] = launch_config.associate_public_ip_address
+    return [interface]
 
 
 class ReplacementPolicy(object):
     def __init__(self, asg, spotnik):
         self.asg = asg
-        self.asg_name = asg['AutoScalingGroupName']
-        self.asg_tags = _boto_tags_to_dict(asg['Tags'])
+        self.asg_name = asg.name
+        self.asg_tags = asg.tags
         self.on_demand_instances = None
+        self.spot_instances = None
 
         self.spotnik = spotnik
         self.ec2_client = spotnik.ec2_client
         self.logger = spotnik.logger
+        self.payload_logger = spotnik.payload_logger
+        self.decision = spotnik.decision
+        self.interruption_tracker = spotnik.interruption_tracker
 
         # Keep at least this many on-demand instances in the ASG.
         self.min_on_demand = int(self.asg_tags.get('spotnik-min-on-demand-instances', 0))
 
     def get_instances(self):
-        instances = self.asg['Instances']
         spot_instances = []
         on_demand_instances = []
-        for instance in instances:
-            response = self.ec2_client.describe_instances(InstanceIds=[instance['InstanceId']])
-            description = response['Reservations'][0]['Instances'][0]
-            if description.get('InstanceLifecycle') == "spot":
-                spot_instances.append(description)
+        for instance_id in self.asg.instance_ids:
+            instance = self.spotnik.describe_instance(instance_id)
+            if instance.is_spot:
+                spot_instances.append(instance)
             else:
-                on_demand_instances.append(description)
+                on_demand_instances.append(instance)
         return on_demand_instances, spot_instances
 
     def is_replacement_needed(self):
-        self.on_demand_instances, spot_instances = self.get_instances()
+        self.on_demand_instances, self.spot_instances = self.get_instances()
         num_on_demand_instances = len(self.on_demand_instances)
 
         msg = "Instances in ASG {asg}: {on_demand} on-demand, {spot} spot. "
@@ -96,20 +107,26 @@ class ReplacementPolicy(object):
             if self.min_on_demand:
                 msg += ("the number of on-demand instances would "
                         "fall below the minimum.")
+                reason = 'min_on_demand_reached'
             else:
                 msg += " all instances are already spotted."
+                reason = 'all_spot'
         msg = msg.format(asg=self.asg_name, on_demand=num_on_demand_instances,
-                         spot=len(spot_instances),
+                         spot=len(self.spot_instances),
                          min_on_demand=self.min_on_demand)
-        self.logger.info(msg)
+        self.logger.debug(msg)
+        self.decision.update(on_demand=num_on_demand_instances, spot=len(self.spot_instances),
+                             min_on_demand=self.min_on_demand)
         if not replacement_needed:
+            self.decision['reason'] = reason
             return False
 
         for instance in self.on_demand_instances:
             if self.should_instance_be_replaced_now(instance):
-                self.logger.info("Found an instance that is old enough for replacement")
+                self.logger.debug("Found an instance that is old enough for replacement")
                 return True
-        self.logger.info("None of the instances is old enough for replacement")
+        self.logger.debug("None of the instances is old enough for replacement")
+        self.decision['reason'] = 'no_instance_old_enough'
         return False
 
     @staticmethod
@@ -120,30 +137,77 @@ class ReplacementPolicy(object):
         Therefor, an instance that has been running for 5 minutes should not
         be replaced, but run for another ~40 minutes.
         """
-        minutes_over_hour = (datetime.utcnow().minute - instance['LaunchTime'].minute) % 60
-        return 45 < minutes_over_hour < 55
+        minutes_over_hour = (utcnow().minute - instance.launch_time.minute) % 60
+        window_start, window_end = REPLACEMENT_WINDOW
+        return window_start < minutes_over_hour < window_end
 
-    def _decide_instance_type(self):
+    def _get_instance_types(self):
         spotnik_instance_type = self.asg_tags.get('spotnik-instance-type', '')
 
         # Allow both comma and/or space separated instance types.
-        instance_types = re.split(",? *", spotnik_instance_type)
-        return random.choice(instance_types) or None
+        instance_types = [instance_type for instance_type in re.split(r"[,\s]+", spotnik_instance_type)
+                          if instance_type]
+        # Without the tag, use the types of the mixed instances policy.
+        return instance_types or list(self.asg.instance_types)
+
+    def _is_risky(self, availability_zone, instance_type):
+        return self.interruption_tracker.is_risky((availability_zone, instance_type))
+
+    def _decide_instance_type(self, availability_zone=None):
+        instance_types = self._get_instance_types()
+        if availability_zone is not None:
+            # Do not request spot instances from pools that are likely to be
+            # reclaimed soon, unless there is no other choice.
+            safe_instance_types = [instance_type for instance_type in instance_types
+                                   if not self._is_risky(availability_zone, instance_type)]
+            instance_types = safe_instance_types or instance_types
+        return get_random(self.asg_name).choice(instance_types) if instance_types else None
 
     def decide_replacement(self):
         # decide which instance to replace
-        replaced_instance_details = self.spotnik.describe_instance(self.on_demand_instances[0]['InstanceId'])
-        self.logger.info("replaced_instance_details: %s\n", pformat(replaced_instance_details))
+        replaced_instance_details = self.spotnik.describe_instance(self.on_demand_instances[0].instance_id)
+        self.payload_logger.log("replaced_instance_details", replaced_instance_details)
 
         # decide with what to replace it
-        launch_config_name = self.asg['LaunchConfigurationName']
-        launch_config = self.spotnik.describe_launch_configuration(launch_config_name)
-        self.logger.info("launch_config: %s\n", pformat(launch_config))
-
-        instance_type = self._decide_instance_type()
-        launch_specification = generate_launch_specification(launch_config, replaced_instance_details,
-                                                             new_instance_type=instance_type)
-        self.logger.info("launch_specification: %s\n", pformat(launch_specification))
+        instance_type = self._decide_instance_type(replaced_instance_details.availability_zone)
+        return self._build_replacement(replaced_instance_details, instance_type)
+
+    def decide_rebalance(self, spot_instances=None):
+        """Decide whether a spot instance should be moved off its spot pool
+
+        Looks for a spot instance (by default of those found by
+        is_replacement_needed()) in a risky pool, and for an instance type
+        whose pool in the same availability zone is not risky. Returns the
+        same as decide_replacement(), or None if nothing should be moved.
+        """
+        if spot_instances is None:
+            spot_instances = self.spot_instances or []
+        at_risk = [instance for instance in spot_instances
+                   if self._is_risky(instance.availability_zone, instance.instance_type)]
+        if not at_risk:
+            return None
+
+        replaced_instance_details = at_risk[0]
+        self.payload_logger.log("replaced_instance_details", replaced_instance_details)
+        availability_zone = replaced_instance_details.availability_zone
+        instance_types = self._get_instance_types()
+        if not instance_types:
+            launch_source = self.spotnik.launch_spec_builder.get_launch_source(self.asg)
+            instance_types = [launch_source.instance_type]
+        safe_instance_types = [instance_type for instance_type in instance_types
+                               if not self._is_risky(availability_zone, instance_type)]
+        if not safe_instance_types:
+            self.logger.debug("No safe spot pool to move instance %s to", replaced_instance_details.instance_id)
+            self.decision['reason'] = 'no_safe_pool'
+            return None
+        return self._build_replacement(replaced_instance_details, get_random(self.asg_name).choice(safe_instance_types))
+
+    def _build_replacement(self, replaced_instance_details, instance_type):
+        builder = self.spotnik.launch_spec_builder
+        self.payload_logger.log("launch_config", builder.get_launch_source(self.asg))
+
+        launch_specification = builder.build(self.asg, replaced_instance_details, instance_type=instance_type)
+        self.payload_logger.log("launch_specification", launch_specification)
 
         # decide how much we want to pay
         bid_price = self.asg_tags['spotnik-bid-price']
@@ -0,0 +1,187 @@
+from __future__ import print_function, absolute_import, division
+
+import json
+import logging
+import os
+import threading
+
+from .replacement_policy import REPLACEMENT_WINDOW
+
+# How often the Lambda function runs, see the ScheduleExpressionCron
+# parameter of the stack. Can be overridden with SPOTNIK_RUN_INTERVAL_MINUTES.
+DEFAULT_RUN_INTERVAL_MINUTES = 2
+
+_lock = threading.Lock()
+_price_tables = {}
+
+
+class PriceTable(object):
+    """Hourly on-demand and spot prices (US$) per region and instance type
+
+    The JSON file looks like
+    {"eu-west-1": {"m5.large": {"on_demand": 0.107, "spot": 0.035}}}.
+    """
+    def __init__(self, prices=None):
+        self.prices = prices or {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as price_file:
+            return cls(json.load(price_file))
+
+    def get(self, region_name, instance_type, kind):
+        return self.prices.get(region_name, {}).get(instance_type, {}).get(kind)
+
+
+def get_price_table():
+    """Return the price table named by SPOTNIK_PRICE_TABLE, or an empty one
+
+    The report is optional, so a missing or malformed file is logged and
+    replaced by an empty table instead of stopping the run.
+    """
+    path = os.environ.get('SPOTNIK_PRICE_TABLE')
+    if not path:
+        return PriceTable()
+    with _lock:
+        if path not in _price_tables:
+            try:
+                _price_tables[path] = PriceTable.load(path)
+            except (IOError, ValueError):
+                logging.getLogger('spotnik.report').exception("Could not load price table %s:", path)
+                return PriceTable()
+        return _price_tables[path]
+
+
+def get_run_interval_minutes():
+    return int(os.environ.get('SPOTNIK_RUN_INTERVAL_MINUTES', DEFAULT_RUN_INTERVAL_MINUTES))
+
+
+def _runs_until_window(minute, launch_minute, run_interval_minutes):
+    """Return after how many runs an instance is in its replacement window
+
+    minute is the minute of the hour of the first run. Returns None if the
+    runs never hit the window.
+    """
+    window_start, window_end = REPLACEMENT_WINDOW
+    for runs in range(60):
+        minutes_over_hour = (minute + runs * run_interval_minutes - launch_minute) % 60
+        if window_start < minutes_over_hour < window_end:
+            return runs
+    return None
+
+
+def estimate_minutes_to_convergence(on_demand_instances, min_on_demand, now, run_interval_minutes,
+                                    replaced_instance_id=None, pending=False):
+    """Estimate when spotnik has replaced all on-demand instances it may replace
+
+    Spotnik replaces one instance at a time: one run requests the spot
+    instance while the replaced instance is in its replacement window, a
+    later run attaches it. replaced_instance_id is the instance that was
+    replaced in this run or, if pending, will be replaced by the next run.
+    Assumes that each spot request is fulfilled before the next run.
+    Returns None if an instance is never replaced.
+    """
+    remaining = len(on_demand_instances) - min_on_demand
+    minutes = run_interval_minutes if pending else 0
+    launch_minutes = []
+    for instance in on_demand_instances:
+        if instance.instance_id == replaced_instance_id:
+            remaining -= 1
+        else:
+            launch_minutes.append(instance.launch_time.minute)
+    for _ in range(max(0, remaining)):
+        waits = [(_runs_until_window(now.minute + minutes, launch_minute, run_interval_minutes), index)
+                 for index, launch_minute in enumerate(launch_minutes)]
+        waits = [(runs, index) for runs, index in waits if runs is not None]
+        if not waits:
+            return None
+        runs, index = min(waits)
+        del launch_minutes[index]
+        minutes += (runs + 1) * run_interval_minutes
+    return minutes
+
+
+class ReportBuilder(object):
+    """Build the savings and convergence report of each ASG in a run
+
+    The report only uses data the run fetched anyway: the instance
+    snapshot of the region and the ASG's decision.
+    """
+    def __init__(self, prices=None, run_interval_minutes=DEFAULT_RUN_INTERVAL_MINUTES):
+        self.prices = prices or PriceTable()
+        self.run_interval_minutes = run_interval_minutes
+
+    def _get_hourly_saving(self, region_name, instance, bid_price):
+        on_demand_price = self.prices.get(region_name, instance.instance_type, 'on_demand')
+        # Spot instances never cost more than the bid price.
+        spot_price = self.prices.get(region_name, instance.instance_type, 'spot') or bid_price
+        if on_demand_price is None or spot_price is None:
+            return None
+        return on_demand_price - spot_price
+
+    def build(self, region_name, asg, instances, decision, now):
+        """Return the report of an ASG
+
+        Instance counts are those at the start of the run, pending_requests
+        counts the spot requests that are still open after the run.
+        """
+        asg_instances = [instances[instance_id] for instance_id in asg.instance_ids if instance_id in instances]
+        spot_instances = [instance for instance in asg_instances if instance.is_spot]
+        on_demand_instances = [instance for instance in asg_instances if not instance.is_spot]
+        min_on_demand = int(asg.tags.get('spotnik-min-on-demand-instances', 0))
+        pending = decision.get('action') in ('pending', 'requested')
+        try:
+            bid_price = float(asg.tags['spotnik-bid-price'])
+        except (KeyError, ValueError):
+            bid_price = None
+
+        savings = [self._get_hourly_saving(region_name, instance, bid_price) for instance in spot_instances]
+        hourly_saving = None if None in savings else round(sum(savings), 4)
+
+        convertible = max(0, len(on_demand_instances) - min_on_demand)
+        savings = [self._get_hourly_saving(region_name, instance, bid_price) for instance in on_demand_instances]
+        if None in savings:
+            remaining_hourly_saving = None
+        else:
+            remaining_hourly_saving = round(sum(sorted(savings, reverse=True)[:convertible]), 4)
+
+        return {
+            'on_demand': len(on_demand_instances),
+            'spot': len(spot_instances),
+            'min_on_demand': min_on_demand,
+            'pending_requests': 1 if pending else 0,
+            'hourly_saving': hourly_saving,
+            'remaining_hourly_saving': remaining_hourly_saving,
+            'minutes_to_convergence': estimate_minutes_to_convergence(
+                on_demand_instances, min_on_demand, now, self.run_interval_minutes,
+                replaced_instance_id=decision.get('replaced_instance_id'), pending=pending),
+        }
+
+
+def summarize(decisions):
+    """Add up the reports in the decisions of one account"""
+    reports = [decision['report'] for decision in decisions if decision.get('report')]
+    summary = {'asgs': len(reports)}
+    for key in ('on_demand', 'spot', 'pending_requests'):
+        summary[key] = sum(report[key] for report in reports)
+    for key in ('hourly_saving', 'remaining_hourly_saving'):
+        # ASGs without prices are not included.
+        summary[key] = round(sum(report[key] for report in reports if report[key] is not None), 4)
+    minutes = [report['minutes_to_convergence'] for report in reports]
+    summary['unconverging_asgs'] = minutes.count(None)
+    minutes = [value for value in minutes if value is not None]
+    summary['max_minutes_to_convergence'] = max(minutes) if minutes else 0
+    return summary
+
+
+def merge_summaries(summaries):
+    """Add up summaries made by summarize(), e.g. those of several shards"""
+    merged = summarize([])
+    for summary in summaries:
+        for key in ('asgs', 'on_demand', 'spot', 'pending_requests', 'unconverging_asgs'):
+            merged[key] += summary[key]
+        for key in ('hourly_saving', 'remaining_hourly_saving'):
+            merged[key] = round(merged[key] + summary[key], 4)
+        merged['max_minutes_to_convergence'] = max(merged['max_minutes_to_convergence'],
+                                                   summary['max_minutes_to_convergence'])
+    return merged
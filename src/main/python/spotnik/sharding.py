@@ -0,0 +1,174 @@
+from __future__ import print_function, absolute_import, division
+
+import json
+import os
+import time
+import zlib
+
+from .aws import DEFAULT_REGION, get_session
+from .pool import WorkerPool
+from .report import merge_summaries
+
+SHARD_BY_REGION = 'region'
+SHARD_BY_ASG_HASH = 'asg_hash'
+SHARD_STRATEGIES = (SHARD_BY_REGION, SHARD_BY_ASG_HASH)
+
+# Lambda functions run for at most 15 minutes, so the coordinator must
+# wait at least that long for a worker invocation to return.
+LAMBDA_READ_TIMEOUT = 900
+# The coordinator runs under the same limit as its workers, but started
+# earlier. It stops waiting for them this long before its own timeout to
+# merge and report the results.
+COORDINATOR_MARGIN_SECONDS = 10
+# Workers start no new ASGs this long before the coordinator stops waiting.
+WORKER_MARGIN_SECONDS = 30
+
+
+def new_account_result():
+    return {'regions': [], 'decisions': [], 'errors': []}
+
+
+def get_asg_shard_index(asg_name, shard_count):
+    """Return the shard an ASG belongs to
+
+    Unlike hash(), crc32 is stable across processes, so the coordinator
+    and all workers agree on the assignment.
+    """
+    return (zlib.crc32(asg_name.encode('utf-8')) & 0xffffffff) % shard_count
+
+
+def is_in_asg_shard(asg_name, asg_shard):
+    if asg_shard is None:
+        return True
+    shard_index, shard_count = asg_shard
+    return get_asg_shard_index(asg_name, shard_count) == shard_index
+
+
+def plan_shards(targets, strategy, region_names, shard_count=None, deadline=None):
+    """Split a run into worker events
+
+    With SHARD_BY_REGION, the regions are distributed round-robin over
+    shard_count shards (default: one shard per region). With
+    SHARD_BY_ASG_HASH, every shard handles all regions, but only the ASGs
+    whose name hashes to it. deadline is the time (as returned by
+    time.time()) at which the coordinator stops waiting for the workers.
+    """
+    if strategy not in SHARD_STRATEGIES:
+        raise ValueError("Unknown shard strategy %r, expected one of %r" % (strategy, SHARD_STRATEGIES))
+    role_arns = [target.role_arn for target in targets if target.role_arn]
+
+    if strategy == SHARD_BY_REGION:
+        shard_count = min(shard_count or len(region_names), len(region_names))
+        events = [{'worker': True, 'role_arns': role_arns, 'regions': region_names[index::shard_count]}
+                  for index in range(shard_count)]
+    elif not shard_count:
+        raise ValueError("Sharding by ASG hash needs a shard count")
+    else:
+        events = [{'worker': True, 'role_arns': role_arns, 'asg_shard': [index, shard_count]}
+                  for index in range(shard_count)]
+    if deadline is not None:
+        for event in events:
+            event['deadline'] = deadline - WORKER_MARGIN_SECONDS
+    return events
+
+
+def compact_results(results):
+    """Drop the decisions from the per-account results of a shard
+
+    A synchronous Lambda invocation returns at most 6 MB, which one
+    decision per ASG can exceed. The workers log their decisions, so the
+    coordinator only needs the errors and the summary.
+    """
+    return dict((account_id, {'regions': result['regions'], 'errors': result['errors'],
+                              'summary': result['summary']})
+                for account_id, result in results.items())
+
+
+def merge_results(targets, shard_results):
+    """Combine the per-account results of all shards, see compact_results()
+
+    A shard that failed as a whole (i.e. its entry is an exception) is
+    recorded as an error of every account.
+    """
+    merged = dict((target.account_id, new_account_result()) for target in targets)
+    summaries = dict((account_id, []) for account_id in merged)
+    for shard_index, shard_result in enumerate(shard_results):
+        if isinstance(shard_result, Exception):
+            for result in merged.values():
+                result['errors'].append("shard %d: %s" % (shard_index, shard_result))
+            continue
+        for account_id, result in shard_result.items():
+            account_result = merged.setdefault(account_id, new_account_result())
+            for key in ('regions', 'errors'):
+                account_result[key].extend(result[key])
+            summaries.setdefault(account_id, []).append(result['summary'])
+    for account_id, result in merged.items():
+        result['summary'] = merge_summaries(summaries[account_id])
+    return merged
+
+
+def _run_worker_event(event):
+    # Imported here because spotnik.main imports this module.
+    from . import aws
+    from .main import run_worker
+
+    # Connections inherited from the parent process must not be reused.
+    aws.reset()
+    return run_worker(event)
+
+
+class LocalDispatcher(object):
+    """Run each shard in a local process; meant for tests and development"""
+    def __init__(self, processes=None):
+        self.processes = processes
+
+    def dispatch(self, events):
+        import multiprocessing
+
+        pool = multiprocessing.Pool(self.processes or len(events) or 1)
+        try:
+            tasks = [pool.apply_async(_run_worker_event, (event,)) for event in events]
+            return [_get_result(task) for task in tasks]
+        finally:
+            pool.close()
+            pool.join()
+
+
+class LambdaDispatcher(object):
+    """Run each shard in a synchronous invocation of a Lambda function
+
+    By default, the function invokes itself. Its role then needs the
+    lambda:InvokeFunction permission on itself.
+    """
+    def __init__(self, function_name=None, region_name=None, deadline=None):
+        self.function_name = function_name or os.environ['AWS_LAMBDA_FUNCTION_NAME']
+        self.region_name = region_name or os.environ.get('AWS_REGION', DEFAULT_REGION)
+        # Invocations still running at this time fail, see plan_shards().
+        self.deadline = deadline
+
+    def dispatch(self, events):
+        from botocore.config import Config
+
+        read_timeout = LAMBDA_READ_TIMEOUT
+        if self.deadline is not None:
+            read_timeout = max(1, min(read_timeout, self.deadline - time.time()))
+        config = Config(read_timeout=read_timeout, retries={'max_attempts': 0})
+        client = get_session().client('lambda', region_name=self.region_name, config=config)
+        with WorkerPool(len(events) or 1) as pool:
+            tasks = [pool.submit(self._invoke, client, event) for event in events]
+            return [_get_result(task) for task in tasks]
+
+    def _invoke(self, client, event):
+        response = client.invoke(FunctionName=self.function_name, InvocationType='RequestResponse',
+                                 Payload=json.dumps(event).encode('utf-8'))
+        payload = json.loads(response['Payload'].read().decode('utf-8'))
+        if response.get('FunctionError'):
+            raise Exception("%s: %s" % (payload.get('errorType'), payload.get('errorMessage')))
+        return payload
+
+
+def _get_result(task):
+    try:
+        return task.get()
+    except Exception as exc:
+        return exc
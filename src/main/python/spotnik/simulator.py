@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""Replay recorded fleet history to tune spotnik's settings offline
+
+The simulator feeds recorded spot prices and ASG desired capacities
+through the same rules that ReplacementPolicy and Spotnik apply, on a
+simulated clock that advances one spotnik run per step. All ASGs and all
+settings are simulated at once as rows of NumPy arrays, so the Python
+loop only runs once per step.
+
+Run it with
+
+    python -m spotnik.simulator trace.npz --bid-price 0.05 0.1 --min-on-demand 0 1 --window 45-55
+
+to get a JSON report for every combination of the given settings.
+"""
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import itertools
+import json
+
+import numpy as np
+
+from .replacement_policy import REPLACEMENT_WINDOW
+
+
+class FleetTrace(object):
+    """Recorded history of a fleet
+
+    spot_prices and desired_capacity have one row per ASG and one column
+    per spotnik run, i.e. per step_minutes. spot_prices holds the price of
+    the spot pool that the ASG's spot requests would use. on_demand_prices
+    has one entry per ASG.
+    """
+    def __init__(self, spot_prices, on_demand_prices, desired_capacity, step_minutes=2,
+                 asg_names=None):
+        self.spot_prices = np.asarray(spot_prices, dtype=float)
+        self.on_demand_prices = np.asarray(on_demand_prices, dtype=float)
+        self.desired_capacity = np.asarray(desired_capacity, dtype=int)
+        self.step_minutes = step_minutes
+
+        if self.spot_prices.ndim != 2 or self.spot_prices.shape != self.desired_capacity.shape:
+            raise ValueError("spot_prices and desired_capacity must have the same (ASG, step) shape")
+        if self.on_demand_prices.shape != (self.spot_prices.shape[0],):
+            raise ValueError("on_demand_prices must have one entry per ASG")
+
+        if asg_names is None:
+            asg_names = ["asg-%d" % index for index in range(self.spot_prices.shape[0])]
+        self.asg_names = [str(name) for name in asg_names]
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        asg_names = data['asg_names'] if 'asg_names' in data.files else None
+        return cls(data['spot_prices'], data['on_demand_prices'], data['desired_capacity'],
+                   step_minutes=int(data['step_minutes']), asg_names=asg_names)
+
+    def save(self, path):
+        np.savez_compressed(path, spot_prices=self.spot_prices, on_demand_prices=self.on_demand_prices,
+                            desired_capacity=self.desired_capacity, step_minutes=self.step_minutes,
+                            asg_names=np.array(self.asg_names))
+
+
+class Settings(object):
+    """The tunable settings of one simulated configuration
+
+    bid_price and min_on_demand correspond to the ASG tags
+    spotnik-bid-price and spotnik-min-on-demand-instances, window to
+    REPLACEMENT_WINDOW.
+    """
+    __slots__ = ('bid_price', 'min_on_demand', 'window')
+
+    def __init__(self, bid_price, min_on_demand=0, window=REPLACEMENT_WINDOW):
+        self.bid_price = float(bid_price)
+        self.min_on_demand = int(min_on_demand)
+        self.window = tuple(window)
+
+    def __repr__(self):
+        return "Settings(bid_price=%r, min_on_demand=%r, window=%r)" % (
+            self.bid_price, self.min_on_demand, self.window)
+
+
+def simulate(trace, settings, seed=0):
+    """Replay the trace for each of the given settings
+
+    Returns one report dict per settings object, in the same order.
+    """
+    settings = list(settings)
+    num_asgs, num_steps = trace.spot_prices.shape
+    num_rows = num_asgs * len(settings)
+    # Row r simulates ASG asg_index[r] with settings setting_index[r].
+    asg_index = np.tile(np.arange(num_asgs), len(settings))
+    setting_index = np.repeat(np.arange(len(settings)), num_asgs)
+
+    bid = np.array([s.bid_price for s in settings])[setting_index]
+    min_on_demand = np.array([s.min_on_demand for s in settings])[setting_index]
+    window_start = np.array([s.window[0] for s in settings])[setting_index][:, None]
+    window_end = np.array([s.window[1] for s in settings])[setting_index][:, None]
+    on_demand_price = trace.on_demand_prices[asg_index]
+    step_hours = trace.step_minutes / 60
+    capacity = max(1, int(trace.desired_capacity.max()))
+
+    # Each slot holds an instance (occupied) with its launch minute.
+    # Before the replay, the fleet is entirely on-demand, with launch times
+    # spread over the billing hour. All settings start from the same fleet.
+    occupied = np.arange(capacity)[None, :] < trace.desired_capacity[asg_index, 0][:, None]
+    is_spot = np.zeros((num_rows, capacity), dtype=bool)
+    initial_offsets = np.random.RandomState(seed).randint(0, 60, size=(num_asgs, capacity))
+    launch = -initial_offsets[asg_index]
+
+    # A pending spot request and the instance (slot + launch time) it replaces.
+    pending = np.zeros(num_rows, dtype=bool)
+    target_slot = np.zeros(num_rows, dtype=int)
+    target_launch = np.zeros(num_rows, dtype=int)
+
+    # Step-major copies make the per-step rows contiguous.
+    spot_prices = np.ascontiguousarray(trace.spot_prices.T)
+    desired_capacity = np.ascontiguousarray(trace.desired_capacity.T)
+
+    cost = np.zeros(num_rows)
+    on_demand_cost = np.zeros(num_rows)
+    interruptions = np.zeros(num_rows, dtype=int)
+    spot_minutes = np.zeros(num_rows)
+    converged_at = np.full(num_rows, np.nan)
+
+    for step in range(num_steps):
+        now = step * trace.step_minutes
+        price = spot_prices[step][asg_index]
+        desired = desired_capacity[step][asg_index]
+
+        # Spot instances are reclaimed as soon as the price exceeds the bid.
+        outbid = price > bid
+        if outbid.any():
+            rows = np.nonzero(outbid)[0]
+            reclaimed = is_spot[rows]
+            interruptions[rows] += reclaimed.sum(axis=1)
+            occupied[rows] &= ~reclaimed
+            is_spot[rows] = False
+
+        _scale_to_desired(occupied, is_spot, launch, desired, now)
+
+        # Spotnik attaches fulfilled spot instances. If the instance it was
+        # meant to replace is gone, the spot instance is terminated instead.
+        fulfilled = pending & ~outbid
+        if fulfilled.any():
+            rows = np.nonzero(fulfilled)[0]
+            slots = target_slot[rows]
+            swapped = (occupied[rows, slots] & ~is_spot[rows, slots]
+                       & (launch[rows, slots] == target_launch[rows]))
+            launch[rows[swapped], slots[swapped]] = now
+            is_spot[rows[swapped], slots[swapped]] = True
+            pending[rows] = False
+
+        on_demand = occupied & ~is_spot
+        num_on_demand = on_demand.sum(axis=1)
+
+        # Otherwise, it requests a spot instance if an on-demand instance
+        # may be replaced right now (see ReplacementPolicy).
+        candidates = ~pending & ~fulfilled & (num_on_demand > min_on_demand)
+        if candidates.any():
+            rows = np.nonzero(candidates)[0]
+            minutes_over_hour = (now - launch[rows]) % 60
+            in_window = (on_demand[rows] & (minutes_over_hour > window_start[rows])
+                         & (minutes_over_hour < window_end[rows]))
+            rows = rows[in_window.any(axis=1)]
+            # Like decide_replacement(), replace the first on-demand instance.
+            slots = np.argmax(on_demand[rows], axis=1)
+            pending[rows] = True
+            target_slot[rows] = slots
+            target_launch[rows] = launch[rows, slots]
+
+        num_spot = is_spot.sum(axis=1)
+        cost += (num_on_demand * on_demand_price + num_spot * price) * step_hours
+        on_demand_cost += (num_on_demand + num_spot) * on_demand_price * step_hours
+        spot_minutes += num_spot * trace.step_minutes
+        newly_converged = np.isnan(converged_at) & (num_on_demand <= min_on_demand)
+        converged_at[newly_converged] = now
+
+    reports = []
+    for index, setting in enumerate(settings):
+        rows = slice(index * num_asgs, (index + 1) * num_asgs)
+        reports.append(_build_report(setting, cost[rows], on_demand_cost[rows], interruptions[rows],
+                                     spot_minutes[rows], converged_at[rows]))
+    return reports
+
+
+def _scale_to_desired(occupied, is_spot, launch, desired, now):
+    """Launch on-demand instances or terminate instances like the ASG does"""
+    missing = desired - occupied.sum(axis=1)
+
+    rows = np.nonzero(missing > 0)[0]
+    if rows.size:
+        empty = ~occupied[rows]
+        fill = empty & (np.cumsum(empty, axis=1) <= missing[rows][:, None])
+        grown = launch[rows]
+        grown[fill] = now
+        launch[rows] = grown
+        occupied[rows] |= fill
+
+    rows = np.nonzero(missing < 0)[0]
+    if rows.size:
+        # Approximates the default termination policy: instances closest
+        # to the next billing hour are terminated first.
+        score = np.where(occupied[rows], (now - launch[rows]) % 60, -1)
+        rank = np.argsort(np.argsort(-score, axis=1, kind='mergesort'), axis=1)
+        terminate = rank < -missing[rows][:, None]
+        occupied[rows] &= ~terminate
+        is_spot[rows] &= ~terminate
+
+
+def _build_report(setting, cost, on_demand_cost, interruptions, spot_minutes, converged_at):
+    converged = converged_at[~np.isnan(converged_at)]
+    total_cost = float(cost.sum())
+    total_on_demand_cost = float(on_demand_cost.sum())
+    spot_hours = float(spot_minutes.sum()) / 60
+    return {
+        'bid_price': setting.bid_price,
+        'min_on_demand': setting.min_on_demand,
+        'window': list(setting.window),
+        'cost': total_cost,
+        'on_demand_cost': total_on_demand_cost,
+        'savings': total_on_demand_cost - total_cost,
+        'savings_ratio': (total_on_demand_cost - total_cost) / total_on_demand_cost if total_on_demand_cost else 0.0,
+        'converged_ratio': converged.size / converged_at.size if converged_at.size else 0.0,
+        'median_convergence_minutes': float(np.median(converged)) if converged.size else None,
+        'max_convergence_minutes': float(converged.max()) if converged.size else None,
+        'interruptions': int(interruptions.sum()),
+        'interruptions_per_spot_hour': int(interruptions.sum()) / spot_hours if spot_hours else 0.0,
+    }
+
+
+def _parse_window(value):
+    start, end = value.split('-')
+    return int(start), int(end)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a recorded fleet trace with different settings")
+    parser.add_argument('trace', help="trace file written by FleetTrace.save()")
+    parser.add_argument('--bid-price', type=float, nargs='+', required=True)
+    parser.add_argument('--min-on-demand', type=int, nargs='+', default=[0])
+    parser.add_argument('--window', type=_parse_window, nargs='+', default=[REPLACEMENT_WINDOW],
+                        help="replacement window in minutes past the hour, e.g. 45-55")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    settings = [Settings(bid_price, min_on_demand, window) for bid_price, min_on_demand, window
+                in itertools.product(args.bid_price, args.min_on_demand, args.window)]
+    for report in simulate(FleetTrace.load(args.trace), settings, seed=args.seed):
+        print(json.dumps(report, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""Record the AWS responses of a run and replay them without network
+
+A snapshot is a zip file with one gzip compressed stream per account and
+region (e.g. "local/eu-west-1.jsonl.gz"). Each line holds the operation,
+its parameters, the HTTP status code and the parsed response of one call.
+
+Capture a real run, then replay it as often as needed, e.g. with
+profiling:
+
+    python -m spotnik.snapshot capture fleet.zip
+    python -m spotnik.snapshot replay fleet.zip --cprofile replay.prof --tracemalloc 20
+
+On replay, calls are matched by operation and parameters. Calls with the
+same parameters get their responses in the recorded order. The snapshot
+also holds the time and random seed of the captured run (see
+util.pin()), so a replay takes the same decisions. Mutating calls
+(anything but Describe*, List* and Get*) that were not recorded, e.g.
+tag batches that were split differently, are answered with a recorded
+response of the same operation or a synthesized no-op.
+"""
+from __future__ import print_function, absolute_import, division
+
+import argparse
+import contextlib
+import gzip
+import io
+import json
+import logging
+import random
+import threading
+import zipfile
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from dateutil.tz import tzutc
+
+from . import aws, util
+
+_CONTEXT_KEY = 'spotnik_snapshot_key'
+# Zip entry with the capture time and random seed.
+_METADATA_NAME = 'snapshot.json'
+_READ_ONLY_PREFIXES = ('Describe', 'List', 'Get')
+# Responses to unrecorded mutating calls, if the operation was not
+# recorded at all. Operations missing here get an empty response.
+_NOOP_RESPONSES = {
+    'RequestSpotInstances': {'SpotInstanceRequests': [{'SpotInstanceRequestId': 'sir-replayed', 'State': 'open'}]},
+}
+# Snapshots leave the box, so credentials (e.g. of sts AssumeRole) are
+# never written. Replayed calls are not signed, so dummy values suffice.
+_DUMMY_CREDENTIALS = {'AccessKeyId': 'SNAPSHOT', 'SecretAccessKey': 'SNAPSHOT', 'SessionToken': 'SNAPSHOT'}
+
+
+class SnapshotMissError(Exception):
+    """The replayed code made a call that is not in the snapshot"""
+
+
+class _ReplayedHttpResponse(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.headers = {}
+        self.content = b''
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        from dateutil.parser import parse
+        return parse(obj['__datetime__'])
+    return obj
+
+
+def _call_key(operation_name, params):
+    return json.dumps([operation_name, params], sort_keys=True, default=_encode)
+
+
+def _stream_name(role_arn, region_name):
+    account_id = role_arn.split(':')[4] if role_arn else 'local'
+    return "%s/%s.jsonl.gz" % (account_id, region_name)
+
+
+def _redact_credentials(response, expiration):
+    if 'Credentials' in response:
+        response = dict(response)
+        response['Credentials'] = dict(_DUMMY_CREDENTIALS, Expiration=expiration)
+    return response
+
+
+def _is_mutating(operation_name):
+    return not operation_name.startswith(_READ_ONLY_PREFIXES)
+
+
+def _remember_params(params, model, context, **_):
+    context[_CONTEXT_KEY] = _call_key(model.name, params)
+
+
+class SnapshotRecorder(object):
+    """Write the responses of all attached clients to a snapshot file"""
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._streams = {}
+        self.logger = logging.getLogger('spotnik.snapshot')
+        self.captured_at = datetime.utcnow().replace(microsecond=0)
+        self.seed = random.randrange(2 ** 32)
+
+    def attach(self, client, role_arn, region_name):
+        stream_name = _stream_name(role_arn, region_name)
+
+        def record(http_response, parsed, model, context, **_):
+            self._record(stream_name, context.get(_CONTEXT_KEY), http_response.status_code,
+                         model.name, parsed)
+
+        client.meta.events.register('before-parameter-build', _remember_params)
+        client.meta.events.register('after-call', record)
+
+    def _record(self, stream_name, key, status_code, operation_name, parsed):
+        response = dict((name, value) for name, value in parsed.items() if name != 'ResponseMetadata')
+        response = _redact_credentials(response, datetime(1970, 1, 1, tzinfo=tzutc()))
+        try:
+            line = json.dumps({'key': key, 'operation': operation_name, 'status_code': status_code,
+                               'response': response}, sort_keys=True, default=_encode)
+        except TypeError:
+            self.logger.warning("Not recording %s, its response is not serializable", operation_name)
+            return
+        with self._lock:
+            stream = self._streams.get(stream_name)
+            if stream is None:
+                buffer = io.BytesIO()
+                stream = self._streams[stream_name] = (buffer, gzip.GzipFile(fileobj=buffer, mode='wb'))
+            stream[1].write(line.encode('utf-8') + b'\n')
+
+    def close(self):
+        with self._lock:
+            with zipfile.ZipFile(self.path, 'w', zipfile.ZIP_STORED) as snapshot:
+                snapshot.writestr(_METADATA_NAME, json.dumps(
+                    {'captured_at': self.captured_at, 'seed': self.seed}, sort_keys=True, default=_encode))
+                for stream_name, (buffer, gzip_file) in sorted(self._streams.items()):
+                    gzip_file.close()
+                    snapshot.writestr(stream_name, buffer.getvalue())
+            self._streams = {}
+
+
+class SnapshotReplayer(object):
+    """Answer the calls of all attached clients from a snapshot file"""
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._responses = {}
+        # stream name -> operation name -> last successful (status code, response)
+        self._operations = {}
+        self.captured_at = self.seed = None
+        self.logger = logging.getLogger('spotnik.snapshot')
+        with zipfile.ZipFile(path) as snapshot:
+            for stream_name in snapshot.namelist():
+                if stream_name == _METADATA_NAME:
+                    metadata = json.loads(snapshot.read(stream_name).decode('utf-8'), object_hook=_decode)
+                    # Stored as naive UTC, like util.utcnow() returns it.
+                    self.captured_at = metadata['captured_at'].replace(tzinfo=None)
+                    self.seed = metadata['seed']
+                    continue
+                responses = defaultdict(list)
+                operations = {}
+                data = gzip.GzipFile(fileobj=io.BytesIO(snapshot.read(stream_name))).read()
+                for line in data.decode('utf-8').splitlines():
+                    entry = json.loads(line, object_hook=_decode)
+                    responses[entry['key']].append((entry['status_code'], entry['response']))
+                    if entry['status_code'] < 300:
+                        operations[entry.get('operation')] = (entry['status_code'], entry['response'])
+                self._responses[stream_name] = responses
+                self._operations[stream_name] = operations
+
+    def attach(self, client, role_arn, region_name):
+        stream_name = _stream_name(role_arn, region_name)
+
+        def replay(model, context, **_):
+            return self._replay(stream_name, context[_CONTEXT_KEY], model.name)
+
+        client.meta.events.register('before-parameter-build', _remember_params)
+        client.meta.events.register('before-call', replay)
+
+    def _replay(self, stream_name, key, operation_name):
+        with self._lock:
+            recorded = self._responses.get(stream_name, {}).get(key)
+            if recorded:
+                # The last response is reused once all others were consumed.
+                status_code, response = recorded.pop(0) if len(recorded) > 1 else recorded[0]
+            elif _is_mutating(operation_name):
+                self.logger.debug("Answering unrecorded %s in %s with a no-op", operation_name, stream_name)
+                status_code, response = self._operations.get(stream_name, {}).get(
+                    operation_name, (200, _NOOP_RESPONSES.get(operation_name, {})))
+            else:
+                raise SnapshotMissError("No recorded response for %s in %s: %s" % (
+                    operation_name, stream_name, key))
+        # Valid for long enough that botocore never refreshes them.
+        response = _redact_credentials(response, datetime.now(tzutc()) + timedelta(days=1))
+        return _ReplayedHttpResponse(status_code), dict(response)
+
+
+@contextlib.contextmanager
+def capture(path):
+    """Record all AWS calls made within the block to path"""
+    recorder = SnapshotRecorder(path)
+    aws.set_recorder(recorder)
+    # The captured run uses the time and seed a replay will use.
+    util.pin(recorder.captured_at, recorder.seed)
+    try:
+        yield recorder
+    finally:
+        util.pin()
+        aws.set_recorder(None)
+        recorder.close()
+
+
+@contextlib.contextmanager
+def replay(path):
+    """Answer all AWS calls made within the block from the snapshot at path"""
+    replayer = SnapshotReplayer(path)
+    aws.set_recorder(replayer)
+    util.pin(replayer.captured_at, replayer.seed)
+    try:
+        yield replayer
+    finally:
+        util.pin()
+        aws.set_recorder(None)
+
+
+def profile(function, cprofile_path=None, tracemalloc_top=0):
+    """Call function, optionally under cProfile and/or tracemalloc
+
+    The cProfile stats are written to cprofile_path, the top allocation
+    sites and the peak memory usage are printed.
+    """
+    profiler = None
+    if cprofile_path:
+        import cProfile
+        profiler = cProfile.Profile()
+    if tracemalloc_top:
+        import tracemalloc
+        tracemalloc.start()
+
+    try:
+        if profiler is not None:
+            return profiler.runcall(function)
+        return function()
+    finally:
+        if profiler is not None:
+            profiler.dump_stats(cprofile_path)
+        if tracemalloc_top:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("Peak traced memory: %.1f KiB" % (peak / 1024))
+            for statistic in snapshot.statistics('lineno')[:tracemalloc_top]:
+                print(statistic)
+
+
+def main(argv=None):
+    from .logs import configure_logging
+    from .main import get_targets, main as run_main
+
+    parser = argparse.ArgumentParser(description="Capture or replay the AWS calls of a spotnik run")
+    parser.add_argument('mode', choices=('capture', 'replay'))
+    parser.add_argument('path', help="snapshot file")
+    parser.add_argument('--role-arn', dest='role_arns', action='append',
+                        help="IAM role of an account to handle, may be given several times")
+    parser.add_argument('--cprofile', metavar='PATH', help="write cProfile stats to PATH")
+    parser.add_argument('--tracemalloc', type=int, default=0, metavar='N',
+                        help="print the N top allocation sites")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig()
+    configure_logging()
+    if args.mode == 'capture':
+        paths = {'capture_path': args.path}
+    else:
+        paths = {'replay_path': args.path}
+    profile(lambda: run_main(targets=get_targets(args.role_arns), **paths),
+            cprofile_path=args.cprofile, tracemalloc_top=args.tracemalloc)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,83 +1,174 @@
 from __future__ import print_function, absolute_import, division
 
-from pils import retry
-import boto3
-
-from .util import _boto_tags_to_dict
+from .aws import get_client
+from .interruptions import (RISKY_POOLS_TAG_KEY, format_reported_pools, get_interruption_tracker, get_pool,
+                            get_reported_pools)
+from .launch_specs import get_launch_spec_builder
+from .logs import PayloadLogger, get_sample_rate
+from .records import AutoScalingGroup, Instance, SpotRequest
+from .util import _dict_to_boto_tags
 from .replacement_policy import ReplacementPolicy
+from .tagging import get_tag_queue
 
 # Any ASG that has a tag with this key will be handled by spotnik.
 SPOTNIK_TAG_KEY = "spotnik"
+# Spot requests that move an instance off a risky spot pool carry this tag.
+REBALANCE_TAG_KEY = "spotnik-rebalance"
+# EC2 accepts at most this many values per filter.
+MAX_FILTER_VALUES = 200
 
 
 class Spotnik(object):
-    def __init__(self, region_name, asg, logger=None):
+    def __init__(self, region_name, asg, logger=None, decision=None, role_arn=None, instances=None):
         self.asg = asg
-        self.asg_name = asg['AutoScalingGroupName']
+        self.asg_name = asg.name
 
-        self.ec2_client = boto3.client('ec2', region_name=region_name)
-        self.asg_client = boto3.client('autoscaling', region_name=region_name)
+        self.ec2_client = get_client('ec2', region_name, role_arn=role_arn)
+        self.asg_client = get_client('autoscaling', region_name, role_arn=role_arn)
+        # Tag changes are sent in the background, batched with other ASGs.
+        self.tag_queue = get_tag_queue(region_name, role_arn=role_arn)
+        # Caches launch sources and specifications across ASGs and runs.
+        self.launch_spec_builder = get_launch_spec_builder(region_name, role_arn=role_arn)
+        self.interruption_tracker = get_interruption_tracker(region_name, role_arn=role_arn)
 
         self.logger = logger
+        self.payload_logger = PayloadLogger(logger, get_sample_rate(asg.tags), name=asg.name)
+        # Compact summary of what was done with the ASG in this run.
+        self.decision = decision if decision is not None else {}
+        # Snapshot of the region's ASG instances, see get_instance_snapshot().
+        self.instances = instances or {}
 
     def describe_instance(self, instance_id):
+        instance = self.instances.get(instance_id)
+        if instance is not None:
+            return instance
         response = self.ec2_client.describe_instances(InstanceIds=[instance_id])
-        return response['Reservations'][0]['Instances'][0]
-
-    def describe_launch_configuration(self, launch_config_name):
-        response = self.asg_client.describe_launch_configurations(
-                LaunchConfigurationNames=[launch_config_name])
-        return response['LaunchConfigurations'][0]
+        return Instance.from_boto(response['Reservations'][0]['Instances'][0])
 
     def get_pending_spot_resources(self):
-        self.logger.info("Searching pending resources of ASG")
+        self.logger.debug("Searching pending resources of ASG")
         response = self.ec2_client.describe_spot_instance_requests(Filters=[
                 {'Name': 'tag-value', 'Values': [self.asg_name]}])
-        requests = response['SpotInstanceRequests']
+        requests = [SpotRequest.from_boto(request) for request in response['SpotInstanceRequests']]
 
         for request in requests:
-            if request['State'] not in ('open', 'active'):
+            if request.state not in ('open', 'active'):
                 continue
 
-            instance_id = request.get('InstanceId')
+            instance_id = request.instance_id
             if instance_id is None:
                 return request, None
 
-            details = self.describe_instance(instance_id)
-            state = details['State']['Name']
-            self.logger.info("Found spot instance %s which is in state %s.", instance_id, state)
+            state = self.describe_instance(instance_id).state
+            self.logger.debug("Found spot instance %s which is in state %s.", instance_id, state)
             if state == 'running':
                 return request, instance_id
             return request, None
         return None, None
 
     def tag_new_instance(self, new_instance_id, old_instance):
-        self.ec2_client.create_tags(Resources=[new_instance_id],
-                                    Tags=[old_instance['Tags']])
+        self.tag_queue.create_tags([new_instance_id], _dict_to_boto_tags(old_instance.tags))
 
     @staticmethod
-    def get_spotnik_asgs(region_name):
-        client = boto3.client('autoscaling', region_name=region_name)
-        asgs = client.describe_auto_scaling_groups()['AutoScalingGroups']
+    def get_spotnik_asgs(region_name, role_arn=None):
+        client = get_client('autoscaling', region_name, role_arn=role_arn)
         spotnik_asgs = []
-        for asg in asgs:
-            tags = asg['Tags']
-            tag_keys = [tag['Key'] for tag in tags]
-            if SPOTNIK_TAG_KEY in tag_keys:
-                spotnik_asgs.append(asg)
+        for page in client.get_paginator('describe_auto_scaling_groups').paginate():
+            for asg in page['AutoScalingGroups']:
+                tags = asg['Tags']
+                tag_keys = [tag['Key'] for tag in tags]
+                if SPOTNIK_TAG_KEY in tag_keys:
+                    spotnik_asgs.append(AutoScalingGroup.from_boto(asg))
         return spotnik_asgs
 
+    @staticmethod
+    def record_reported_pools(region_name, asgs, role_arn=None):
+        """Mark the pools in the asgs' tags as risky for all ASGs of the region
+
+        The interruption events may have been handled in another Lambda
+        container, see tag_risky_pool().
+        """
+        tracker = get_interruption_tracker(region_name, role_arn=role_arn)
+        for asg in asgs:
+            for pool, reported_at in get_reported_pools(asg.tags).items():
+                tracker.record(pool, reported_at)
+
+    @staticmethod
+    def get_instance_snapshot(region_name, asgs, role_arn=None):
+        """Describe the instances of all given ASGs with as few calls as possible
+
+        Returns a dict that maps instance IDs to Instance records.
+        """
+        client = get_client('ec2', region_name, role_arn=role_arn)
+        instance_ids = sorted(set(instance_id for asg in asgs for instance_id in asg.instance_ids))
+        instances = {}
+        for start in range(0, len(instance_ids), MAX_FILTER_VALUES):
+            # Unlike InstanceIds, the filter does not fail for instances
+            # that were terminated in the meantime.
+            kwargs = {'Filters': [{'Name': 'instance-id',
+                                   'Values': instance_ids[start:start + MAX_FILTER_VALUES]}]}
+            while True:
+                response = client.describe_instances(**kwargs)
+                for reservation in response['Reservations']:
+                    for description in reservation['Instances']:
+                        instance = Instance.from_boto(description)
+                        instances[instance.instance_id] = instance
+                if not response.get('NextToken'):
+                    break
+                kwargs['NextToken'] = response['NextToken']
+        return instances
+
+    @staticmethod
+    def get_spotnik_asg(region_name, asg_name, role_arn=None):
+        """Return the named ASG if spotnik handles it, otherwise None"""
+        client = get_client('autoscaling', region_name, role_arn=role_arn)
+        asgs = client.describe_auto_scaling_groups(AutoScalingGroupNames=[asg_name])['AutoScalingGroups']
+        for asg in asgs:
+            if SPOTNIK_TAG_KEY in [tag['Key'] for tag in asg['Tags']]:
+                return AutoScalingGroup.from_boto(asg)
+        return None
+
+    def is_instance_gone(self, instance_id):
+        """Return True if instance_id has left or is leaving the ASG
+
+        A reclaimed instance may still be listed for a while, but no longer
+        InService, or not running in the instance snapshot.
+        """
+        if instance_id not in self.asg.instance_ids:
+            return True
+        if self.asg.lifecycle_states.get(instance_id, 'InService') != 'InService':
+            return True
+        instance = self.instances.get(instance_id)
+        return instance is not None and instance.state not in (None, 'running')
+
     def attach_spot_instance(self, spot_instance_id, spot_request):
-        instance_id = _boto_tags_to_dict(spot_request['Tags'])['spotnik-will-replace']
+        """Swap spot_instance_id into the ASG, return False if there is nothing to swap it for"""
+        instance_id = spot_request.tags['spotnik-will-replace']
+        if REBALANCE_TAG_KEY in spot_request.tags and self.is_instance_gone(instance_id):
+            # The instance was reclaimed before its replacement was ready,
+            # and the ASG has probably refilled it with an on-demand instance.
+            policy = ReplacementPolicy(self.asg, self)
+            on_demand_instances = [instance for instance in policy.get_instances()[0]
+                                   if not self.is_instance_gone(instance.instance_id)]
+            if len(on_demand_instances) <= policy.min_on_demand:
+                # Attaching would only end in detaching and terminating
+                # it again. Later runs replace on-demand instances as usual.
+                self.logger.info("Instance %r is gone and no on-demand instance may be replaced, "
+                                 "terminating spot instance %r", instance_id, spot_instance_id)
+                self.ec2_client.terminate_instances(InstanceIds=[spot_instance_id])
+                self.decision['reason'] = 'min_on_demand_reached' if on_demand_instances else 'all_spot'
+                return False
+            instance_id = on_demand_instances[0].instance_id
 
-        self.logger.info("attaching: %r detaching: %r", spot_instance_id, instance_id)
+        self.logger.debug("attaching: %r detaching: %r", spot_instance_id, instance_id)
+        self.decision['replaced_instance_id'] = instance_id
 
         # If the ASG is already at its MaxSize, we cannot attach a new instance.
         # So either
         #   - temporarily increase the MaxSize with AUTOSCALING.update_auto_scaling_group()
         #   or
         #   - detach the old instance before attaching the new one
-        current_max_size = self.asg['MaxSize']
+        current_max_size = self.asg.max_size
         self.asg_client.update_auto_scaling_group(
                 AutoScalingGroupName=self.asg_name,
                 MaxSize=current_max_size + 1)
@@ -99,32 +190,67 @@ class Spotnik(object):
 
         self.asg_client.update_auto_scaling_group(
                 AutoScalingGroupName=self.asg_name, MaxSize=current_max_size)
+        return True
 
     def untag_spot_request(self, spot_request):
         # Remove tags so that self.get_pending_spot_resources() does not find
         # this spot request again.
-        self.ec2_client.delete_tags(Resources=[spot_request['SpotInstanceRequestId']],
-                                    Tags=[{'Key': SPOTNIK_TAG_KEY}])
+        self.tag_queue.delete_tags([spot_request.request_id], [{'Key': SPOTNIK_TAG_KEY}])
 
     def make_spot_request(self):
         policy = ReplacementPolicy(self.asg, self)
-        if not policy.is_replacement_needed():
+        if policy.is_replacement_needed():
+            self.request_spot_instance(*policy.decide_replacement())
             return
 
-        launch_specification, replaced_instance_details, bid_price = policy.decide_replacement()
+        # Nothing to replace, but maybe spot instances should be moved off
+        # a pool that is likely to be reclaimed soon.
+        replacement = policy.decide_rebalance()
+        if replacement is not None:
+            self.request_spot_instance(*replacement, rebalance='risky_pool')
+
+    def make_rebalance_request(self, instance, trigger):
+        """Prepare a replacement for a spot instance that is about to be lost"""
+        pool = get_pool(instance)
+        self.tag_risky_pool(pool, self.interruption_tracker.record(pool))
+        replacement = ReplacementPolicy(self.asg, self).decide_rebalance([instance])
+        if replacement is not None:
+            self.request_spot_instance(*replacement, rebalance=trigger)
+
+    def tag_risky_pool(self, pool, reported_at):
+        """Add pool to the ASG's RISKY_POOLS_TAG_KEY tag, see get_reported_pools()"""
+        pools = get_reported_pools(self.asg.tags)
+        pools[pool] = reported_at
+        try:
+            self.asg_client.create_or_update_tags(Tags=[{
+                'ResourceId': self.asg_name, 'ResourceType': 'auto-scaling-group',
+                'Key': RISKY_POOLS_TAG_KEY, 'Value': format_reported_pools(pools), 'PropagateAtLaunch': False}])
+        except Exception:
+            # Only runs in other Lambda containers miss the mark.
+            self.logger.exception("Could not tag ASG with risky pool %s/%s:", *pool)
 
+    def request_spot_instance(self, launch_specification, replaced_instance_details, bid_price,
+                              rebalance=None):
         response = self.ec2_client.request_spot_instances(
             DryRun=False, SpotPrice=bid_price,
             LaunchSpecification=launch_specification)
 
         spot_request_id = response['SpotInstanceRequests'][0]['SpotInstanceRequestId']
-        self.logger.info("New spot request %r was created", spot_request_id)
+        self.logger.debug("New spot request %r was created", spot_request_id)
+        self.decision.update(action='requested', spot_request_id=spot_request_id,
+                             replaced_instance_id=replaced_instance_details.instance_id,
+                             instance_type=launch_specification['InstanceType'],
+                             bid_price=bid_price)
 
         tags = [
-            {'Key': SPOTNIK_TAG_KEY, 'Value': self.asg['AutoScalingGroupName']},
-            {'Key': 'spotnik-will-replace', 'Value': replaced_instance_details['InstanceId']}]
+            {'Key': SPOTNIK_TAG_KEY, 'Value': self.asg_name},
+            {'Key': 'spotnik-will-replace', 'Value': replaced_instance_details.instance_id}]
+        if rebalance:
+            self.decision['rebalance'] = rebalance
+            tags.append({'Key': REBALANCE_TAG_KEY, 'Value': rebalance})
         self.tag_spot_request(spot_request_id, tags)
 
-    @retry(attempts=3, delay=3)
     def tag_spot_request(self, spot_request_id, tags):
-        self.ec2_client.create_tags(Resources=[spot_request_id], Tags=tags)
+        # A new spot request may not be visible to create_tags yet. The tag
+        # queue retries it in the background instead of blocking this ASG.
+        self.tag_queue.create_tags([spot_request_id], tags)
@@ -0,0 +1,197 @@
+from __future__ import print_function, absolute_import, division
+
+import logging
+import threading
+import time
+
+from .aws import ClientRegistry
+
+# Operations queued within this time are merged into one API call.
+LINGER_SECONDS = 0.2
+# Resources that are not visible yet are retried after 1, 2, 4, 8 seconds.
+BASE_DELAY_SECONDS = 1
+MAX_ATTEMPTS = 5
+# Limit of the EC2 API for create_tags and delete_tags.
+MAX_RESOURCES_PER_CALL = 1000
+
+
+class _TagOperation(object):
+    __slots__ = ('operation', 'tags', 'resource_id', 'attempts', 'due')
+
+    def __init__(self, operation, tags, resource_id, due):
+        self.operation = operation
+        self.tags = tags
+        self.resource_id = resource_id
+        self.attempts = 0
+        self.due = due
+
+
+def _freeze_tags(tags):
+    return tuple(sorted((tag['Key'], tag.get('Value')) for tag in tags))
+
+
+def _thaw_tags(tags):
+    return [{'Key': key} if value is None else {'Key': key, 'Value': value} for key, value in tags]
+
+
+def _get_not_found_resources(exc, resource_ids):
+    """Return the resources an EC2 NotFound error refers to, or None"""
+    error = getattr(exc, 'response', {}).get('Error', {})
+    if not error.get('Code', '').endswith('.NotFound'):
+        return None
+    message = error.get('Message', '')
+    # EC2 names the missing IDs in the message. If it does not, assume
+    # that none of the resources is visible yet.
+    return [resource_id for resource_id in resource_ids if resource_id in message] or list(resource_ids)
+
+
+class TagQueue(object):
+    """Collect the create_tags and delete_tags calls of all ASG workers
+
+    A background thread sends the queued operations. Operations with the
+    same tags are merged into one call for many resources. Freshly
+    created resources (e.g. spot requests) may not be visible to the tag
+    API yet. Only those resources are retried, with exponential backoff.
+    Callers never wait for the API.
+    """
+    def __init__(self, ec2_client, logger=None, linger=LINGER_SECONDS,
+                 base_delay=BASE_DELAY_SECONDS, max_attempts=MAX_ATTEMPTS):
+        self.ec2_client = ec2_client
+        self.logger = logger or logging.getLogger('spotnik.tagging')
+        self.linger = linger
+        self.base_delay = base_delay
+        self.max_attempts = max_attempts
+
+        self._condition = threading.Condition()
+        self._pending = []
+        self._failures = []
+        self._closing = False
+        self._thread = None
+
+    def create_tags(self, resource_ids, tags):
+        self._add('create_tags', resource_ids, tags)
+
+    def delete_tags(self, resource_ids, tags):
+        self._add('delete_tags', resource_ids, tags)
+
+    def _add(self, operation, resource_ids, tags):
+        tags = _freeze_tags(tags)
+        with self._condition:
+            due = time.time() + (0 if self._closing else self.linger)
+            for resource_id in resource_ids:
+                self._pending.append(_TagOperation(operation, tags, resource_id, due))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def close(self, timeout=None):
+        """Send all queued operations and return the failures
+
+        Returns a list of messages, one per resource that could not be
+        tagged or untagged.
+        """
+        with self._condition:
+            self._closing = True
+            thread = self._thread
+            self._condition.notify()
+        if thread is not None:
+            thread.join(timeout)
+        with self._condition:
+            failures = list(self._failures)
+            for operation in self._pending:
+                failures.append("%s %s: not sent before timeout" % (operation.operation, operation.resource_id))
+        return failures
+
+    def _run(self):
+        while True:
+            with self._condition:
+                batch = self._wait_for_batch()
+            if batch is None:
+                return
+            self._send(batch)
+
+    def _wait_for_batch(self):
+        while True:
+            if not self._pending:
+                if self._closing:
+                    return None
+                self._condition.wait()
+                continue
+            now = time.time()
+            next_due = min(operation.due for operation in self._pending)
+            if next_due > now:
+                self._condition.wait(next_due - now)
+                continue
+            # Take along what would be due shortly, so it can be merged.
+            cutoff = now + self.linger
+            batch = [operation for operation in self._pending if operation.due <= cutoff]
+            self._pending = [operation for operation in self._pending if operation.due > cutoff]
+            return batch
+
+    def _send(self, batch):
+        groups = {}
+        for operation in batch:
+            groups.setdefault((operation.operation, operation.tags), {})[operation.resource_id] = operation
+        for (operation_name, tags), operations in sorted(groups.items()):
+            resource_ids = sorted(operations)
+            for start in range(0, len(resource_ids), MAX_RESOURCES_PER_CALL):
+                chunk = dict((resource_id, operations[resource_id])
+                             for resource_id in resource_ids[start:start + MAX_RESOURCES_PER_CALL])
+                self._send_chunk(operation_name, tags, chunk)
+
+    def _send_chunk(self, operation_name, tags, operations):
+        call = getattr(self.ec2_client, operation_name)
+        while operations:
+            resource_ids = sorted(operations)
+            try:
+                call(Resources=resource_ids, Tags=_thaw_tags(tags))
+                return
+            except Exception as exc:
+                not_found = _get_not_found_resources(exc, resource_ids)
+                if not_found is None:
+                    self.logger.exception("%s failed for %s:", operation_name, resource_ids)
+                    self._fail(operations.values(), exc)
+                    return
+            # Retry the visible resources right away, the others later.
+            self._retry_later([operations.pop(resource_id) for resource_id in not_found])
+
+    def _retry_later(self, operations):
+        now = time.time()
+        with self._condition:
+            for operation in operations:
+                operation.attempts += 1
+                if operation.attempts >= self.max_attempts:
+                    self._failures.append("%s %s: still not visible after %d attempts" % (
+                        operation.operation, operation.resource_id, operation.attempts))
+                    continue
+                operation.due = now + self.base_delay * 2 ** (operation.attempts - 1)
+                self._pending.append(operation)
+
+    def _fail(self, operations, exc):
+        with self._condition:
+            for operation in operations:
+                self._failures.append("%s %s: %s" % (operation.operation, operation.resource_id, exc))
+
+
+def _new_queue(region_name, ec2_client):
+    return TagQueue(ec2_client, logger=logging.getLogger('spotnik.tagging.%s' % region_name))
+
+
+_queues = ClientRegistry(_new_queue, 'ec2')
+
+
+def get_tag_queue(region_name, role_arn=None):
+    """Return the tag queue shared by all ASG workers of a region"""
+    return _queues.get(region_name, role_arn=role_arn)
+
+
+def drain_tag_queues(timeout=None):
+    """Close all tag queues and return their failures per role ARN"""
+    queues = _queues.pop_all()
+    failures = {}
+    for (role_arn, region_name), queue in sorted(queues.items(), key=lambda item: (str(item[0][0]), item[0][1])):
+        for message in queue.close(timeout):
+            failures.setdefault(role_arn, []).append("%s: %s" % (region_name, message))
+    return failures
@@ -1,5 +1,12 @@
 from __future__ import print_function, absolute_import, division
 
+import random
+from datetime import datetime
+
+# Set by pin(), see spotnik.snapshot.
+_pinned_now = None
+_pinned_seed = None
+
 
 def _boto_tags_to_dict(tags):
     """Convert the Tags in boto format into a usable dict
@@ -9,3 +16,32 @@ def _boto_tags_to_dict(tags):
     {'foo': 'bar', 'ham': 'spam'}
     """
     return {item['Key']: item['Value'] for item in tags}
+
+
+def _dict_to_boto_tags(tags):
+    """Inverse of _boto_tags_to_dict()"""
+    return [{'Key': key, 'Value': value} for key, value in sorted(tags.items())]
+
+
+def utcnow():
+    """Return the current (naive) UTC time, or the pinned one"""
+    return _pinned_now or datetime.utcnow()
+
+
+def get_random(name=None):
+    """Return the random number generator for a decision about name
+
+    Without a pinned seed, this is the random module itself. Otherwise it
+    is seeded by the pinned seed and name, so the decision neither depends
+    on the order in which threads draw numbers nor changes between runs.
+    """
+    if _pinned_seed is None:
+        return random
+    return random.Random("%s/%s" % (_pinned_seed, name))
+
+
+def pin(now=None, seed=None):
+    """Make utcnow() return now and get_random() use seed; pin() undoes it"""
+    global _pinned_now, _pinned_seed
+    _pinned_now = now
+    _pinned_seed = seed
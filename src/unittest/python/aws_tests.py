@@ -0,0 +1,134 @@
+from __future__ import print_function, absolute_import, division
+
+import threading
+import unittest2
+
+from datetime import datetime, timedelta
+
+from dateutil.tz import tzutc
+from mock import Mock, patch
+
+from spotnik import aws
+from spotnik.benchmark import measure_once
+
+
+class AwsTests(unittest2.TestCase):
+    def setUp(self):
+        aws.reset()
+
+    def tearDown(self):
+        aws.reset()
+
+    @patch("spotnik.aws.get_session")
+    def test_clients_are_cached_per_service_and_region(self, mock_get_session):
+        mock_get_session.return_value.client.side_effect = lambda *args, **kwargs: object()
+
+        ec2_client = aws.get_client('ec2', 'eu-west-1')
+
+        self.assertIs(aws.get_client('ec2', 'eu-west-1'), ec2_client)
+        self.assertIsNot(aws.get_client('ec2', 'us-east-1'), ec2_client)
+        self.assertIsNot(aws.get_client('autoscaling', 'eu-west-1'), ec2_client)
+        self.assertEqual(mock_get_session.return_value.client.call_count, 3)
+
+    def test_session_preloads_only_needed_service_models(self):
+        session = aws.get_session()
+        loader = session._session.get_component('data_loader')
+
+        self.assertIs(aws.get_session(), session)
+        with patch.object(loader, 'load_data_with_path', side_effect=AssertionError):
+            # Served from the loader's cache, no file is read again.
+            loader.load_service_model('ec2', 'service-2')
+            loader.load_service_model('autoscaling', 'service-2')
+
+
+class ClientRegistryTests(unittest2.TestCase):
+    @patch("spotnik.aws.get_client")
+    def test_objects_are_shared_until_clients_change(self, mock_get_client):
+        clients = {}
+        mock_get_client.side_effect = lambda *args, **kwargs: clients.setdefault((args, kwargs.get('role_arn')), Mock())
+        registry = aws.ClientRegistry(lambda region_name, ec2_client, asg_client: Mock(), 'ec2', 'autoscaling')
+
+        shared = registry.get('eu-west-1')
+        self.assertIs(registry.get('eu-west-1'), shared)
+        self.assertIsNot(registry.get('us-east-1'), shared)
+        self.assertIsNot(registry.get('eu-west-1', role_arn='arn:aws:iam::111111111111:role/spotnik'), shared)
+
+        clients.clear()
+        self.assertIsNot(registry.get('eu-west-1'), shared)
+
+    @patch("spotnik.aws.get_client")
+    def test_pop_all(self, mock_get_client):
+        registry = aws.ClientRegistry(lambda region_name, ec2_client: region_name, 'ec2')
+        registry.get('eu-west-1')
+
+        self.assertEqual(registry.pop_all(), {(None, 'eu-west-1'): 'eu-west-1'})
+        self.assertEqual(registry.pop_all(), {})
+
+
+class ColdStartTests(unittest2.TestCase):
+    def test_import_does_not_load_heavy_modules(self):
+        result = measure_once(api_call=False)
+        self.assertEqual(result['heavy_modules'], [])
+
+
+class AssumedRoleTests(unittest2.TestCase):
+    role_arn = 'arn:aws:iam::111111111111:role/spotnik'
+
+    def setUp(self):
+        aws.reset()
+        self.sts_client = Mock()
+        self.sts_client.assume_role.return_value = {'Credentials': {
+            'AccessKeyId': 'AKID', 'SecretAccessKey': 'secret', 'SessionToken': 'token',
+            'Expiration': datetime.now(tzutc()) + timedelta(hours=1)}}
+        # Only the sts client is faked, all other clients are real.
+        self.real_get_client = aws.get_client
+        patcher = patch("spotnik.aws.get_client", side_effect=self.get_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        aws.reset()
+
+    def get_client(self, service_name, region_name, role_arn=None):
+        if service_name == 'sts':
+            return self.sts_client
+        return self.real_get_client(service_name, region_name, role_arn=role_arn)
+
+    def test_role_is_assumed_once(self):
+        session = aws.get_session(self.role_arn)
+
+        self.assertIs(aws.get_session(self.role_arn), session)
+        self.assertEqual(self.sts_client.assume_role.call_count, 1)
+        credentials = session.get_credentials().get_frozen_credentials()
+        self.assertEqual(credentials.access_key, 'AKID')
+        self.assertEqual(credentials.token, 'token')
+
+    def test_assumed_role_session_shares_service_models(self):
+        session = aws.get_session(self.role_arn)
+
+        self.assertIs(session._session.get_component('data_loader'),
+                      aws.get_session()._session.get_component('data_loader'))
+
+    def test_roles_are_assumed_in_parallel(self):
+        other_role_arn = 'arn:aws:iam::222222222222:role/spotnik'
+        credentials = self.sts_client.assume_role.return_value
+        blocked = threading.Event()
+        release = threading.Event()
+
+        def assume_role(RoleArn, **_):
+            if RoleArn == self.role_arn:
+                blocked.set()
+                release.wait(5)
+            return credentials
+        self.sts_client.assume_role.side_effect = assume_role
+        aws.get_session()
+        thread = threading.Thread(target=aws.get_client, args=('ec2', 'eu-west-1', self.role_arn))
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(release.set)
+        blocked.wait(5)
+
+        # Neither other accounts nor cached clients wait for the pending AssumeRole.
+        aws.get_client('ec2', 'eu-west-1', role_arn=other_role_arn)
+        aws.get_client('ec2', 'eu-west-1')
+        self.assertTrue(thread.is_alive())
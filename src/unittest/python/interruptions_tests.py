@@ -0,0 +1,91 @@
+from __future__ import print_function, absolute_import, division
+
+import unittest2
+
+from datetime import datetime, timedelta
+
+from dateutil.tz import tzutc
+from mock import Mock, patch
+
+from spotnik.interruptions import (RISKY_POOLS_TAG_KEY, InterruptionTracker, format_reported_pools,
+                                   get_reported_pools, is_interruption_event)
+
+
+def get_interrupted_request(availability_zone, instance_type, minutes_ago=5):
+    return {
+        'LaunchedAvailabilityZone': availability_zone,
+        'LaunchSpecification': {'InstanceType': instance_type},
+        'Status': {'Code': 'instance-terminated-no-capacity',
+                   'UpdateTime': datetime.now(tzutc()) - timedelta(minutes=minutes_ago)}}
+
+
+class InterruptionTrackerTests(unittest2.TestCase):
+    def setUp(self):
+        self.ec2_client = Mock()
+        self.tracker = InterruptionTracker(self.ec2_client, threshold=2)
+
+    def test_counts_recent_interruptions_per_pool(self):
+        self.ec2_client.describe_spot_instance_requests.side_effect = [
+            {'SpotInstanceRequests': [get_interrupted_request('eu-west-1a', 'm5.large'),
+                                      get_interrupted_request('eu-west-1a', 'm5.large', minutes_ago=120)],
+             'NextToken': 'next'},
+            {'SpotInstanceRequests': [get_interrupted_request('eu-west-1a', 'm5.large'),
+                                      get_interrupted_request('eu-west-1b', 'm5.large')]}]
+
+        self.assertEqual(self.tracker.get_interruptions(), {
+            ('eu-west-1a', 'm5.large'): 2, ('eu-west-1b', 'm5.large'): 1})
+        self.assertTrue(self.tracker.is_risky(('eu-west-1a', 'm5.large')))
+        self.assertFalse(self.tracker.is_risky(('eu-west-1b', 'm5.large')))
+        self.assertEqual(self.ec2_client.describe_spot_instance_requests.call_args[1]['NextToken'], 'next')
+
+    def test_history_is_fetched_once_per_run(self):
+        self.ec2_client.describe_spot_instance_requests.return_value = {'SpotInstanceRequests': []}
+
+        self.tracker.is_risky(('eu-west-1a', 'm5.large'))
+        self.tracker.is_risky(('eu-west-1b', 'm5.large'))
+
+        self.assertEqual(self.ec2_client.describe_spot_instance_requests.call_count, 1)
+
+    def test_recorded_pool_is_risky(self):
+        self.ec2_client.describe_spot_instance_requests.return_value = {'SpotInstanceRequests': []}
+
+        self.tracker.record(('eu-west-1a', 'm5.large'))
+
+        self.assertTrue(self.tracker.is_risky(('eu-west-1a', 'm5.large')))
+        self.assertFalse(self.tracker.is_risky(('eu-west-1a', 'c5.large')))
+
+    def test_record_keeps_latest_report(self):
+        self.assertEqual(self.tracker.record(('eu-west-1a', 'm5.large'), 200), 200)
+        self.tracker.record(('eu-west-1a', 'm5.large'), 100)
+
+        self.assertEqual(self.tracker._reported, {('eu-west-1a', 'm5.large'): 200})
+
+
+class ReportedPoolsTests(unittest2.TestCase):
+    @patch("spotnik.interruptions.utcnow")
+    def test_reported_pools_round_trip(self, mock_utcnow):
+        mock_utcnow.return_value = datetime(2017, 7, 14, 2, 40)
+        now = 1500000000
+        pools = {('eu-west-1a', 'm5.large'): now - 60, ('eu-west-1b', 'c5.large'): now - 7200}
+
+        tags = {RISKY_POOLS_TAG_KEY: format_reported_pools(pools) + " garbage"}
+
+        self.assertEqual(get_reported_pools(tags), {('eu-west-1a', 'm5.large'): now - 60})
+        self.assertEqual(get_reported_pools({}), {})
+
+    def test_format_keeps_latest_pools_that_fit_into_a_tag(self):
+        pools = dict((('eu-west-1a', 'type-%03d' % index), index) for index in range(100))
+
+        value = format_reported_pools(pools)
+
+        self.assertLessEqual(len(value), 256)
+        self.assertEqual(value.split()[0], 'eu-west-1a/type-099/99')
+        self.assertEqual(len(value.split()), 256 // len('eu-west-1a/type-099/99 '))
+
+
+class InterruptionEventTests(unittest2.TestCase):
+    def test_is_interruption_event(self):
+        self.assertTrue(is_interruption_event({'detail-type': 'EC2 Spot Instance Interruption Warning'}))
+        self.assertTrue(is_interruption_event({'detail-type': 'EC2 Instance Rebalance Recommendation'}))
+        self.assertFalse(is_interruption_event({'detail-type': 'Scheduled Event'}))
+        self.assertFalse(is_interruption_event(None))
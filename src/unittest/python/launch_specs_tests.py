@@ -0,0 +1,91 @@
+from __future__ import print_function, absolute_import, division
+
+import unittest2
+
+from mock import Mock, patch
+
+from spotnik import launch_specs
+from spotnik.launch_specs import LaunchSpecBuilder
+from spotnik.records import AutoScalingGroup, Instance, LaunchTemplateRef
+from records_tests import get_boto_instance, get_boto_launch_config
+
+
+def get_template_version(version_number, image_id='ami-123'):
+    return {'LaunchTemplateVersions': [{
+        'LaunchTemplateId': 'lt-1',
+        'VersionNumber': version_number,
+        'LaunchTemplateData': {'ImageId': image_id, 'InstanceType': 'm5.large'}}]}
+
+
+class LaunchSpecBuilderTests(unittest2.TestCase):
+    def setUp(self):
+        self.ec2_client = Mock()
+        self.asg_client = Mock()
+        self.asg_client.describe_launch_configurations.return_value = {
+            'LaunchConfigurations': [get_boto_launch_config()]}
+        self.builder = LaunchSpecBuilder(self.ec2_client, self.asg_client)
+        self.instance = Instance.from_boto(get_boto_instance())
+
+    def test_launch_configuration_spec_is_memoized(self):
+        asg = AutoScalingGroup('the-asg', launch_configuration_name='the-lc')
+
+        first = self.builder.build(asg, self.instance)
+        second = self.builder.build(asg, self.instance)
+
+        self.assertIs(first, second)
+        self.assertEqual(first['ImageId'], 'ami-123')
+        self.asg_client.describe_launch_configurations.assert_called_once_with(
+            LaunchConfigurationNames=['the-lc'])
+
+    def test_spec_depends_on_instance_type_and_subnet(self):
+        asg = AutoScalingGroup('the-asg', launch_configuration_name='the-lc')
+        other_subnet = Instance.from_boto(get_boto_instance(NetworkInterfaces=[{
+            'SubnetId': 'subnet-2', 'Groups': [{'GroupId': 'sg-1'}]}]))
+
+        default = self.builder.build(asg, self.instance)
+        larger = self.builder.build(asg, self.instance, instance_type='c4.large')
+        moved = self.builder.build(asg, other_subnet)
+
+        self.assertEqual(larger['InstanceType'], 'c4.large')
+        self.assertEqual(moved['NetworkInterfaces'][0]['SubnetId'], 'subnet-2')
+        self.assertIsNot(default, larger)
+        self.assertEqual(self.asg_client.describe_launch_configurations.call_count, 1)
+
+    def test_numbered_template_version_is_cached(self):
+        self.ec2_client.describe_launch_template_versions.return_value = get_template_version(3)
+        asg = AutoScalingGroup('the-asg', launch_template=LaunchTemplateRef('lt-1', version='3'))
+
+        self.builder.build(asg, self.instance)
+        launch_specification = self.builder.build(asg, self.instance)
+
+        self.assertEqual(launch_specification['InstanceType'], 'm5.large')
+        self.ec2_client.describe_launch_template_versions.assert_called_once_with(
+            LaunchTemplateId='lt-1', Versions=['3'])
+
+    def test_template_alias_is_resolved_again_after_ttl(self):
+        self.ec2_client.describe_launch_template_versions.side_effect = [
+            get_template_version(3), get_template_version(4, image_id='ami-456')]
+        asg = AutoScalingGroup('the-asg', launch_template=LaunchTemplateRef('lt-1', version='$Latest'))
+
+        with patch("spotnik.launch_specs.time.time", return_value=1000):
+            first = self.builder.build(asg, self.instance)
+            self.builder.build(asg, self.instance)
+        with patch("spotnik.launch_specs.time.time", return_value=1000 + launch_specs.ALIAS_TTL_SECONDS + 1):
+            second = self.builder.build(asg, self.instance)
+
+        self.assertEqual(first['ImageId'], 'ami-123')
+        self.assertEqual(second['ImageId'], 'ami-456')
+        self.assertEqual(self.ec2_client.describe_launch_template_versions.call_count, 2)
+
+    def test_resolved_alias_serves_numbered_version(self):
+        self.ec2_client.describe_launch_template_versions.return_value = get_template_version(3)
+        self.builder.build(AutoScalingGroup(
+            'asg-1', launch_template=LaunchTemplateRef('lt-1', version='$Default')), self.instance)
+
+        self.builder.build(AutoScalingGroup(
+            'asg-2', launch_template=LaunchTemplateRef('lt-1', version='3')), self.instance)
+
+        self.assertEqual(self.ec2_client.describe_launch_template_versions.call_count, 1)
+
+    def test_asg_without_launch_source_fails(self):
+        self.assertRaises(Exception, self.builder.build, AutoScalingGroup('the-asg'), self.instance)
@@ -0,0 +1,91 @@
+from __future__ import print_function, absolute_import, division
+
+import json
+import logging
+import unittest2
+
+from mock import Mock, patch
+
+from spotnik.logs import JsonFormatter, PayloadLogger, get_sample_rate, log_decision
+
+
+class Unprintable(object):
+    def __repr__(self):
+        raise AssertionError("payload must not be formatted")
+
+
+class JsonFormatterTests(unittest2.TestCase):
+    def make_record(self, msg, args=(), **extra):
+        record = logging.LogRecord('spotnik.eu-west-1.foo', logging.INFO, __file__, 1,
+                                   msg, args, None)
+        record.__dict__.update(extra)
+        return record
+
+    def test_format_plain_message(self):
+        entry = json.loads(JsonFormatter().format(self.make_record("Found %d ASGs", (3,))))
+
+        self.assertEqual(entry['message'], "Found 3 ASGs")
+        self.assertEqual(entry['level'], 'INFO')
+        self.assertEqual(entry['logger'], 'spotnik.eu-west-1.foo')
+
+    def test_format_decision(self):
+        decision = {'asg': 'foo', 'action': 'requested', 'on_demand': 2}
+        record = self.make_record("Decision: %s", ("ignored",), decision=decision)
+
+        entry = json.loads(JsonFormatter().format(record))
+
+        self.assertEqual(entry['decision'], decision)
+        self.assertNotIn('message', entry)
+
+
+class PayloadLoggerTests(unittest2.TestCase):
+    def setUp(self):
+        self.logger = logging.getLogger('spotnik.test_payload_logger')
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.handler = Mock(level=logging.NOTSET)
+        self.logger.handlers = [self.handler]
+
+    def test_payloads_are_not_logged_by_default(self):
+        payload_logger = PayloadLogger(self.logger, sample_rate=0)
+        payload_logger.log("launch_config", Unprintable())
+
+        self.assertFalse(payload_logger.enabled)
+        self.assertFalse(self.handler.handle.called)
+
+    def test_payloads_are_logged_at_debug_level(self):
+        self.logger.setLevel(logging.DEBUG)
+        payload_logger = PayloadLogger(self.logger)
+        payload_logger.log("launch_config", {'ImageId': 'ami-123'})
+
+        record = self.handler.handle.call_args[0][0]
+        self.assertEqual(record.levelno, logging.DEBUG)
+        self.assertIn("ami-123", record.getMessage())
+
+    @patch("spotnik.util.random.random")
+    def test_payloads_are_logged_if_sampled(self, mock_random):
+        mock_random.return_value = 0.05
+        self.assertTrue(PayloadLogger(self.logger, sample_rate=0.1).enabled)
+
+        mock_random.return_value = 0.5
+        self.assertFalse(PayloadLogger(self.logger, sample_rate=0.1).enabled)
+
+    def test_log_decision(self):
+        log_decision(self.logger, {'asg': 'foo', 'action': 'none'})
+
+        record = self.handler.handle.call_args[0][0]
+        self.assertEqual(record.decision, {'asg': 'foo', 'action': 'none'})
+        self.assertEqual(record.getMessage(), "Decision: action=none asg=foo")
+
+
+class SampleRateTests(unittest2.TestCase):
+    @patch.dict("os.environ", {'SPOTNIK_LOG_SAMPLE_RATE': '0.2'})
+    def test_sample_rate_from_environment(self):
+        self.assertEqual(get_sample_rate({}), 0.2)
+
+    @patch.dict("os.environ", {'SPOTNIK_LOG_SAMPLE_RATE': '0.2'})
+    def test_sample_rate_tag_overrides_environment(self):
+        self.assertEqual(get_sample_rate({'spotnik-log-sample-rate': '1'}), 1.0)
+
+    def test_invalid_sample_rate_disables_sampling(self):
+        self.assertEqual(get_sample_rate({'spotnik-log-sample-rate': 'often'}), 0.0)
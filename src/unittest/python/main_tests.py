@@ -3,9 +3,12 @@ from __future__ import print_function, absolute_import, division
 import time
 import unittest2
 
-from mock import patch
+from datetime import datetime
 
-from spotnik.main import main
+from mock import Mock, patch
+
+from spotnik.main import get_targets, handle_interruption_event, main
+from spotnik.records import AutoScalingGroup, Instance, Target
 
 
 def fail_eventually(*args, **kwargs):
@@ -30,6 +33,123 @@ class MainTests(unittest2.TestCase):
     @patch("spotnik.main.Spotnik")
     def test_main_fails_if_asg_thread_fails(self, mock_spotnik, mock_get_aws_region_names):
         mock_get_aws_region_names.return_value = ['region_one', 'region_two']
-        mock_spotnik.get_spotnik_asgs.return_value = [{'AutoScalingGroupName': 'foo'}]
+        mock_spotnik.get_spotnik_asgs.return_value = [AutoScalingGroup('foo')]
         mock_spotnik.side_effect = fail_eventually
         self.assertRaises(Exception, main)
+
+
+class MultiAccountTests(unittest2.TestCase):
+    role_arns = ['arn:aws:iam::111111111111:role/spotnik', 'arn:aws:iam::222222222222:role/spotnik']
+
+    @patch("spotnik.main.get_aws_region_names")
+    @patch("spotnik.main.Spotnik")
+    def test_main_fans_out_over_accounts_and_regions(self, mock_spotnik, mock_get_aws_region_names):
+        mock_get_aws_region_names.return_value = ['region_one', 'region_two']
+        mock_spotnik.get_spotnik_asgs.return_value = [AutoScalingGroup('foo')]
+        mock_spotnik.return_value.get_pending_spot_resources.return_value = None, None
+
+        results = main(targets=get_targets(self.role_arns), max_workers=3)
+
+        self.assertEqual(sorted(results), ['111111111111', '222222222222'])
+        for role_arn, account_id in zip(self.role_arns, ['111111111111', '222222222222']):
+            mock_get_aws_region_names.assert_any_call(role_arn=role_arn)
+            mock_spotnik.get_spotnik_asgs.assert_any_call('region_two', role_arn=role_arn)
+            self.assertEqual(results[account_id]['regions'], ['region_one', 'region_two'])
+            self.assertEqual(len(results[account_id]['decisions']), 2)
+            self.assertEqual(results[account_id]['errors'], [])
+
+    @patch("spotnik.main.get_aws_region_names")
+    @patch("spotnik.main.Spotnik")
+    def test_results_contain_report_and_summary(self, mock_spotnik, mock_get_aws_region_names):
+        mock_get_aws_region_names.return_value = ['region_one']
+        mock_spotnik.get_spotnik_asgs.return_value = [AutoScalingGroup('foo', instance_ids=['i-1', 'i-2'])]
+        mock_spotnik.get_instance_snapshot.return_value = {
+            'i-1': Instance('i-1', lifecycle='spot'), 'i-2': Instance('i-2', launch_time=datetime(2016, 1, 1))}
+        mock_spotnik.return_value.get_pending_spot_resources.return_value = None, None
+
+        results = main(targets=get_targets(self.role_arns[:1]))
+
+        result = results['111111111111']
+        self.assertEqual(result['decisions'][0]['report']['spot'], 1)
+        self.assertEqual(result['decisions'][0]['report']['on_demand'], 1)
+        self.assertEqual(result['summary']['asgs'], 1)
+        self.assertEqual(mock_spotnik.get_instance_snapshot.call_count, 1)
+        self.assertEqual(mock_spotnik.call_args[1]['instances'], mock_spotnik.get_instance_snapshot.return_value)
+
+    @patch("spotnik.main.get_aws_region_names")
+    @patch("spotnik.main.Spotnik")
+    def test_failing_account_does_not_stop_other_accounts(self, mock_spotnik, mock_get_aws_region_names):
+        def get_aws_region_names(role_arn):
+            if role_arn == self.role_arns[0]:
+                raise Exception("AccessDenied")
+            return ['region_one']
+        mock_get_aws_region_names.side_effect = get_aws_region_names
+        mock_spotnik.get_spotnik_asgs.return_value = [AutoScalingGroup('foo')]
+        mock_spotnik.return_value.get_pending_spot_resources.return_value = None, None
+
+        with self.assertRaisesRegex(Exception, "111111111111"):
+            main(targets=get_targets(self.role_arns))
+        self.assertEqual(mock_spotnik.return_value.make_spot_request.call_count, 1)
+
+    @patch.dict("os.environ", {'SPOTNIK_ROLE_ARNS': "arn:aws:iam::111111111111:role/a, "
+                                                    "arn:aws:iam::222222222222:role/b"})
+    def test_get_targets_from_environment(self):
+        targets = get_targets()
+        self.assertEqual([target.account_id for target in targets], ['111111111111', '222222222222'])
+        self.assertEqual(targets[1].role_arn, "arn:aws:iam::222222222222:role/b")
+
+    @patch.dict("os.environ", {'SPOTNIK_ROLE_ARNS': ""})
+    def test_get_targets_defaults_to_local_account(self):
+        self.assertEqual(get_targets(), [Target()])
+
+
+class InterruptionEventTests(unittest2.TestCase):
+    event = {
+        'detail-type': 'EC2 Spot Instance Interruption Warning',
+        'account': '111111111111',
+        'region': 'eu-west-1',
+        'detail': {'instance-id': 'i-1', 'instance-action': 'terminate'}}
+
+    def setUp(self):
+        patcher = patch("spotnik.main.get_client")
+        self.ec2_client = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.ec2_client.describe_instances.return_value = {'Reservations': [{'Instances': [{
+            'InstanceId': 'i-1', 'InstanceLifecycle': 'spot', 'InstanceType': 'm5.large',
+            'Placement': {'AvailabilityZone': 'eu-west-1a'},
+            'Tags': [{'Key': 'aws:autoscaling:groupName', 'Value': 'foo'}]}]}]}
+
+    @patch("spotnik.main.Spotnik")
+    def test_interruption_warning_prepares_replacement(self, mock_spotnik):
+        mock_spotnik.get_spotnik_asg.return_value = AutoScalingGroup('foo')
+        mock_spotnik.return_value.get_pending_spot_resources.return_value = None, None
+        targets = get_targets(['arn:aws:iam::111111111111:role/spotnik'])
+
+        decision = handle_interruption_event(self.event, targets=targets)
+
+        mock_spotnik.get_spotnik_asg.assert_called_once_with(
+            'eu-west-1', 'foo', role_arn='arn:aws:iam::111111111111:role/spotnik')
+        instance, trigger = mock_spotnik.return_value.make_rebalance_request.call_args[0]
+        self.assertEqual(instance.instance_id, 'i-1')
+        self.assertEqual(trigger, 'interruption_warning')
+        self.assertEqual(decision['account'], '111111111111')
+        self.assertEqual(decision['asg'], 'foo')
+
+    @patch("spotnik.main.Spotnik")
+    def test_pending_request_is_not_duplicated(self, mock_spotnik):
+        mock_spotnik.get_spotnik_asg.return_value = AutoScalingGroup('foo')
+        mock_spotnik.return_value.get_pending_spot_resources.return_value = Mock(request_id='sir-1'), None
+
+        decision = handle_interruption_event(self.event, targets=[Target()])
+
+        self.assertEqual(decision['action'], 'pending')
+        self.assertFalse(mock_spotnik.return_value.make_rebalance_request.called)
+
+    @patch("spotnik.main.Spotnik")
+    def test_instance_outside_spotnik_asg_is_ignored(self, mock_spotnik):
+        mock_spotnik.get_spotnik_asg.return_value = None
+
+        decision = handle_interruption_event(self.event, targets=[Target()])
+
+        self.assertEqual(decision['reason'], 'not_in_spotnik_asg')
+        self.assertFalse(mock_spotnik.called)
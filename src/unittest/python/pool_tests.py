@@ -0,0 +1,38 @@
+from __future__ import print_function, absolute_import, division
+
+import threading
+import time
+import unittest2
+
+from spotnik.pool import WorkerPool
+
+
+class WorkerPoolTests(unittest2.TestCase):
+    def test_submit_returns_result(self):
+        with WorkerPool(2) as pool:
+            tasks = [pool.submit(pow, number, 2) for number in range(5)]
+            self.assertEqual([task.get() for task in tasks], [0, 1, 4, 9, 16])
+
+    def test_exception_is_raised_by_get(self):
+        with WorkerPool(1) as pool:
+            task = pool.submit(int, "not a number")
+            self.assertRaises(ValueError, task.get)
+
+    def test_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        running = [0]
+        max_running = [0]
+
+        def work():
+            with lock:
+                running[0] += 1
+                max_running[0] = max(max_running[0], running[0])
+            time.sleep(.01)
+            with lock:
+                running[0] -= 1
+
+        with WorkerPool(3) as pool:
+            for task in [pool.submit(work) for _ in range(12)]:
+                task.get()
+
+        self.assertEqual(max_running[0], 3)
@@ -0,0 +1,175 @@
+from __future__ import print_function, absolute_import, division
+
+import unittest2
+
+from datetime import datetime
+
+from spotnik.records import AutoScalingGroup, Instance, LaunchConfiguration, LaunchTemplateRef, SpotRequest
+from spotnik.replacement_policy import generate_launch_specification
+
+
+def get_boto_instance(**kwargs):
+    description = {
+        'InstanceId': 'i-123',
+        'InstanceType': 'm3.medium',
+        'LaunchTime': datetime(2016, 1, 1, 12, 0),
+        'Placement': {'AvailabilityZone': 'eu-west-1a', 'Tenancy': 'default'},
+        'State': {'Code': 16, 'Name': 'running'},
+        'NetworkInterfaces': [{
+            'SubnetId': 'subnet-1',
+            'Groups': [{'GroupId': 'sg-1', 'GroupName': 'one'}],
+            'PrivateIpAddresses': [{'PrivateIpAddress': '10.0.0.1'}]}],
+        'Tags': [{'Key': 'Name', 'Value': 'foo'}],
+        'BlockDeviceMappings': [{'DeviceName': '/dev/xvda'}]}
+    description.update(kwargs)
+    return description
+
+
+def get_boto_launch_config(**kwargs):
+    launch_config = {
+        'LaunchConfigurationName': 'the-lc',
+        'ImageId': 'ami-123',
+        'UserData': 'ZWNobyBoZWxsbw==',
+        'InstanceType': 'm3.medium',
+        'IamInstanceProfile': 'the-profile',
+        'InstanceMonitoring': {'Enabled': False},
+        'BlockDeviceMappings': [],
+        'KeyName': '',
+        'EbsOptimized': False,
+        'AssociatePublicIpAddress': True,
+        'SecurityGroups': ['sg-1'],
+        'CreatedTime': datetime(2016, 1, 1)}
+    launch_config.update(kwargs)
+    return launch_config
+
+
+class RecordsTests(unittest2.TestCase):
+    def test_instance_from_boto(self):
+        instance = Instance.from_boto(get_boto_instance())
+
+        self.assertEqual(instance.instance_id, 'i-123')
+        self.assertEqual(instance.launch_time, datetime(2016, 1, 1, 12, 0))
+        self.assertEqual(instance.availability_zone, 'eu-west-1a')
+        self.assertEqual(instance.subnet_id, 'subnet-1')
+        self.assertEqual(instance.security_group_ids, ('sg-1',))
+        self.assertEqual(instance.state, 'running')
+        self.assertEqual(instance.tags, {'Name': 'foo'})
+        self.assertFalse(instance.is_spot)
+
+    def test_instance_from_boto_spot(self):
+        instance = Instance.from_boto(get_boto_instance(InstanceLifecycle='spot'))
+        self.assertTrue(instance.is_spot)
+
+    def test_records_do_not_keep_unused_fields(self):
+        instance = Instance.from_boto(get_boto_instance())
+        self.assertFalse(hasattr(instance, '__dict__'))
+        self.assertRaises(AttributeError, setattr, instance, 'block_device_mappings', [])
+
+    def test_asg_from_boto(self):
+        asg = AutoScalingGroup.from_boto({
+            'AutoScalingGroupName': 'the-asg',
+            'Tags': [{'Key': 'spotnik', 'Value': ''}],
+            'Instances': [{'InstanceId': 'i-1', 'LifecycleState': 'InService'},
+                          {'InstanceId': 'i-2', 'LifecycleState': 'Terminating'}],
+            'MaxSize': 3,
+            'LaunchConfigurationName': 'the-lc'})
+
+        self.assertEqual(asg, AutoScalingGroup('the-asg', tags={'spotnik': ''},
+                                               instance_ids=['i-1', 'i-2'], max_size=3,
+                                               launch_configuration_name='the-lc',
+                                               lifecycle_states={'i-1': 'InService', 'i-2': 'Terminating'}))
+
+    def test_asg_from_boto_launch_template(self):
+        asg = AutoScalingGroup.from_boto({
+            'AutoScalingGroupName': 'the-asg',
+            'LaunchTemplate': {'LaunchTemplateId': 'lt-1', 'LaunchTemplateName': 'the-lt'}})
+
+        self.assertIs(asg.launch_configuration_name, None)
+        self.assertEqual(asg.launch_template, LaunchTemplateRef('lt-1', 'the-lt', '$Default'))
+        self.assertEqual(asg.instance_types, ())
+
+    def test_asg_from_boto_mixed_instances_policy(self):
+        asg = AutoScalingGroup.from_boto({
+            'AutoScalingGroupName': 'the-asg',
+            'MixedInstancesPolicy': {'LaunchTemplate': {
+                'LaunchTemplateSpecification': {'LaunchTemplateId': 'lt-1', 'Version': '3'},
+                'Overrides': [{'InstanceType': 'm5.large'}, {'InstanceType': 'c5.large'}]}}})
+
+        self.assertEqual(asg.launch_template, LaunchTemplateRef('lt-1', None, '3'))
+        self.assertEqual(asg.instance_types, ('m5.large', 'c5.large'))
+
+    def test_launch_configuration_from_launch_template_version(self):
+        launch_config = LaunchConfiguration.from_launch_template_version({
+            'LaunchTemplateId': 'lt-1',
+            'VersionNumber': 4,
+            'LaunchTemplateData': {
+                'ImageId': 'ami-123',
+                'InstanceType': 'm5.large',
+                'IamInstanceProfile': {'Name': 'the-profile'},
+                'NetworkInterfaces': [{'DeviceIndex': 0, 'AssociatePublicIpAddress': False}]}})
+
+        self.assertEqual(launch_config.name, 'lt-1:4')
+        self.assertEqual(launch_config.image_id, 'ami-123')
+        self.assertEqual(launch_config.user_data, '')
+        self.assertEqual(launch_config.iam_instance_profile, 'the-profile')
+        self.assertEqual(launch_config.monitoring_enabled, False)
+        self.assertEqual(launch_config.associate_public_ip_address, False)
+
+    def test_spot_request_from_boto(self):
+        request = SpotRequest.from_boto({
+            'SpotInstanceRequestId': 'sir-1',
+            'State': 'open',
+            'Tags': [{'Key': 'spotnik-will-replace', 'Value': 'i-1'}]})
+
+        self.assertEqual(request.request_id, 'sir-1')
+        self.assertEqual(request.state, 'open')
+        self.assertIs(request.instance_id, None)
+        self.assertEqual(request.tags, {'spotnik-will-replace': 'i-1'})
+
+
+class GenerateLaunchSpecificationTests(unittest2.TestCase):
+    def test_generate_launch_specification(self):
+        launch_config = LaunchConfiguration.from_boto(get_boto_launch_config())
+        instance = Instance.from_boto(get_boto_instance())
+
+        launch_specification = generate_launch_specification(launch_config, instance)
+
+        self.assertEqual(launch_specification, {
+            'ImageId': 'ami-123',
+            'UserData': 'ZWNobyBoZWxsbw==',
+            'InstanceType': 'm3.medium',
+            'Placement': {'AvailabilityZone': 'eu-west-1a'},
+            'IamInstanceProfile': {'Name': 'the-profile'},
+            'Monitoring': {'Enabled': False},
+            'NetworkInterfaces': [{
+                'DeviceIndex': 0,
+                'Groups': ['sg-1'],
+                'SubnetId': 'subnet-1',
+                'AssociatePublicIpAddress': True}],
+            'BlockDeviceMappings': []})
+
+    def test_generate_launch_specification_optional_fields(self):
+        launch_config = LaunchConfiguration.from_boto(get_boto_launch_config(
+            KeyName='the-key', EbsOptimized=True,
+            IamInstanceProfile='arn:aws:iam::123:instance-profile/the-profile'))
+        instance = Instance.from_boto(get_boto_instance())
+
+        launch_specification = generate_launch_specification(launch_config, instance,
+                                                             new_instance_type='c4.large')
+
+        self.assertEqual(launch_specification['InstanceType'], 'c4.large')
+        self.assertEqual(launch_specification['KeyName'], 'the-key')
+        self.assertEqual(launch_specification['EbsOptimized'], True)
+        self.assertEqual(launch_specification['IamInstanceProfile'],
+                         {'Arn': 'arn:aws:iam::123:instance-profile/the-profile'})
+
+    def test_generate_launch_specification_without_profile_and_public_ip(self):
+        launch_config = LaunchConfiguration.from_launch_template_version({
+            'LaunchTemplateId': 'lt-1', 'VersionNumber': 1,
+            'LaunchTemplateData': {'ImageId': 'ami-123', 'InstanceType': 'm5.large'}})
+        instance = Instance.from_boto(get_boto_instance())
+
+        launch_specification = generate_launch_specification(launch_config, instance)
+
+        self.assertNotIn('IamInstanceProfile', launch_specification)
+        self.assertNotIn('AssociatePublicIpAddress', launch_specification['NetworkInterfaces'][0])
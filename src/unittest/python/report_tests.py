@@ -0,0 +1,132 @@
+from __future__ import print_function, absolute_import, division
+
+import os
+import shutil
+import tempfile
+import unittest2
+
+from datetime import datetime
+
+from mock import patch
+
+from spotnik.records import AutoScalingGroup, Instance
+from spotnik.report import (PriceTable, ReportBuilder, estimate_minutes_to_convergence, get_price_table,
+                            merge_summaries, summarize)
+
+NOW = datetime(2016, 1, 1, 12, 0)
+
+
+def get_instance(instance_id, lifecycle=None, launch_minute=0, instance_type='m5.large'):
+    return Instance(instance_id, lifecycle=lifecycle, launch_time=datetime(2016, 1, 1, 9, launch_minute),
+                    instance_type=instance_type)
+
+
+class EstimateConvergenceTests(unittest2.TestCase):
+    def test_converged_asg_needs_no_time(self):
+        self.assertEqual(estimate_minutes_to_convergence([], 0, NOW, 2), 0)
+        self.assertEqual(estimate_minutes_to_convergence([get_instance('i-1')], 1, NOW, 2), 0)
+
+    def test_instance_is_replaced_in_its_window(self):
+        # At 12:00, an instance launched at xx:10 is 50 minutes into its hour.
+        self.assertEqual(estimate_minutes_to_convergence([get_instance('i-1', launch_minute=10)], 0, NOW, 2), 2)
+        # One launched at xx:20 enters its window (46 minutes) at 12:06.
+        self.assertEqual(estimate_minutes_to_convergence([get_instance('i-1', launch_minute=20)], 0, NOW, 2), 8)
+
+    def test_instances_are_replaced_one_at_a_time(self):
+        instances = [get_instance('i-1', launch_minute=10), get_instance('i-2', launch_minute=10)]
+        self.assertEqual(estimate_minutes_to_convergence(instances, 0, NOW, 2), 4)
+
+    def test_pending_request_counts_as_replacement(self):
+        instances = [get_instance('i-1', launch_minute=10), get_instance('i-2', launch_minute=20)]
+        # i-1 is attached by the next run, i-2 is requested at 12:06 and attached at 12:08.
+        self.assertEqual(estimate_minutes_to_convergence(instances, 0, NOW, 2, replaced_instance_id='i-1',
+                                                         pending=True), 8)
+        # i-1 was attached in this run.
+        self.assertEqual(estimate_minutes_to_convergence(instances, 0, NOW, 2, replaced_instance_id='i-1'), 8)
+        self.assertEqual(estimate_minutes_to_convergence(instances[:1], 0, NOW, 2, replaced_instance_id='i-1'), 0)
+
+
+class GetPriceTableTests(unittest2.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def get_price_table(self, content=None):
+        path = os.path.join(self.tempdir, 'prices.json')
+        if content is not None:
+            with open(path, 'w') as price_file:
+                price_file.write(content)
+        with patch.dict('os.environ', {'SPOTNIK_PRICE_TABLE': path}):
+            return get_price_table()
+
+    def test_loads_price_table(self):
+        prices = self.get_price_table('{"eu-west-1": {"m5.large": {"on_demand": 0.1}}}')
+        self.assertEqual(prices.get('eu-west-1', 'm5.large', 'on_demand'), 0.1)
+
+    def test_missing_or_malformed_price_table_is_empty(self):
+        self.assertEqual(self.get_price_table().prices, {})
+        self.assertEqual(self.get_price_table('{"eu-west-1": ').prices, {})
+
+
+class ReportBuilderTests(unittest2.TestCase):
+    def setUp(self):
+        prices = PriceTable({'eu-west-1': {'m5.large': {'on_demand': 0.1, 'spot': 0.03},
+                                           'c5.large': {'on_demand': 0.09}}})
+        self.builder = ReportBuilder(prices, run_interval_minutes=2)
+        self.instances = dict((instance.instance_id, instance) for instance in [
+            get_instance('i-1', lifecycle='spot'),
+            get_instance('i-2', lifecycle='spot', instance_type='c5.large'),
+            get_instance('i-3', launch_minute=10),
+            get_instance('i-4', launch_minute=30)])
+
+    def test_report(self):
+        asg = AutoScalingGroup('the-asg', tags={'spotnik-bid-price': '0.05'},
+                               instance_ids=['i-1', 'i-2', 'i-3', 'i-4', 'i-gone'])
+
+        decision = {'action': 'requested', 'replaced_instance_id': 'i-3'}
+        report = self.builder.build('eu-west-1', asg, self.instances, decision, NOW)
+
+        self.assertEqual(report, {
+            'on_demand': 2,
+            'spot': 2,
+            'min_on_demand': 0,
+            'pending_requests': 1,
+            # 0.07 for the m5.large, 0.04 for the c5.large at the bid price.
+            'hourly_saving': 0.11,
+            'remaining_hourly_saving': 0.14,
+            # i-3 is attached at 12:02, i-4 requested at 12:16 and attached at 12:18.
+            'minutes_to_convergence': 18,
+        })
+
+    def test_missing_prices(self):
+        asg = AutoScalingGroup('the-asg', instance_ids=['i-2'])
+
+        report = self.builder.build('us-east-1', asg, self.instances, {'action': 'none'}, NOW)
+
+        self.assertIs(report['hourly_saving'], None)
+        self.assertEqual(report['pending_requests'], 0)
+
+    def test_summarize(self):
+        reports = [
+            {'on_demand': 2, 'spot': 1, 'pending_requests': 1, 'hourly_saving': 0.1,
+             'remaining_hourly_saving': 0.2, 'minutes_to_convergence': 30},
+            {'on_demand': 1, 'spot': 0, 'pending_requests': 0, 'hourly_saving': None,
+             'remaining_hourly_saving': None, 'minutes_to_convergence': None}]
+
+        summary = summarize([{'report': report} for report in reports] + [{'action': 'failed'}])
+
+        self.assertEqual(summary, {
+            'asgs': 2, 'on_demand': 3, 'spot': 1, 'pending_requests': 1, 'hourly_saving': 0.1,
+            'remaining_hourly_saving': 0.2, 'unconverging_asgs': 1, 'max_minutes_to_convergence': 30})
+
+    def test_merge_summaries(self):
+        summaries = [
+            {'asgs': 2, 'on_demand': 3, 'spot': 1, 'pending_requests': 1, 'hourly_saving': 0.1,
+             'remaining_hourly_saving': 0.2, 'unconverging_asgs': 1, 'max_minutes_to_convergence': 30},
+            {'asgs': 1, 'on_demand': 0, 'spot': 2, 'pending_requests': 0, 'hourly_saving': 0.2,
+             'remaining_hourly_saving': 0, 'unconverging_asgs': 0, 'max_minutes_to_convergence': 0}]
+
+        self.assertEqual(merge_summaries(summaries), {
+            'asgs': 3, 'on_demand': 3, 'spot': 3, 'pending_requests': 1, 'hourly_saving': 0.3,
+            'remaining_hourly_saving': 0.2, 'unconverging_asgs': 1, 'max_minutes_to_convergence': 30})
+        self.assertEqual(merge_summaries([]), summarize([]))
@@ -0,0 +1,175 @@
+from __future__ import print_function, absolute_import, division
+
+import time
+import unittest2
+
+from mock import Mock, patch
+
+from spotnik.main import coordinate, handler, run_worker
+from spotnik.records import AutoScalingGroup, Target
+from spotnik.report import summarize
+from spotnik.sharding import (COORDINATOR_MARGIN_SECONDS, WORKER_MARGIN_SECONDS, LocalDispatcher, compact_results,
+                              get_asg_shard_index, is_in_asg_shard, merge_results, plan_shards)
+
+REGIONS = ['region_one', 'region_two', 'region_three']
+
+
+class PlanShardsTests(unittest2.TestCase):
+    def test_one_shard_per_region_by_default(self):
+        events = plan_shards([Target()], 'region', REGIONS)
+        self.assertEqual([event['regions'] for event in events],
+                         [['region_one'], ['region_two'], ['region_three']])
+        self.assertTrue(all(event['worker'] for event in events))
+        self.assertEqual(events[0]['role_arns'], [])
+
+    def test_regions_are_distributed_over_shards(self):
+        events = plan_shards([Target()], 'region', REGIONS, shard_count=2)
+        self.assertEqual([event['regions'] for event in events],
+                         [['region_one', 'region_three'], ['region_two']])
+
+    def test_asg_hash_shards(self):
+        targets = [Target.from_role_arn('arn:aws:iam::111111111111:role/spotnik')]
+        events = plan_shards(targets, 'asg_hash', REGIONS, shard_count=3)
+
+        self.assertEqual([event['asg_shard'] for event in events], [[0, 3], [1, 3], [2, 3]])
+        self.assertEqual(events[0]['role_arns'], ['arn:aws:iam::111111111111:role/spotnik'])
+        self.assertRaises(ValueError, plan_shards, targets, 'asg_hash', REGIONS)
+
+    def test_workers_stop_before_the_coordinator(self):
+        events = plan_shards([Target()], 'region', REGIONS, deadline=1000)
+        self.assertEqual([event['deadline'] for event in events], [1000 - WORKER_MARGIN_SECONDS] * 3)
+        self.assertNotIn('deadline', plan_shards([Target()], 'region', REGIONS)[0])
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, plan_shards, [Target()], 'random', REGIONS)
+
+    def test_every_asg_is_in_exactly_one_shard(self):
+        for name in ('foo', 'bar', 'baz', u'\xe4sg'):
+            shards = [index for index in range(4) if is_in_asg_shard(name, (index, 4))]
+            self.assertEqual(shards, [get_asg_shard_index(name, 4)])
+        self.assertTrue(is_in_asg_shard('foo', None))
+
+
+def get_summary(asgs=0, **kwargs):
+    return dict(summarize([]), asgs=asgs, **kwargs)
+
+
+class MergeResultsTests(unittest2.TestCase):
+    def test_merge_results(self):
+        shard_results = [
+            {'local': {'regions': ['region_one'], 'errors': [], 'summary': get_summary(2, hourly_saving=0.1)}},
+            {'local': {'regions': ['region_two'], 'errors': ['region_two: boom'],
+                       'summary': get_summary(1, hourly_saving=0.2)}},
+            Exception("timeout"),
+        ]
+        merged = merge_results([Target()], shard_results)
+
+        self.assertEqual(merged, {'local': {
+            'regions': ['region_one', 'region_two'],
+            'decisions': [],
+            'errors': ['region_two: boom', 'shard 2: timeout'],
+            'summary': get_summary(3, hourly_saving=0.3)}})
+
+    def test_compact_results_drops_decisions(self):
+        results = {'local': {'regions': ['region_one'], 'decisions': [{'asg': 'foo'}], 'errors': [],
+                             'summary': get_summary(1)}}
+
+        self.assertEqual(compact_results(results), {'local': {
+            'regions': ['region_one'], 'errors': [], 'summary': get_summary(1)}})
+
+
+class CoordinatorTests(unittest2.TestCase):
+    @patch("spotnik.main.get_aws_region_names")
+    def test_coordinate_dispatches_shards_and_merges_results(self, mock_get_aws_region_names):
+        mock_get_aws_region_names.return_value = REGIONS
+        dispatcher = Mock()
+        dispatcher.dispatch.side_effect = lambda events: [
+            {'local': {'regions': event['regions'], 'errors': [], 'summary': get_summary()}} for event in events]
+
+        results = coordinate([Target()], dispatcher, 'region', shard_count=2)
+
+        self.assertEqual(len(dispatcher.dispatch.call_args[0][0]), 2)
+        self.assertEqual(sorted(results['local']['regions']), sorted(REGIONS))
+
+    @patch("spotnik.main.get_aws_region_names")
+    def test_coordinate_covers_regions_of_all_accounts(self, mock_get_aws_region_names):
+        targets = [Target(), Target.from_role_arn('arn:aws:iam::111111111111:role/spotnik')]
+        mock_get_aws_region_names.side_effect = lambda role_arn=None: REGIONS[:2] if role_arn else REGIONS[1:]
+        dispatcher = Mock()
+        dispatcher.dispatch.side_effect = lambda events: [
+            dict((target.account_id, {'regions': [], 'errors': [], 'summary': get_summary()})
+                 for target in targets) for event in events]
+
+        coordinate(targets, dispatcher, 'region')
+
+        self.assertEqual(sorted(event['regions'][0] for event in dispatcher.dispatch.call_args[0][0]),
+                         sorted(REGIONS))
+
+    @patch("spotnik.main.get_aws_region_names")
+    def test_coordinate_reports_accounts_without_regions(self, mock_get_aws_region_names):
+        targets = [Target(), Target.from_role_arn('arn:aws:iam::111111111111:role/spotnik')]
+
+        def get_aws_region_names(role_arn=None):
+            if role_arn:
+                raise Exception("AccessDenied")
+            return REGIONS
+        mock_get_aws_region_names.side_effect = get_aws_region_names
+        dispatcher = Mock()
+        dispatcher.dispatch.side_effect = lambda events: [{} for event in events]
+
+        with self.assertRaises(Exception):
+            coordinate(targets, dispatcher, 'region')
+        self.assertEqual(len(dispatcher.dispatch.call_args[0][0]), 3)
+
+    @patch("spotnik.main.get_aws_region_names")
+    def test_coordinate_fails_if_a_shard_fails(self, mock_get_aws_region_names):
+        mock_get_aws_region_names.return_value = REGIONS
+        dispatcher = Mock()
+        dispatcher.dispatch.return_value = [Exception("boom")]
+
+        self.assertRaises(Exception, coordinate, [Target()], dispatcher, 'region', 1)
+
+    @patch("spotnik.main.get_aws_region_names")
+    @patch("spotnik.main.Spotnik")
+    def test_worker_only_processes_its_shard(self, mock_spotnik, mock_get_aws_region_names):
+        mock_get_aws_region_names.return_value = REGIONS
+        asgs = [AutoScalingGroup(name) for name in ('foo', 'bar', 'baz', 'qux')]
+        mock_spotnik.get_spotnik_asgs.return_value = asgs
+        mock_spotnik.return_value.get_pending_spot_resources.return_value = None, None
+
+        results = run_worker({'worker': True, 'regions': ['region_two'], 'asg_shard': [1, 2]})
+
+        self.assertEqual(results['local']['regions'], ['region_two'])
+        expected = [asg.name for asg in asgs if get_asg_shard_index(asg.name, 2) == 1]
+        self.assertEqual(results['local']['summary']['asgs'], len(expected))
+        self.assertNotIn('decisions', results['local'])
+
+    @patch("spotnik.main.get_aws_region_names")
+    @patch("spotnik.main.Spotnik")
+    def test_worker_skips_asgs_after_its_deadline(self, mock_spotnik, mock_get_aws_region_names):
+        mock_get_aws_region_names.return_value = REGIONS
+        mock_spotnik.get_spotnik_asgs.return_value = [AutoScalingGroup('foo'), AutoScalingGroup('bar')]
+
+        results = run_worker({'worker': True, 'regions': ['region_two'], 'deadline': time.time() - 1})
+
+        self.assertEqual(results['local']['errors'], ["skipped 2 ASGs, the run's deadline passed"])
+        self.assertFalse(mock_spotnik.return_value.get_pending_spot_resources.called)
+
+    @patch("spotnik.main.coordinate")
+    @patch.dict("os.environ", {'SPOTNIK_SHARD_STRATEGY': 'region', 'AWS_LAMBDA_FUNCTION_NAME': 'spotnik'})
+    def test_handler_passes_remaining_time_to_coordinator(self, mock_coordinate):
+        context = Mock()
+        context.get_remaining_time_in_millis.return_value = 60000
+
+        handler({}, context)
+
+        deadline = mock_coordinate.call_args[1]['deadline']
+        self.assertAlmostEqual(deadline, time.time() + 60 - COORDINATOR_MARGIN_SECONDS, delta=5)
+        self.assertEqual(mock_coordinate.call_args[0][1].deadline, deadline)
+
+
+class LocalDispatcherTests(unittest2.TestCase):
+    @patch("spotnik.sharding._run_worker_event", len)
+    def test_dispatch_runs_events_in_processes(self):
+        # multiprocessing pickles functions by name, so patch with a builtin.
+        self.assertEqual(LocalDispatcher(processes=2).dispatch([[1], [1, 2], []]), [1, 2, 0])
@@ -0,0 +1,92 @@
+from __future__ import print_function, absolute_import, division
+
+import os
+import shutil
+import tempfile
+import unittest2
+
+import numpy as np
+
+from spotnik.simulator import FleetTrace, Settings, simulate
+
+ON_DEMAND_PRICE = 0.1
+# Six hours of spotnik runs every two minutes.
+NUM_STEPS = 180
+
+
+def make_trace(spot_price=0.02, desired=2, num_asgs=1):
+    spot_prices = np.full((num_asgs, NUM_STEPS), spot_price)
+    desired_capacity = np.full((num_asgs, NUM_STEPS), desired)
+    return FleetTrace(spot_prices, np.full(num_asgs, ON_DEMAND_PRICE), desired_capacity)
+
+
+class SimulatorTests(unittest2.TestCase):
+    def test_fleet_converges_to_spot_below_bid(self):
+        report, = simulate(make_trace(), [Settings(bid_price=0.05)])
+
+        self.assertEqual(report['converged_ratio'], 1.0)
+        # Every on-demand instance is replaced within its first billing hour.
+        self.assertLessEqual(report['max_convergence_minutes'], 2 * 60)
+        self.assertGreater(report['savings_ratio'], 0.5)
+        self.assertEqual(report['interruptions'], 0)
+
+    def test_nothing_is_replaced_above_bid(self):
+        report, = simulate(make_trace(spot_price=0.5), [Settings(bid_price=0.05)])
+
+        self.assertEqual(report['converged_ratio'], 0.0)
+        self.assertIs(report['median_convergence_minutes'], None)
+        self.assertAlmostEqual(report['savings'], 0.0)
+
+    def test_min_on_demand_is_kept(self):
+        settings = [Settings(0.05, min_on_demand=1), Settings(0.05, min_on_demand=0)]
+        on_demand, spot_only = simulate(make_trace(desired=3), settings)
+
+        self.assertEqual(on_demand['converged_ratio'], 1.0)
+        self.assertLess(on_demand['savings'], spot_only['savings'])
+        # Two of three instances are spot, the rest stays on-demand.
+        expected_cost = (ON_DEMAND_PRICE + 2 * 0.02) * NUM_STEPS * 2 / 60
+        self.assertLess(on_demand['cost'], expected_cost * 1.5)
+
+    def test_price_spike_interrupts_spot_instances(self):
+        trace = make_trace()
+        trace.spot_prices[0, 120:125] = 1.0
+
+        cheap_bid, high_bid = simulate(trace, [Settings(0.05), Settings(2.0)])
+
+        self.assertEqual(cheap_bid['interruptions'], 2)
+        self.assertEqual(high_bid['interruptions'], 0)
+        self.assertGreater(cheap_bid['interruptions_per_spot_hour'], 0)
+
+    def test_scaling_in_terminates_instances(self):
+        trace = make_trace(desired=4)
+        trace.desired_capacity[0, 60:] = 1
+
+        report, = simulate(trace, [Settings(0.05)])
+
+        # Four instances for two hours, then one instance for four hours.
+        expected_on_demand_cost = (4 * 2 + 1 * 4) * ON_DEMAND_PRICE
+        self.assertAlmostEqual(report['on_demand_cost'], expected_on_demand_cost)
+
+    def test_wider_window_converges_faster(self):
+        trace = make_trace(desired=5, num_asgs=20)
+        narrow, wide = simulate(trace, [Settings(0.05, window=(45, 55)), Settings(0.05, window=(0, 60))])
+
+        self.assertLess(wide['median_convergence_minutes'], narrow['median_convergence_minutes'])
+
+    def test_trace_save_and_load(self):
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        path = os.path.join(tempdir, 'trace.npz')
+        trace = make_trace(num_asgs=2)
+
+        trace.save(path)
+        loaded = FleetTrace.load(path)
+
+        np.testing.assert_array_equal(loaded.spot_prices, trace.spot_prices)
+        np.testing.assert_array_equal(loaded.desired_capacity, trace.desired_capacity)
+        self.assertEqual(loaded.asg_names, ['asg-0', 'asg-1'])
+        self.assertEqual(loaded.step_minutes, 2)
+
+    def test_trace_validates_shapes(self):
+        self.assertRaises(ValueError, FleetTrace, np.zeros((2, 3)), np.zeros(2), np.zeros((2, 4)))
+        self.assertRaises(ValueError, FleetTrace, np.zeros((2, 3)), np.zeros(3), np.zeros((2, 3)))
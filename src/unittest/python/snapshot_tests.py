@@ -0,0 +1,141 @@
+from __future__ import print_function, absolute_import, division
+
+import gzip
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest2
+import zipfile
+
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from datetime import datetime
+from dateutil.tz import tzutc
+
+from spotnik import aws, util
+from spotnik.main import main
+from spotnik.snapshot import SnapshotMissError, capture, replay
+
+REGIONS_RESPONSE = {'Regions': [{'RegionName': 'eu-west-1', 'Endpoint': 'ec2.eu-west-1.amazonaws.com'}]}
+INSTANCES_RESPONSE = {'Reservations': [{'Instances': [
+    {'InstanceId': 'i-1', 'LaunchTime': datetime(2016, 1, 1, 12, 0, tzinfo=tzutc())}]}]}
+
+
+class SnapshotTests(unittest2.TestCase):
+    def setUp(self):
+        aws.reset()
+        tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tempdir)
+        self.path = os.path.join(tempdir, 'snapshot.zip')
+
+    def tearDown(self):
+        aws.reset()
+
+    def capture_calls(self, stubbed_calls):
+        """Capture the given (client, method, response, params) calls"""
+        with capture(self.path):
+            stubbers = {}
+            for service_name, region_name, method, response, params in stubbed_calls:
+                client = aws.get_client(service_name, region_name)
+                if client not in stubbers:
+                    stubbers[client] = Stubber(client)
+                    stubbers[client].activate()
+                stubbers[client].add_response(method, response, params)
+                getattr(client, method)(**params)
+
+    def test_capture_writes_one_stream_per_region(self):
+        self.capture_calls([
+            ('ec2', 'eu-west-1', 'describe_regions', REGIONS_RESPONSE, {}),
+            ('ec2', 'us-east-1', 'describe_instances', INSTANCES_RESPONSE, {'InstanceIds': ['i-1']}),
+        ])
+
+        with zipfile.ZipFile(self.path) as snapshot:
+            self.assertEqual(sorted(snapshot.namelist()),
+                             ['local/eu-west-1.jsonl.gz', 'local/us-east-1.jsonl.gz', 'snapshot.json'])
+
+    def test_replay_returns_captured_responses(self):
+        self.capture_calls([
+            ('ec2', 'us-east-1', 'describe_instances', INSTANCES_RESPONSE, {'InstanceIds': ['i-1']}),
+        ])
+
+        with replay(self.path):
+            response = aws.get_client('ec2', 'us-east-1').describe_instances(InstanceIds=['i-1'])
+
+        self.assertEqual(response['Reservations'], INSTANCES_RESPONSE['Reservations'])
+
+    def test_replay_matches_parameters(self):
+        self.capture_calls([
+            ('ec2', 'us-east-1', 'describe_instances', INSTANCES_RESPONSE, {'InstanceIds': ['i-1']}),
+        ])
+
+        with replay(self.path):
+            client = aws.get_client('ec2', 'us-east-1')
+            self.assertRaises(SnapshotMissError, client.describe_instances, InstanceIds=['i-2'])
+            self.assertRaises(SnapshotMissError, aws.get_client('ec2', 'eu-west-1').describe_instances,
+                              InstanceIds=['i-1'])
+
+    def test_replay_raises_captured_errors(self):
+        with capture(self.path):
+            client = aws.get_client('ec2', 'eu-west-1')
+            with Stubber(client) as stubber:
+                stubber.add_client_error('describe_regions', service_error_code='UnauthorizedOperation',
+                                         http_status_code=403)
+                self.assertRaises(ClientError, client.describe_regions)
+
+        with replay(self.path):
+            self.assertRaises(ClientError, aws.get_client('ec2', 'eu-west-1').describe_regions)
+
+    def test_replay_pins_time_and_seed_of_capture(self):
+        with capture(self.path):
+            captured = util.utcnow(), util.get_random('the-asg').random()
+
+        with replay(self.path):
+            self.assertEqual((util.utcnow(), util.get_random('the-asg').random()), captured)
+            self.assertNotEqual(util.get_random('other-asg').random(), captured[1])
+        self.assertIs(util.get_random('the-asg'), random)
+
+    def test_unrecorded_mutating_calls_are_no_ops(self):
+        self.capture_calls([
+            ('ec2', 'eu-west-1', 'create_tags', {},
+             {'Resources': ['sir-1'], 'Tags': [{'Key': 'spotnik', 'Value': 'asg'}]}),
+        ])
+
+        with replay(self.path):
+            client = aws.get_client('ec2', 'eu-west-1')
+            client.create_tags(Resources=['sir-2'], Tags=[{'Key': 'spotnik', 'Value': 'asg'}])
+            response = client.request_spot_instances(SpotPrice='0.1', LaunchSpecification={})
+            self.assertRaises(SnapshotMissError, client.describe_instances, InstanceIds=['i-1'])
+
+        self.assertEqual(response['SpotInstanceRequests'][0]['SpotInstanceRequestId'], 'sir-replayed')
+
+    def test_credentials_are_not_captured(self):
+        credentials = {'AccessKeyId': 'AKIDTHESECRETKEY', 'SecretAccessKey': 'the-secret', 'SessionToken': 'the-token',
+                       'Expiration': datetime(2016, 1, 1, 12, 0, tzinfo=tzutc())}
+        params = {'RoleArn': 'arn:aws:iam::123456789012:role/spotnik', 'RoleSessionName': 'spotnik'}
+        self.capture_calls([
+            ('sts', aws.DEFAULT_REGION, 'assume_role', {'Credentials': credentials}, params),
+        ])
+
+        with zipfile.ZipFile(self.path) as snapshot:
+            content = b''.join(gzip.GzipFile(fileobj=io.BytesIO(snapshot.read(name))).read()
+                               for name in snapshot.namelist() if name.endswith('.gz'))
+        for secret in ('AKIDTHESECRETKEY', 'the-secret', 'the-token'):
+            self.assertNotIn(secret.encode('utf-8'), content)
+
+        with replay(self.path):
+            response = aws.get_client('sts', aws.DEFAULT_REGION).assume_role(**params)
+        self.assertEqual(response['Credentials']['AccessKeyId'], 'SNAPSHOT')
+        self.assertGreater(response['Credentials']['Expiration'], datetime.now(tzutc()))
+
+    def test_main_replays_a_run(self):
+        self.capture_calls([
+            ('ec2', aws.DEFAULT_REGION, 'describe_regions', REGIONS_RESPONSE, {}),
+            ('autoscaling', 'eu-west-1', 'describe_auto_scaling_groups', {'AutoScalingGroups': []}, {}),
+        ])
+
+        results = main(replay_path=self.path)
+
+        self.assertEqual(results['local']['regions'], ['eu-west-1'])
+        self.assertEqual(results['local']['errors'], [])
@@ -4,9 +4,12 @@ import unittest2
 
 from datetime import datetime, timedelta
 
-from mock import Mock
+from mock import Mock, patch
 
-from spotnik.spotnik import _boto_tags_to_dict, ReplacementPolicy
+from spotnik.records import AutoScalingGroup, Instance, SpotRequest
+from spotnik.replacement_policy import ReplacementPolicy
+from spotnik.spotnik import Spotnik
+from spotnik.util import _boto_tags_to_dict, _dict_to_boto_tags
 
 class SpotnikTests(unittest2.TestCase):
     def test_boto_tag_conversion(self):
@@ -18,11 +21,17 @@ class SpotnikTests(unittest2.TestCase):
         expected_tags = {}
         self.assertEqual(_boto_tags_to_dict(boto_tags), expected_tags)
 
+    def test_dict_to_boto_tag_conversion(self):
+        tags = {'foo': 'bar', 'ham': 'spam'}
+        self.assertEqual(_boto_tags_to_dict(_dict_to_boto_tags(tags)), tags)
+        self.assertEqual(_dict_to_boto_tags({}), [])
+
 
 class ReplacementPolicyTests(unittest2.TestCase):
     def setUp(self):
-        self.fake_asg = {'AutoScalingGroupName': 'thename', 'Tags': []}
+        self.fake_asg = AutoScalingGroup('thename')
         self.fake_spotnik = Mock()
+        self.fake_spotnik.decision = {}
         self.policy = ReplacementPolicy(self.fake_asg, self.fake_spotnik)
         self.policy._should_instance_be_replaced_now = self.policy.should_instance_be_replaced_now
         self.policy.should_instance_be_replaced_now = lambda x: True
@@ -30,6 +39,8 @@ class ReplacementPolicyTests(unittest2.TestCase):
     def test_is_replacement_needed_all_spot_no_on_demand(self):
         self.policy.get_instances = lambda: ([], ['spot1', 'spot2'])
         self.assertEqual(self.policy.is_replacement_needed(), False)
+        self.assertEqual(self.fake_spotnik.decision,
+                         {'on_demand': 0, 'spot': 2, 'min_on_demand': 0, 'reason': 'all_spot'})
 
     def test_is_replacement_needed_some_spot_some_on_demand(self):
         self.policy.get_instances = lambda: (['od1', 'od2'], ['spot1', 'spot2'])
@@ -40,16 +51,14 @@ class ReplacementPolicyTests(unittest2.TestCase):
         self.assertEqual(self.policy.is_replacement_needed(), True)
 
     def test_is_replacement_needed_min_on_demand_reached(self):
-        fake_asg = {'AutoScalingGroupName': 'thename',
-                    'Tags': [{'Key': 'spotnik-min-on-demand-instances', 'Value': '2'}]}
+        fake_asg = AutoScalingGroup('thename', tags={'spotnik-min-on-demand-instances': '2'})
         self.policy = ReplacementPolicy(fake_asg, self.fake_spotnik)
 
         self.policy.get_instances = lambda: (['od1', 'od2'], ['spot1'])
         self.assertEqual(self.policy.is_replacement_needed(), False)
 
     def test_is_replacement_needed_min_on_demand_not_reached(self):
-        fake_asg = {'AutoScalingGroupName': 'thename',
-                    'Tags': [{'Key': 'spotnik-min-on-demand-instances', 'Value': '2'}]}
+        fake_asg = AutoScalingGroup('thename', tags={'spotnik-min-on-demand-instances': '2'})
         self.policy = ReplacementPolicy(fake_asg, self.fake_spotnik)
         self.policy.should_instance_be_replaced_now = lambda x: True
 
@@ -63,9 +72,9 @@ class ReplacementPolicyTests(unittest2.TestCase):
         ten_minutes_ago = now - timedelta(minutes=10)
         fifty_minutes_ago = now -timedelta(minutes=50)
         # This instance should not be replaced.
-        new_instance = {'InstanceId': 'aaa', 'LaunchTime': ten_minutes_ago}
+        new_instance = Instance('aaa', launch_time=ten_minutes_ago)
         # This instance should be replaced
-        old_instance = {'InstanceId': 'aaa', 'LaunchTime': fifty_minutes_ago}
+        old_instance = Instance('aaa', launch_time=fifty_minutes_ago)
 
         self.policy.get_instances = Mock()
         self.policy.get_instances.return_value = [new_instance, old_instance], []
@@ -77,22 +86,29 @@ class ReplacementPolicyTests(unittest2.TestCase):
         self.policy.should_instance_be_replaced_now = lambda x: False
 
         self.assertEqual(self.policy.is_replacement_needed(), False)
+        self.assertEqual(self.fake_spotnik.decision['reason'], 'no_instance_old_enough')
 
     def test_should_instance_be_replaced_now(self):
         self.policy.should_instance_be_replaced_now = self.policy._should_instance_be_replaced_now
 
-        instance = {'LaunchTime': datetime.now()}
+        instance = Instance('aaa', launch_time=datetime.now())
         self.assertFalse(self.policy.should_instance_be_replaced_now(instance))
-        instance = {'LaunchTime': datetime.now() - timedelta(minutes=47)}
+        instance = Instance('aaa', launch_time=datetime.now() - timedelta(minutes=47))
         self.assertTrue(self.policy.should_instance_be_replaced_now(instance))
-        instance = {'LaunchTime': datetime.now() - timedelta(minutes=57)}
+        instance = Instance('aaa', launch_time=datetime.now() - timedelta(minutes=57))
         self.assertFalse(self.policy.should_instance_be_replaced_now(instance))
 
     def test_decide_instance_type_defaults_to_none(self):
         self.assertIs(self.policy._decide_instance_type(), None)
 
+    def test_decide_instance_type_uses_mixed_instances_policy(self):
+        fake_asg = AutoScalingGroup('thename', instance_types=['m5.large', 'c5.large'])
+        self.policy = ReplacementPolicy(fake_asg, self.fake_spotnik)
+
+        self.assertIn(self.policy._decide_instance_type(), ('m5.large', 'c5.large'))
+
     def test_decide_instance_type_uses_tag(self):
-        self.fake_asg['Tags'] = [{'Key': 'spotnik-instance-type', 'Value': 'm3.large'}]
+        self.fake_asg.tags = {'spotnik-instance-type': 'm3.large'}
         self.policy = ReplacementPolicy(self.fake_asg, self.fake_spotnik)
 
         self.assertEqual(self.policy._decide_instance_type(), "m3.large")
@@ -101,9 +117,164 @@ class ReplacementPolicyTests(unittest2.TestCase):
         # Must be tolerant towards the separator:
         config = "ham, spam,eggs bacon"
 
-        self.fake_asg['Tags'] = [{'Key': 'spotnik-instance-type', 'Value': config}]
+        self.fake_asg.tags = {'spotnik-instance-type': config}
         self.policy = ReplacementPolicy(self.fake_asg, self.fake_spotnik)
 
         self.assertIn(self.policy._decide_instance_type(),
                       ("ham", "spam", "eggs", "bacon"))
 
+    def test_decide_instance_type_avoids_risky_pools(self):
+        fake_asg = AutoScalingGroup('thename', instance_types=['m5.large', 'c5.large'])
+        self.fake_spotnik.interruption_tracker.is_risky.side_effect = lambda pool: pool[1] == 'm5.large'
+        self.policy = ReplacementPolicy(fake_asg, self.fake_spotnik)
+
+        for _ in range(10):
+            self.assertEqual(self.policy._decide_instance_type('eu-west-1a'), 'c5.large')
+
+
+class RebalanceTests(unittest2.TestCase):
+    def setUp(self):
+        self.fake_asg = AutoScalingGroup('thename', tags={'spotnik-bid-price': '0.1'},
+                                         instance_types=['m5.large', 'c5.large'])
+        self.fake_spotnik = Mock()
+        self.fake_spotnik.decision = {}
+        self.risky_pools = set()
+        self.fake_spotnik.interruption_tracker.is_risky.side_effect = lambda pool: pool in self.risky_pools
+        self.fake_spotnik.launch_spec_builder.build.side_effect = (
+            lambda asg, instance, instance_type: {'InstanceType': instance_type})
+        self.policy = ReplacementPolicy(self.fake_asg, self.fake_spotnik)
+        self.instance = Instance('i-1', lifecycle='spot', availability_zone='eu-west-1a',
+                                 instance_type='m5.large')
+
+    def test_no_rebalance_without_risky_pool(self):
+        self.assertIs(self.policy.decide_rebalance([self.instance]), None)
+
+    def test_instance_is_moved_to_safe_pool(self):
+        self.risky_pools.add(('eu-west-1a', 'm5.large'))
+
+        launch_specification, replaced_instance, bid_price = self.policy.decide_rebalance([self.instance])
+
+        self.assertEqual(launch_specification, {'InstanceType': 'c5.large'})
+        self.assertIs(replaced_instance, self.instance)
+        self.assertEqual(bid_price, '0.1')
+
+    def test_no_rebalance_without_safe_pool(self):
+        self.risky_pools.update([('eu-west-1a', 'm5.large'), ('eu-west-1a', 'c5.large')])
+
+        self.assertIs(self.policy.decide_rebalance([self.instance]), None)
+        self.assertEqual(self.fake_spotnik.decision['reason'], 'no_safe_pool')
+
+
+class InstanceSnapshotTests(unittest2.TestCase):
+    @patch("spotnik.spotnik.get_client")
+    def test_snapshot_describes_instances_in_chunks(self, mock_get_client):
+        ec2_client = mock_get_client.return_value
+        ec2_client.describe_instances.side_effect = lambda **kwargs: {'Reservations': [{'Instances': [
+            {'InstanceId': instance_id} for instance_id in kwargs['Filters'][0]['Values']]}]}
+        asgs = [AutoScalingGroup('one', instance_ids=['i-%03d' % index for index in range(150)]),
+                AutoScalingGroup('two', instance_ids=['i-%03d' % index for index in range(100, 250)])]
+
+        instances = Spotnik.get_instance_snapshot('eu-west-1', asgs)
+
+        self.assertEqual(len(instances), 250)
+        self.assertEqual(instances['i-042'], Instance('i-042'))
+        self.assertEqual(ec2_client.describe_instances.call_count, 2)
+
+    @patch("spotnik.spotnik.get_client")
+    def test_get_spotnik_asgs_reads_all_pages(self, mock_get_client):
+        paginator = mock_get_client.return_value.get_paginator.return_value
+        paginator.paginate.return_value = [
+            {'AutoScalingGroups': [{'AutoScalingGroupName': 'one', 'Tags': [{'Key': 'spotnik', 'Value': ''}]},
+                                   {'AutoScalingGroupName': 'other', 'Tags': []}]},
+            {'AutoScalingGroups': [{'AutoScalingGroupName': 'two', 'Tags': [{'Key': 'spotnik', 'Value': ''}]}]}]
+
+        asgs = Spotnik.get_spotnik_asgs('eu-west-1')
+
+        self.assertEqual([asg.name for asg in asgs], ['one', 'two'])
+        mock_get_client.return_value.get_paginator.assert_called_once_with('describe_auto_scaling_groups')
+
+    @patch("spotnik.spotnik.get_client")
+    def test_describe_instance_uses_snapshot(self, mock_get_client):
+        asg = AutoScalingGroup('one', instance_ids=['i-1'])
+        spotnik = Spotnik('eu-west-1', asg, logger=Mock(), instances={'i-1': Instance('i-1')})
+
+        self.assertEqual(spotnik.describe_instance('i-1'), Instance('i-1'))
+        self.assertFalse(mock_get_client.return_value.describe_instances.called)
+
+
+class AttachRebalanceTests(unittest2.TestCase):
+    def setUp(self):
+        patcher = patch("spotnik.spotnik.get_client")
+        self.mock_get_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.spot_request = SpotRequest('sir-1', tags={'spotnik': 'the-asg', 'spotnik-will-replace': 'i-gone',
+                                                       'spotnik-rebalance': 'interruption_warning'})
+
+    def get_spotnik(self, min_on_demand):
+        asg = AutoScalingGroup('the-asg', instance_ids=['i-1', 'i-2'], max_size=2,
+                               tags={'spotnik-min-on-demand-instances': str(min_on_demand)})
+        instances = {'i-1': Instance('i-1'), 'i-2': Instance('i-2', lifecycle='spot')}
+        return Spotnik('eu-west-1', asg, logger=Mock(), instances=instances)
+
+    def test_replaces_on_demand_instance(self):
+        spotnik = self.get_spotnik(min_on_demand=0)
+
+        self.assertTrue(spotnik.attach_spot_instance('i-new', self.spot_request))
+
+        spotnik.asg_client.detach_instances.assert_called_once_with(
+            InstanceIds=['i-1'], AutoScalingGroupName='the-asg', ShouldDecrementDesiredCapacity=True)
+
+    def test_respects_min_on_demand(self):
+        spotnik = self.get_spotnik(min_on_demand=1)
+
+        self.assertFalse(spotnik.attach_spot_instance('i-new', self.spot_request))
+
+        self.assertFalse(spotnik.asg_client.attach_instances.called)
+        spotnik.ec2_client.terminate_instances.assert_called_once_with(InstanceIds=['i-new'])
+        self.assertEqual(spotnik.decision['reason'], 'min_on_demand_reached')
+
+    def test_terminating_instance_is_gone(self):
+        spotnik = self.get_spotnik(min_on_demand=0)
+        spot_request = SpotRequest('sir-1', tags={'spotnik': 'the-asg', 'spotnik-will-replace': 'i-2',
+                                                  'spotnik-rebalance': 'interruption_warning'})
+        spotnik.asg.lifecycle_states['i-2'] = 'Terminating:Wait'
+        self.assertTrue(spotnik.is_instance_gone('i-2'))
+        spotnik.asg.lifecycle_states['i-2'] = 'InService'
+        spotnik.instances['i-2'] = Instance('i-2', lifecycle='spot', state='shutting-down')
+
+        self.assertTrue(spotnik.attach_spot_instance('i-new', spot_request))
+
+        spotnik.asg_client.detach_instances.assert_called_once_with(
+            InstanceIds=['i-1'], AutoScalingGroupName='the-asg', ShouldDecrementDesiredCapacity=True)
+        self.assertFalse(spotnik.is_instance_gone('i-1'))
+
+
+class RiskyPoolTagTests(unittest2.TestCase):
+    def setUp(self):
+        patcher = patch("spotnik.spotnik.get_client")
+        self.mock_get_client = patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch("spotnik.interruptions.utcnow", return_value=datetime(2017, 7, 14, 2, 40))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_interruption_is_tagged_on_the_asg(self):
+        asg = AutoScalingGroup('the-asg', tags={'spotnik-risky-pools': 'eu-west-1b/c5.large/1499999000'})
+        spotnik = Spotnik('eu-west-1', asg, logger=Mock())
+
+        spotnik.tag_risky_pool(('eu-west-1a', 'm5.large'), 1500000000)
+
+        spotnik.asg_client.create_or_update_tags.assert_called_once_with(Tags=[{
+            'ResourceId': 'the-asg', 'ResourceType': 'auto-scaling-group', 'Key': 'spotnik-risky-pools',
+            'Value': 'eu-west-1a/m5.large/1500000000 eu-west-1b/c5.large/1499999000', 'PropagateAtLaunch': False}])
+
+    @patch("spotnik.spotnik.get_interruption_tracker")
+    def test_tagged_pools_are_recorded(self, mock_get_interruption_tracker):
+        asgs = [AutoScalingGroup('one', tags={'spotnik-risky-pools': 'eu-west-1a/m5.large/1500000000'}),
+                AutoScalingGroup('two')]
+
+        Spotnik.record_reported_pools('eu-west-1', asgs, role_arn='the-role')
+
+        mock_get_interruption_tracker.assert_called_once_with('eu-west-1', role_arn='the-role')
+        mock_get_interruption_tracker.return_value.record.assert_called_once_with(
+            ('eu-west-1a', 'm5.large'), 1500000000)
@@ -0,0 +1,89 @@
+from __future__ import print_function, absolute_import, division
+
+import threading
+import unittest2
+
+from botocore.exceptions import ClientError
+from mock import Mock, patch
+
+from spotnik.tagging import TagQueue, drain_tag_queues, get_tag_queue
+
+
+def not_found_error(message):
+    return ClientError({'Error': {'Code': 'InvalidSpotInstanceRequestID.NotFound', 'Message': message}},
+                       'CreateTags')
+
+
+class TagQueueTests(unittest2.TestCase):
+    def setUp(self):
+        self.ec2_client = Mock()
+        self.queue = TagQueue(self.ec2_client, linger=0.05, base_delay=0.01, max_attempts=3)
+
+    def test_operations_with_same_tags_are_merged(self):
+        self.queue.create_tags(['sir-2'], [{'Key': 'spotnik', 'Value': 'asg'}])
+        self.queue.create_tags(['sir-1'], [{'Key': 'spotnik', 'Value': 'asg'}])
+        self.queue.create_tags(['sir-3'], [{'Key': 'spotnik', 'Value': 'other'}])
+        self.queue.delete_tags(['sir-4'], [{'Key': 'spotnik'}])
+
+        self.assertEqual(self.queue.close(), [])
+
+        self.ec2_client.create_tags.assert_any_call(
+            Resources=['sir-1', 'sir-2'], Tags=[{'Key': 'spotnik', 'Value': 'asg'}])
+        self.ec2_client.create_tags.assert_any_call(
+            Resources=['sir-3'], Tags=[{'Key': 'spotnik', 'Value': 'other'}])
+        self.assertEqual(self.ec2_client.create_tags.call_count, 2)
+        self.ec2_client.delete_tags.assert_called_once_with(Resources=['sir-4'], Tags=[{'Key': 'spotnik'}])
+
+    def test_only_missing_resources_are_retried(self):
+        self.ec2_client.create_tags.side_effect = [
+            not_found_error("The spot instance request ID 'sir-2' does not exist"), None, None]
+
+        self.queue.create_tags(['sir-1', 'sir-2'], [{'Key': 'spotnik', 'Value': 'asg'}])
+
+        self.assertEqual(self.queue.close(), [])
+        resources = [call[1]['Resources'] for call in self.ec2_client.create_tags.call_args_list]
+        self.assertEqual(resources, [['sir-1', 'sir-2'], ['sir-1'], ['sir-2']])
+
+    def test_gives_up_after_max_attempts(self):
+        self.ec2_client.create_tags.side_effect = not_found_error("does not exist")
+
+        self.queue.create_tags(['sir-1'], [{'Key': 'spotnik', 'Value': 'asg'}])
+
+        failures = self.queue.close()
+        self.assertEqual(len(failures), 1)
+        self.assertIn('sir-1', failures[0])
+        self.assertEqual(self.ec2_client.create_tags.call_count, 3)
+
+    def test_other_errors_are_not_retried(self):
+        self.ec2_client.create_tags.side_effect = Exception("denied")
+
+        self.queue.create_tags(['sir-1'], [{'Key': 'spotnik', 'Value': 'asg'}])
+
+        self.assertEqual(self.queue.close(), ["create_tags sir-1: denied"])
+        self.assertEqual(self.ec2_client.create_tags.call_count, 1)
+
+    def test_enqueue_does_not_wait_for_api(self):
+        release = threading.Event()
+        self.ec2_client.create_tags.side_effect = lambda **_: release.wait()
+        self.queue.linger = 0
+
+        self.queue.create_tags(['sir-1'], [{'Key': 'spotnik', 'Value': 'asg'}])
+        self.queue.create_tags(['sir-2'], [{'Key': 'spotnik', 'Value': 'other'}])
+
+        release.set()
+        self.assertEqual(self.queue.close(), [])
+
+
+class TagQueueRegistryTests(unittest2.TestCase):
+    @patch("spotnik.aws.get_client")
+    def test_queues_are_shared_per_region_and_drained(self, mock_get_client):
+        mock_get_client.return_value.create_tags.side_effect = Exception("denied")
+        queue = get_tag_queue('eu-west-1', role_arn='arn:aws:iam::111111111111:role/spotnik')
+        self.assertIs(get_tag_queue('eu-west-1', role_arn='arn:aws:iam::111111111111:role/spotnik'), queue)
+        self.assertIsNot(get_tag_queue('eu-west-1'), queue)
+
+        queue.create_tags(['sir-1'], [{'Key': 'spotnik', 'Value': 'asg'}])
+
+        self.assertEqual(drain_tag_queues(), {
+            'arn:aws:iam::111111111111:role/spotnik': ["eu-west-1: create_tags sir-1: denied"]})
+        self.assertEqual(drain_tag_queues(), {})